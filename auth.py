@@ -0,0 +1,216 @@
+# auth.py
+"""Пароли и сессии.
+
+bcrypt считается в отдельном пуле из BCRYPT_WORKERS потоков (bcrypt
+отпускает GIL), а не в общем пуле обработчиков: очередь входов не
+забирает потоки у остальных запросов. Если в очереди больше
+BCRYPT_MAX_PENDING проверок, новые сразу получают отказ (PasswordBusy).
+
+Сессия — подписанный HMAC токен в cookie: имя пользователя и срок
+действия. Проверяется без обращения к БД на каждом HTTP-запросе и при
+подключении WebSocket. Что пользователь существует, помнит UserCache.
+SECRET_KEY берётся из окружения или .env; без него ключ случайный,
+и сессии не переживают перезапуск и не работают между узлами.
+"""
+import asyncio
+import base64
+import hashlib
+import hmac
+import logging
+import os
+import secrets
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import bcrypt
+from dotenv import load_dotenv
+from fastapi import HTTPException, Request
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from starlette.requests import HTTPConnection
+
+from database import run_db
+from models import User
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+SESSION_COOKIE = "session"
+SESSION_TTL_S = int(os.getenv("SESSION_TTL_S", str(7 * 86400)))
+SESSION_COOKIE_SECURE = os.getenv("SESSION_COOKIE_SECURE", "") == "1"
+BCRYPT_WORKERS = int(os.getenv("BCRYPT_WORKERS", "2"))
+BCRYPT_MAX_PENDING = int(os.getenv("BCRYPT_MAX_PENDING", "64"))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL_S = int(os.getenv("USER_CACHE_TTL_S", "300"))
+
+SECRET_KEY = os.getenv("SECRET_KEY", "").encode()
+if not SECRET_KEY:
+    logger.warning("SECRET_KEY is not set, sessions will not survive a restart")
+    SECRET_KEY = secrets.token_bytes(32)
+
+_executor = ThreadPoolExecutor(max_workers=BCRYPT_WORKERS, thread_name_prefix="bcrypt")
+_pending = 0
+
+
+class PasswordBusy(Exception):
+    """Очередь проверки паролей переполнена."""
+
+
+# ====== Пароли ======
+async def _run_bcrypt(fn, *args):
+    global _pending
+    if _pending >= BCRYPT_MAX_PENDING:
+        raise PasswordBusy()
+    _pending += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_executor, fn, *args)
+    finally:
+        _pending -= 1
+
+
+def _hash(password: str) -> str:
+    return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt()).decode("utf-8")
+
+
+def _check(password: str, hashed: str) -> bool:
+    return bcrypt.checkpw(password.encode("utf-8"), hashed.encode("utf-8"))
+
+
+async def hash_password(password: str) -> str:
+    return await _run_bcrypt(_hash, password)
+
+
+async def check_password(password: str, hashed: str) -> bool:
+    return await _run_bcrypt(_check, password, hashed)
+
+
+def shutdown():
+    _executor.shutdown(wait=False, cancel_futures=True)
+
+
+# ====== БД (через run_db) ======
+def user_exists(db: Session, username: str) -> bool:
+    return db.query(User.id).filter(User.username == username).first() is not None
+
+
+def load_password_hash(db: Session, username: str) -> Optional[str]:
+    row = db.query(User.hashed_password).filter(User.username == username).first()
+    return row.hashed_password if row else None
+
+
+def create_user(db: Session, username: str, hashed: str) -> bool:
+    """False — имя уже занято (в том числе параллельной регистрацией)."""
+    user = User(username=username, hashed_password=hashed)
+    user.generate_friend_code()
+    db.add(user)
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        return False
+    return True
+
+
+# ====== Сессии ======
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _b64decode(value: str) -> bytes:
+    return base64.urlsafe_b64decode(value + "=" * (-len(value) % 4))
+
+
+def _sign(payload: str) -> str:
+    return _b64encode(hmac.new(SECRET_KEY, payload.encode(), hashlib.sha256).digest())
+
+
+def issue_token(username: str, ttl_s: int = SESSION_TTL_S) -> str:
+    payload = _b64encode(f"{int(time.time()) + ttl_s}:{username}".encode("utf-8"))
+    return f"{payload}.{_sign(payload)}"
+
+
+def verify_token(token: Optional[str]) -> Optional[str]:
+    """Имя пользователя из действующего токена или None."""
+    if not token or "." not in token:
+        return None
+    payload, signature = token.rsplit(".", 1)
+    if not hmac.compare_digest(signature, _sign(payload)):
+        return None
+    try:
+        expires, username = _b64decode(payload).decode("utf-8").split(":", 1)
+        if int(expires) < time.time():
+            return None
+    except ValueError:
+        return None
+    return username or None
+
+
+def set_session(response, username: str):
+    response.set_cookie(
+        SESSION_COOKIE, issue_token(username), max_age=SESSION_TTL_S,
+        httponly=True, samesite="lax", secure=SESSION_COOKIE_SECURE
+    )
+
+
+def clear_session(response):
+    response.delete_cookie(SESSION_COOKIE)
+
+
+class UserCache:
+    """Имена существующих пользователей (LRU с TTL). Отсутствие не кэшируется:
+    пользователь может зарегистрироваться в любой момент."""
+
+    def __init__(self, size: int = USER_CACHE_SIZE, ttl_s: int = USER_CACHE_TTL_S):
+        self.size = size
+        self.ttl = ttl_s
+        # username -> когда запись истекает (time.monotonic)
+        self.users: "OrderedDict[str, float]" = OrderedDict()
+        self.counters = {"hits": 0, "misses": 0}
+
+    def add(self, username: str):
+        self.users[username] = time.monotonic() + self.ttl
+        self.users.move_to_end(username)
+        while len(self.users) > self.size:
+            self.users.popitem(last=False)
+
+    async def exists(self, username: str) -> bool:
+        expires = self.users.get(username)
+        if expires is not None and expires > time.monotonic():
+            self.users.move_to_end(username)
+            self.counters["hits"] += 1
+            return True
+        self.counters["misses"] += 1
+        if not await run_db(user_exists, username):
+            self.users.pop(username, None)
+            return False
+        self.add(username)
+        return True
+
+
+users = UserCache()
+
+
+async def session_user(connection: HTTPConnection) -> Optional[str]:
+    """Пользователь сессии для Request или WebSocket; None — не вошёл.
+    Зависимость для страниц: без сессии они перенаправляют на вход."""
+    username = verify_token(connection.cookies.get(SESSION_COOKIE))
+    if username is None or not await users.exists(username):
+        return None
+    return username
+
+
+async def current_user(request: Request) -> str:
+    """Зависимость для API: 401 без действующей сессии."""
+    username = await session_user(request)
+    if username is None:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    return username
+
+
+def require_self(claimed: str, username: str):
+    """Имя из формы или запроса должно совпадать с пользователем сессии."""
+    if claimed != username:
+        raise HTTPException(status_code=403, detail="Forbidden")
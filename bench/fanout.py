@@ -0,0 +1,186 @@
+# bench/fanout.py
+"""Fan-out latency benchmark for the WebSocket message path.
+
+Simulates N concurrent sockets inside one event loop, with no network
+involved. Each simulated client sends chat messages into its private
+chat and typing events into a shared group. Every event is persisted
+the way websocket_endpoint does it and then delivered via
+ConnectionManager.broadcast. We measure the time from "event received"
+to "delivered to the last recipient".
+
+With --stalled N, the first N sockets never finish a send (a peer that
+stopped reading). Their frames pile up in their own outbound queues until
+the send timeout evicts them; the other sockets should not notice.
+
+Modes:
+  blocking     - synchronous SQLAlchemy commit right on the event loop (original behavior)
+  executor     - one commit per message via database.run_db in the DB thread
+  writebehind  - message_queue.MessageWriter: id right away, batched commits (current behavior)
+
+Run from the repository root:
+    python bench/fanout.py --sockets 1000 --messages 5 --interval 5
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+class FakeSocket:
+    """Minimal stand-in for WebSocket: records when the frame was delivered."""
+
+    def __init__(self, sink, stalled=False):
+        self.sink = sink
+        self.stalled = stalled
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def send_text(self, message):
+        if self.stalled:
+            await asyncio.Event().wait()
+        await asyncio.sleep(0)
+        sent_at = json.loads(message).get("_sent_at")
+        if sent_at is not None:
+            self.sink.append((message, time.perf_counter()))
+
+    async def close(self, code=1000):
+        pass
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+    return values[k]
+
+
+async def run(mode, sockets, messages, interval, seed, stalled=0):
+    from connections import ConnectionManager
+    from database import run_db
+    from message_queue import MessageWriter
+    from models import Message, SessionLocal, User, init_db
+
+    init_db()
+
+    def insert_message(db, username, text, chat_id):
+        db_message = Message(username=username, text=text, chat_id=chat_id)
+        db.add(db_message)
+        db.commit()
+        db.refresh(db_message)
+        return db_message.id, db_message.timestamp.isoformat() + "Z"
+
+    random.seed(seed)
+    users = [f"bench{i}" for i in range(sockets)]
+    group_id = "group:bench"
+
+    async def resolve(chat_id):
+        return users
+
+    # Honors PUBSUB_URL, so the same run can measure the cost of going through a broker
+    manager = ConnectionManager(resolve)
+    await manager.start()
+    deliveries = []
+    for i, u in enumerate(users):
+        await manager.connect(FakeSocket(deliveries, stalled=i < stalled), u)
+
+    db = SessionLocal()
+    if not db.query(User).filter(User.username == users[0]).first():
+        db.add_all([User(username=u, hashed_password="", friend_code=u.upper()) for u in users])
+        db.commit()
+
+    writer = MessageWriter()
+    writer.start()
+
+    latencies = {"message": [], "typing": []}
+    started = {}
+
+    async def client(i):
+        me = users[i]
+        peer = users[(i + 1) % sockets]
+        chat_id = ":".join(sorted([me, peer]))
+        for n in range(messages):
+            await asyncio.sleep(random.random() * 2 * interval)
+            key = f"{me}-{n}"
+            started[key] = ("message", time.perf_counter())
+            if mode == "blocking":
+                msg_id, ts = insert_message(db, me, "hello", chat_id)
+            elif mode == "executor":
+                msg_id, ts = await run_db(insert_message, me, "hello", chat_id)
+            else:
+                msg_id, ts = writer.insert(me, "hello", chat_id)
+            await manager.broadcast(chat_id, {"type": "message", "id": msg_id, "_sent_at": key})
+
+            tkey = f"{me}-t{n}"
+            started[tkey] = ("typing", time.perf_counter())
+            await manager.broadcast(group_id if i % 50 == 0 else chat_id,
+                                    {"type": "typing", "users": [me], "_sent_at": tkey})
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(client(i) for i in range(sockets)))
+    elapsed = time.perf_counter() - t0
+    # Frames may still sit in outbound queues; stalled sockets are evicted after the send timeout
+    while manager.outbox_stats()["queued"]:
+        await asyncio.sleep(0.01)
+    stats = manager.outbox_stats()
+    await writer.stop()
+    await manager.stop()
+    db.close()
+
+    last_delivery = {}
+    for message, at in deliveries:
+        key = json.loads(message)["_sent_at"]
+        last_delivery[key] = max(at, last_delivery.get(key, 0))
+    for key, (kind, t_start) in started.items():
+        if key in last_delivery:
+            latencies[kind].append((last_delivery[key] - t_start) * 1000)
+
+    return {
+        "mode": mode,
+        "sockets": sockets,
+        "stalled": stalled,
+        "events": len(started),
+        "elapsed_s": round(elapsed, 3),
+        "message_p50_ms": round(statistics.median(latencies["message"]), 2),
+        "message_p99_ms": round(percentile(latencies["message"], 99), 2),
+        "typing_p50_ms": round(statistics.median(latencies["typing"]), 2),
+        "typing_p99_ms": round(percentile(latencies["typing"], 99), 2),
+        "evicted": stats["evicted"],
+        "dropped": stats["dropped"],
+        "coalesced": stats["coalesced"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sockets", type=int, default=1000)
+    parser.add_argument("--messages", type=int, default=5, help="messages per client")
+    parser.add_argument("--interval", type=float, default=5.0, help="mean seconds between a client's messages")
+    parser.add_argument("--mode", choices=["blocking", "executor", "writebehind", "all"], default="all")
+    parser.add_argument("--stalled", type=int, default=0, help="sockets that never complete a send")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    # models.py creates ./chat.db relative to the cwd, so we work in a temporary directory
+    workdir = tempfile.mkdtemp(prefix="fanout-")
+    os.chdir(workdir)
+    for d in ("static", "templates"):
+        os.makedirs(d, exist_ok=True)
+
+    modes = ["blocking", "executor", "writebehind"] if args.mode == "all" else [args.mode]
+    for mode in modes:
+        result = asyncio.run(run(mode, args.sockets, args.messages, args.interval, args.seed, args.stalled))
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
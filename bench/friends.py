@@ -0,0 +1,131 @@
+# bench/friends.py
+"""Friend-list lookup latency as the messages table grows.
+
+Compares the old approach with the new one:
+  scan        - Message.chat_id.contains(username) + distinct + one User query per friend
+  friendship  - main.load_friends: one indexed query over friendships with a join to users
+
+The messages table is filled step by step up to the sizes in --sizes.
+After each step both queries are timed for random users.
+
+Run from the repository root (10M rows take a few minutes and ~1 GB of disk):
+    python bench/friends.py --sizes 10000,100000,1000000,10000000
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def old_friend_list(db, username):
+    from models import Message, User
+
+    friend_chats = db.query(Message.chat_id).filter(
+        Message.chat_id.contains(username),
+        Message.chat_id != "global"
+    ).distinct().all()
+    friends = set()
+    for chat_id in friend_chats:
+        for u in chat_id[0].split(":"):
+            if u != username:
+                friends.add(u)
+    result = []
+    for friend_name in friends:
+        friend = db.query(User).filter(User.username == friend_name).first()
+        if friend:
+            result.append(friend.username)
+    return result
+
+
+def seed_graph(path, users, friends_per_user, rng):
+    conn = sqlite3.connect(path)
+    conn.executemany(
+        "INSERT INTO users (username, hashed_password, friend_code, avatar_url, bio) VALUES (?, '', ?, '', '')",
+        [(f"user{i}", f"C{i:07d}") for i in range(users)]
+    )
+    pairs = set()
+    for i in range(users):
+        for _ in range(friends_per_user // 2):
+            j = rng.randrange(users)
+            if j != i:
+                pairs.add(tuple(sorted((f"user{i}", f"user{j}"))))
+    conn.executemany("INSERT OR IGNORE INTO friendships (username, friend) VALUES (?, ?)",
+                     [p for a, b in pairs for p in ((a, b), (b, a))])
+    conn.commit()
+    conn.close()
+    return sorted(pairs)
+
+
+def grow_messages(path, chats, start_id, count, rng):
+    conn = sqlite3.connect(path)
+    batch = 100_000
+    done = 0
+    while done < count:
+        n = min(batch, count - done)
+        rows = []
+        for k in range(n):
+            chat = chats[rng.randrange(len(chats))]
+            rows.append((start_id + done + k, chat[0], "hello", "2025-01-01 00:00:00", f"{chat[0]}:{chat[1]}"))
+        conn.executemany("INSERT INTO messages (id, username, text, timestamp, chat_id) VALUES (?, ?, ?, ?, ?)", rows)
+        conn.commit()
+        done += n
+    conn.close()
+
+
+def time_calls(fn, db, usernames):
+    samples = []
+    for u in usernames:
+        t0 = time.perf_counter()
+        fn(db, u)
+        samples.append((time.perf_counter() - t0) * 1000)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10000,100000,1000000", help="message table sizes, comma-separated")
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--friends", type=int, default=20, help="average friends per user")
+    parser.add_argument("--samples", type=int, default=50)
+    parser.add_argument("--skip-scan-above", type=int, default=2_000_000,
+                        help="do not time the old scan above this many rows (it takes seconds per call)")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="friends-")
+    os.chdir(workdir)
+    for d in ("static", "templates"):
+        os.makedirs(d, exist_ok=True)
+
+    from main import load_friends
+    from models import SessionLocal, init_db
+
+    init_db()
+
+    rng = random.Random(1)
+    chats = seed_graph(os.path.join(workdir, "chat.db"), args.users, args.friends, rng)
+
+    current = 0
+    for size in (int(x) for x in args.sizes.split(",")):
+        grow_messages(os.path.join(workdir, "chat.db"), chats, current + 1, size - current, rng)
+        current = size
+        probe = [f"user{rng.randrange(args.users)}" for _ in range(args.samples)]
+        db = SessionLocal()
+        try:
+            result = {"messages": size, "friendship_p50_ms": round(time_calls(load_friends, db, probe), 3)}
+            if size <= args.skip_scan_above:
+                result["scan_p50_ms"] = round(time_calls(old_friend_list, db, probe[:10]), 3)
+        finally:
+            db.close()
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,511 @@
+# bench/loadtest.py
+"""End-to-end load test for the WebSocket and REST paths.
+
+Seeds a database with --users users, their friendships and private chats,
+groups and --messages messages, starts the app with uvicorn in a scratch
+directory and runs two phases against it over real sockets:
+
+  ws    - --clients simulated /ws/{username} clients. Each one repeatedly
+          sleeps (exponential, mean --interval) and then sends one action
+          picked by --mix: a message, a typing event, load_chat of one of
+          its chats or an attachment frame. Latency is measured from send to
+          the server's answer to that client: its own broadcast for messages
+          and attachments, the history page for load_chat.
+  rest  - GET /api/user/chats and /api/friends_list for random users,
+          --concurrency parallel keep-alive connections, --duration seconds
+          per endpoint.
+
+Every phase prints one JSON line. --out writes the whole run as one JSON
+document; --compare BASELINE prints the p50/p99 change against an earlier
+--out file and exits with status 1 if any p99 got worse by more than
+--tolerance.
+
+Clients use session cookies signed with the server's SECRET_KEY instead of
+logging in, so bcrypt does not skew the numbers. The clients run in this
+process: on a small machine the harness itself may be the bottleneck, so
+compare runs made on the same hardware.
+
+Seeding 10M messages takes about ten minutes and a few GB of disk. With
+--seed-db the seeded database is kept and later runs copy it instead:
+    python bench/loadtest.py --users 10000 --messages 10000000 --seed-db /tmp/seed-10m.db
+    python bench/loadtest.py --seed-db /tmp/seed-10m.db --clients 2000 --out after.json --compare before.json
+"""
+import argparse
+import asyncio
+import http.client
+import json
+import os
+import random
+import resource
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from datetime import datetime, timedelta, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+SECRET_KEY = "loadtest"
+WORDS = ("hello", "ok", "see", "you", "tomorrow", "lunch", "where", "meeting", "photo", "thanks",
+         "call", "me", "later", "привет", "как", "дела", "давай", "завтра", "созвонимся", "отлично")
+FTS_TRIGGERS = ("messages_fts_insert", "messages_fts_delete", "messages_fts_update")
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+    return values[k]
+
+
+def summarize(prefix, values):
+    return {
+        f"{prefix}_p50_ms": round(percentile(values, 50), 2),
+        f"{prefix}_p99_ms": round(percentile(values, 99), 2),
+    }
+
+
+def parse_mix(value):
+    mix = {}
+    for item in value.split(","):
+        kind, _, weight = item.partition("=")
+        mix[kind.strip()] = float(weight)
+    unknown = set(mix) - {"message", "typing", "load_chat", "attachment"}
+    if unknown:
+        raise SystemExit(f"unknown actions in --mix: {', '.join(sorted(unknown))}")
+    return mix
+
+
+# ====== Seeding ======
+def seed(path, users, friends_per_user, groups, messages, rng):
+    """Fills an empty, migrated database directly through sqlite3."""
+    from models import message_id_at
+
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA synchronous=OFF")
+    # The FTS index is rebuilt once at the end instead of per row
+    for trigger in FTS_TRIGGERS:
+        conn.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+
+    names = [f"user{i}" for i in range(users)]
+    conn.executemany(
+        "INSERT INTO users (username, hashed_password, friend_code, avatar_url, bio) VALUES (?, '', ?, '', '')",
+        [(name, f"C{i:07d}") for i, name in enumerate(names)]
+    )
+
+    pairs = set()
+    for i in range(users):
+        for _ in range(friends_per_user // 2):
+            j = rng.randrange(users)
+            if j != i:
+                pairs.add(tuple(sorted((names[i], names[j]))))
+    pairs = sorted(pairs)
+    conn.executemany("INSERT INTO friendships (username, friend) VALUES (?, ?)",
+                     [p for a, b in pairs for p in ((a, b), (b, a))])
+
+    chats = [(f"{a}:{b}", (a, b)) for a, b in pairs]
+    for g in range(groups):
+        members = tuple(sorted(rng.sample(names, min(users, rng.randint(3, 8)))))
+        chats.append((f"group:{g:08x}", members))
+    created = "2024-01-01 00:00:00"
+    conn.executemany(
+        "INSERT INTO chats (id, type, name, created_at) VALUES (?, ?, ?, ?)",
+        [(cid, "group" if cid.startswith("group:") else "private",
+          f"group {cid[6:]}" if cid.startswith("group:") else "", created) for cid, _ in chats]
+    )
+    conn.executemany("INSERT INTO chat_members (chat_id, username, last_read_id, unread_count) VALUES (?, ?, 0, 0)",
+                     [(cid, u) for cid, members in chats for u in members])
+    conn.commit()
+
+    # A few chats get most of the traffic
+    rng.shuffle(chats)
+    end = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(hours=1)
+    span_ms = 90 * 86400 * 1000
+    start_ms = int(end.timestamp() * 1000) - span_ms
+    step = span_ms / max(messages, 1)
+    last = {}
+    batch = 100_000
+    for offset in range(0, messages, batch):
+        rows = []
+        for i in range(offset, min(messages, offset + batch)):
+            cid, members = chats[int(len(chats) * rng.random() ** 3)]
+            ts_ms = start_ms + int(i * step)
+            # Same layout as next_message_id: unique and growing with time
+            msg_id = message_id_at(ts_ms) + (i % 4096)
+            text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 12)))
+            timestamp = datetime.fromtimestamp(ts_ms / 1000, timezone.utc).replace(tzinfo=None).isoformat(" ")
+            row = (msg_id, rng.choice(members), text, timestamp, cid)
+            rows.append(row)
+            last[cid] = row
+        conn.executemany("INSERT INTO messages (id, username, text, timestamp, chat_id) VALUES (?, ?, ?, ?, ?)", rows)
+        conn.commit()
+
+    # Chat previews; the seeded history counts as read
+    conn.executemany(
+        "UPDATE chats SET last_message_id = ?, last_message_username = ?, last_message_text = ?, last_message_at = ? "
+        "WHERE id = ?",
+        [(msg_id, username, text, ts, cid) for msg_id, username, text, ts, cid in last.values()]
+    )
+    conn.executemany("UPDATE chat_members SET last_read_id = ? WHERE chat_id = ?",
+                     [(row[0], cid) for cid, row in last.items()])
+    conn.commit()
+    conn.close()
+
+
+def prepare_database(args):
+    """chat.db in the cwd: a copy of --seed-db, or a freshly seeded one."""
+    if args.seed_db and os.path.exists(args.seed_db):
+        shutil.copyfile(args.seed_db, "chat.db")
+        return False
+
+    import search
+    from migrations import run_migrations
+    from models import SessionLocal, engine, init_db
+
+    init_db()
+    db = SessionLocal()
+    try:
+        run_migrations(db)
+    finally:
+        db.close()
+    seed("chat.db", args.users, args.friends, args.groups, args.messages, random.Random(args.seed))
+    db = SessionLocal()
+    try:
+        search.install(db)
+        db.commit()
+    finally:
+        db.close()
+    engine.dispose()
+    conn = sqlite3.connect("chat.db")
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.close()
+    if args.seed_db:
+        shutil.copyfile("chat.db", args.seed_db)
+    return True
+
+
+def load_population(clients, rng):
+    """(all users, {username: [chat_id]} for clients users that have chats)."""
+    conn = sqlite3.connect("chat.db")
+    users = [u for (u,) in conn.execute("SELECT username FROM users ORDER BY id")]
+    chats = {}
+    for chat_id, username in conn.execute("SELECT chat_id, username FROM chat_members"):
+        chats.setdefault(username, []).append(chat_id)
+    conn.close()
+    candidates = sorted(chats)
+    picked = rng.sample(candidates, min(clients, len(candidates)))
+    return users, {u: chats[u] for u in picked}
+
+
+# ====== Server ======
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(port):
+    env = dict(os.environ, SECRET_KEY=SECRET_KEY, PYTHONPATH=ROOT)
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+        env=env
+    )
+    deadline = time.monotonic() + 600
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit("server exited during startup")
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/", timeout=1).read()
+            return process
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise SystemExit("server did not start")
+
+
+def session_cookie(username):
+    from auth import issue_token
+    return f"session={issue_token(username)}"
+
+
+# ====== WebSocket phase ======
+class WsStats:
+    def __init__(self):
+        self.latencies = {"connect": [], "message": [], "attachment": [], "load_chat": []}
+        self.sent = {"message": 0, "typing": 0, "load_chat": 0, "attachment": 0}
+        self.received = 0
+        self.rate_limited = 0
+        self.failed = 0
+
+
+async def run_client(port, username, chats, args, mix, stats, start_at, stop_at, rng):
+    import websockets
+
+    await asyncio.sleep(max(0.0, start_at - time.monotonic()))
+    pending = {}
+    t0 = time.perf_counter()
+    try:
+        ws = await websockets.connect(
+            f"ws://127.0.0.1:{port}/ws/{username}",
+            additional_headers={"Cookie": session_cookie(username)},
+            max_size=None, open_timeout=120, ping_interval=None
+        )
+    except Exception:
+        stats.failed += 1
+        return
+    stats.latencies["connect"].append((time.perf_counter() - t0) * 1000)
+
+    async def read():
+        async for raw in ws:
+            now = time.perf_counter()
+            stats.received += 1
+            data = json.loads(raw)
+            kind = data.get("type")
+            if kind == "message":
+                key = ("message", data.get("text"))
+            elif kind == "attachment":
+                key = ("attachment", data.get("url"))
+            elif kind == "history":
+                key = ("load_chat", data.get("chat_id"))
+            elif kind == "rate_limited":
+                stats.rate_limited += 1
+                continue
+            else:
+                continue
+            started = pending.pop(key, None)
+            if started is not None:
+                stats.latencies[key[0]].append((now - started) * 1000)
+
+    reader = asyncio.create_task(read())
+    actions, weights = list(mix), list(mix.values())
+    seq = 0
+    try:
+        while True:
+            pause = rng.expovariate(1.0 / args.interval)
+            if time.monotonic() + pause >= stop_at:
+                break
+            await asyncio.sleep(pause)
+            action = rng.choices(actions, weights)[0]
+            chat_id = rng.choice(chats)
+            seq += 1
+            if action == "message":
+                text = f"{username}#{seq} " + " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 12)))
+                frame = {"text": text, "chat_id": chat_id}
+                key = ("message", text)
+            elif action == "attachment":
+                url = f"/files/{username}-{seq}/photo.jpg"
+                frame = {"type": "attachment", "chat_id": chat_id, "url": url,
+                         "filename": "photo.jpg", "is_image": True}
+                key = ("attachment", url)
+            elif action == "load_chat":
+                frame = {"type": "load_chat", "chat_id": chat_id}
+                key = ("load_chat", chat_id)
+            else:
+                frame = {"type": "typing", "chat_id": chat_id, "is_typing": True}
+                key = None
+            if key is not None:
+                pending[key] = time.perf_counter()
+            stats.sent[action] += 1
+            await ws.send(json.dumps(frame))
+        # Answers to the last actions
+        deadline = time.monotonic() + args.drain
+        while pending and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+    except Exception:
+        stats.failed += 1
+    finally:
+        reader.cancel()
+        await ws.close()
+
+
+async def ws_phase(port, population, args, mix):
+    stats = WsStats()
+    rng = random.Random(args.seed)
+    begin = time.monotonic()
+    ramp_step = args.ramp / max(len(population), 1)
+    stop_at = begin + args.ramp + args.duration
+    tasks = [
+        run_client(port, username, chats, args, mix, stats, begin + i * ramp_step, stop_at,
+                   random.Random(rng.random()))
+        for i, (username, chats) in enumerate(population.items())
+    ]
+    await asyncio.gather(*tasks)
+    elapsed = time.monotonic() - begin
+    active = max(elapsed - args.ramp, 1e-9)
+
+    answered = sum(len(stats.latencies[k]) for k in ("message", "attachment", "load_chat"))
+    expected = stats.sent["message"] + stats.sent["attachment"] + stats.sent["load_chat"]
+    result = {
+        "phase": "ws",
+        "clients": len(population),
+        "failed": stats.failed,
+        "duration_s": round(elapsed, 2),
+        "sent": stats.sent,
+        "unanswered": expected - answered,
+        "rate_limited": stats.rate_limited,
+        "frames_received": stats.received,
+        "messages_per_s": round((stats.sent["message"] + stats.sent["attachment"]) / active, 1),
+        "frames_per_s": round(stats.received / active, 1),
+    }
+    for kind in ("connect", "message", "attachment", "load_chat"):
+        result.update(summarize(kind, stats.latencies[kind]))
+    return result
+
+
+# ====== REST phase ======
+def rest_phase(port, users, path, args):
+    rng = random.Random(args.seed)
+    deadline = time.monotonic() + args.duration
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def worker(worker_rng):
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        own = []
+        failed = 0
+        while time.monotonic() < deadline:
+            username = worker_rng.choice(users)
+            headers = {"Cookie": session_cookie(username)}
+            t0 = time.perf_counter()
+            try:
+                conn.request("GET", f"{path}?username={username}", headers=headers)
+                response = conn.getresponse()
+                response.read()
+                if response.status != 200:
+                    failed += 1
+                    continue
+            except (OSError, http.client.HTTPException):
+                failed += 1
+                conn.close()
+                conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+                continue
+            own.append((time.perf_counter() - t0) * 1000)
+        conn.close()
+        with lock:
+            latencies.extend(own)
+            errors.append(failed)
+
+    begin = time.monotonic()
+    threads = [threading.Thread(target=worker, args=(random.Random(rng.random()),)) for _ in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - begin
+    return {
+        "phase": "rest",
+        "endpoint": path,
+        "concurrency": args.concurrency,
+        "requests": len(latencies),
+        "errors": sum(errors),
+        "requests_per_s": round(len(latencies) / elapsed, 1),
+        **summarize("latency", latencies),
+    }
+
+
+# ====== Comparison ======
+def phase_key(result):
+    return result["phase"], result.get("endpoint")
+
+
+def compare(baseline, runs, tolerance):
+    before = {phase_key(r): r for r in baseline["runs"]}
+    regressed = False
+    for result in runs:
+        old = before.get(phase_key(result))
+        if old is None:
+            continue
+        for metric, value in result.items():
+            if not metric.endswith(("_p50_ms", "_p99_ms")) or not old.get(metric):
+                continue
+            change = (value - old[metric]) / old[metric]
+            worse = metric.endswith("_p99_ms") and change > tolerance
+            regressed = regressed or worse
+            print(json.dumps({
+                "phase": result["phase"], "endpoint": result.get("endpoint"), "metric": metric,
+                "before": old[metric], "after": value, "change": round(change, 3), "regression": worse,
+            }))
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--friends", type=int, default=20, help="average friends per user")
+    parser.add_argument("--groups", type=int, default=1000)
+    parser.add_argument("--messages", type=int, default=1_000_000)
+    parser.add_argument("--seed-db", help="keep the seeded database here; reuse it if it exists")
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--interval", type=float, default=2.0, help="mean seconds between a client's actions")
+    parser.add_argument("--mix", default="message=60,typing=25,load_chat=10,attachment=5")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds per phase")
+    parser.add_argument("--ramp", type=float, default=10.0, help="seconds to open all client sockets")
+    parser.add_argument("--drain", type=float, default=5.0, help="seconds to wait for answers after the phase")
+    parser.add_argument("--concurrency", type=int, default=16, help="parallel REST connections")
+    parser.add_argument("--phases", default="ws,rest")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="write the run as one JSON document")
+    parser.add_argument("--compare", help="earlier --out file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed p99 growth for --compare")
+    args = parser.parse_args()
+    mix = parse_mix(args.mix)
+    phases = [p.strip() for p in args.phases.split(",") if p.strip()]
+    if args.seed_db:
+        args.seed_db = os.path.abspath(args.seed_db)
+
+    # Thousands of client sockets plus the server's side of them
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (max(soft, min(hard, 4 * args.clients + 1024)), hard))
+
+    # The app works with ./chat.db, ./static and ./templates: run it in a scratch directory
+    os.environ["SECRET_KEY"] = SECRET_KEY
+    workdir = tempfile.mkdtemp(prefix="loadtest-")
+    os.chdir(workdir)
+    for d in ("static", "templates"):
+        os.symlink(os.path.join(ROOT, d), d)
+
+    t0 = time.monotonic()
+    seeded = prepare_database(args)
+    rng = random.Random(args.seed)
+    users, population = load_population(args.clients, rng)
+    print(json.dumps({"phase": "setup", "seeded": seeded, "users": len(users),
+                      "clients": len(population), "elapsed_s": round(time.monotonic() - t0, 1)}), flush=True)
+
+    port = free_port()
+    server = start_server(port)
+    runs = []
+    try:
+        if "ws" in phases:
+            runs.append(asyncio.run(ws_phase(port, population, args, mix)))
+            print(json.dumps(runs[-1]), flush=True)
+        if "rest" in phases:
+            for path in ("/api/user/chats", "/api/friends_list"):
+                runs.append(rest_phase(port, users, path, args))
+                print(json.dumps(runs[-1]), flush=True)
+        server_stats = json.loads(urllib.request.urlopen(f"http://127.0.0.1:{port}/api/stats").read())
+    finally:
+        server.terminate()
+        server.wait()
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    print(json.dumps({"phase": "server", **server_stats}), flush=True)
+    document = {"args": vars(args), "runs": runs, "server": server_stats}
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(document, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(json.load(f), runs, args.tolerance):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+# bench/search.py
+"""Latency of /api/search (search.search_messages) on a synthetic corpus.
+
+Builds a messages table of --messages rows in a temporary directory.
+Words follow a Zipf distribution over a synthetic vocabulary, so queries
+for common words touch hundreds of thousands of postings. The FTS5 index
+is built with search.install (the same 'rebuild' the migration runs).
+Then queries of several kinds are timed for random users. Each query is
+restricted to the chats that user belongs to.
+
+Query kinds:
+  rare     - a word from the tail of the distribution
+  medium   - a word ranked 100..1000
+  common   - one of the 20 most frequent words
+  two      - medium word AND common word
+  prefix   - first 3 letters of a medium word, as an explicit prefix query ("abc*")
+  in_chat  - common word restricted to one chat (chat_id parameter)
+
+Run from the repository root (5M rows take several minutes and ~1.5 GB of disk):
+    python bench/search.py --messages 5000000 --workdir /tmp/search-5m
+A second run with the same --workdir reuses the database and only times queries.
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    k = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+    return values[k]
+
+
+def make_vocabulary(size, rng):
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choice(letters) for _ in range(rng.randint(4, 10))))
+    words = sorted(words)
+    rng.shuffle(words)
+    return words
+
+
+def rank_words(db, sample):
+    """Words by frequency in the last `sample` messages, so a reused database is probed correctly."""
+    from collections import Counter
+    from models import Message
+
+    counts = Counter()
+    for (text,) in db.query(Message.text).order_by(Message.id.desc()).limit(sample):
+        counts.update((text or "").split())
+    return [word for word, _ in counts.most_common()]
+
+
+def seed(path, args, vocabulary, rng):
+    conn = sqlite3.connect(path)
+    users = [f"user{i}" for i in range(args.users)]
+    conn.executemany(
+        "INSERT INTO users (username, hashed_password, friend_code, avatar_url, bio) VALUES (?, '', ?, '', '')",
+        [(u, f"C{i:07d}") for i, u in enumerate(users)]
+    )
+
+    chats = set()
+    for i in range(args.users):
+        for _ in range(args.friends // 2):
+            j = rng.randrange(args.users)
+            if j != i:
+                chats.add(":".join(sorted((users[i], users[j]))))
+    members = {chat_id: chat_id.split(":") for chat_id in chats}
+    for g in range(args.groups):
+        members[f"group:{g:08x}"] = rng.sample(users, args.group_size)
+    chat_ids = sorted(members)
+    conn.executemany("INSERT INTO chats (id, type) VALUES (?, ?)",
+                     [(c, "group" if c.startswith("group:") else "private") for c in chat_ids])
+    conn.executemany("INSERT INTO chat_members (chat_id, username, last_read_id, unread_count) VALUES (?, ?, 0, 0)",
+                     [(c, u) for c in chat_ids for u in members[c]])
+
+    weights = [1.0 / (rank + 1) ** 1.07 for rank in range(len(vocabulary))]
+    cum_weights = []
+    total = 0.0
+    for w in weights:
+        total += w
+        cum_weights.append(total)
+
+    batch = 100_000
+    done = 0
+    while done < args.messages:
+        n = min(batch, args.messages - done)
+        lengths = [rng.randint(3, 15) for _ in range(n)]
+        words = rng.choices(vocabulary, cum_weights=cum_weights, k=sum(lengths))
+        rows = []
+        pos = 0
+        for k in range(n):
+            chat_id = chat_ids[rng.randrange(len(chat_ids))]
+            text = " ".join(words[pos:pos + lengths[k]])
+            pos += lengths[k]
+            rows.append((done + k + 1, rng.choice(members[chat_id]), text, "2025-01-01 00:00:00", chat_id))
+        conn.executemany("INSERT INTO messages (id, username, text, timestamp, chat_id) VALUES (?, ?, ?, ?, ?)", rows)
+        conn.commit()
+        done += n
+    conn.close()
+
+
+def load_members(db):
+    from models import ChatMember
+
+    user_chats = {}
+    for chat_id, username in db.query(ChatMember.chat_id, ChatMember.username):
+        user_chats.setdefault(username, []).append(chat_id)
+    return user_chats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=5_000_000)
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--friends", type=int, default=20, help="average private chats per user")
+    parser.add_argument("--groups", type=int, default=2000)
+    parser.add_argument("--group-size", type=int, default=10)
+    parser.add_argument("--vocabulary", type=int, default=50000)
+    parser.add_argument("--samples", type=int, default=100, help="queries per kind")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--workdir", help="keep the database here and reuse it on later runs")
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="search-")
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+    reuse = os.path.exists("chat.db")
+
+    import search
+    from sqlalchemy import func
+    from models import Message, SessionLocal, init_db
+
+    init_db()
+
+    rng = random.Random(args.seed)
+    vocabulary = make_vocabulary(args.vocabulary, rng)
+    db = SessionLocal()
+    seed_s = index_s = None
+    if not reuse:
+        t0 = time.perf_counter()
+        seed(os.path.join(workdir, "chat.db"), args, vocabulary, rng)
+        seed_s = round(time.perf_counter() - t0, 1)
+        t0 = time.perf_counter()
+        search.install(db)
+        db.commit()
+        index_s = round(time.perf_counter() - t0, 1)
+
+    ranked = rank_words(db, 50_000)
+    kinds = {
+        "rare": lambda: rng.choice(ranked[5000:]),
+        "medium": lambda: rng.choice(ranked[100:1000]),
+        "common": lambda: rng.choice(ranked[:20]),
+        "two": lambda: f"{rng.choice(ranked[100:1000])} {rng.choice(ranked[:20])}",
+        "prefix": lambda: rng.choice(ranked[100:1000])[:3] + "*",
+        "in_chat": lambda: rng.choice(ranked[:20]),
+    }
+    user_chats = load_members(db)
+    users = sorted(user_chats)
+    rng = random.Random(args.seed + 1)
+
+    result = {
+        "messages": db.query(func.count(Message.id)).scalar(),
+        "seed_s": seed_s,
+        "index_s": index_s,
+        "db_mb": round(os.path.getsize(os.path.join(workdir, "chat.db")) / 1e6, 1),
+    }
+    try:
+        for kind, make_query in kinds.items():
+            samples, hits = [], []
+            for _ in range(args.samples):
+                username = rng.choice(users)
+                chat_id = rng.choice(user_chats[username]) if kind == "in_chat" else None
+                query = make_query()
+                t0 = time.perf_counter()
+                found, _ = search.search_messages(db, username, query, search.SEARCH_PAGE_SIZE, 0, chat_id)
+                samples.append((time.perf_counter() - t0) * 1000)
+                hits.append(len(found))
+            result[f"{kind}_p50_ms"] = round(statistics.median(samples), 2)
+            result[f"{kind}_p99_ms"] = round(percentile(samples, 99), 2)
+            result[f"{kind}_avg_hits"] = round(statistics.mean(hits), 1)
+    finally:
+        db.close()
+    print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
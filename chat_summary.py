@@ -0,0 +1,122 @@
+# chat_summary.py
+"""Инкрементальное обновление превью чатов и счётчиков непрочитанного.
+
+Вызывается в той же транзакции, что и запись сообщений (см. message_queue.apply_ops),
+поэтому /api/user/chats читает готовые значения и не сканирует историю.
+"""
+from collections import Counter, defaultdict
+from typing import Dict, List
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from models import Chat, ChatMember, Message
+
+
+def record_inserts(db: Session, rows: List[dict]):
+    """rows — словари с полями Message (id, username, text, timestamp, chat_id)."""
+    by_chat: Dict[str, List[dict]] = defaultdict(list)
+    for row in rows:
+        by_chat[row["chat_id"]].append(row)
+
+    for chat_id, chat_rows in by_chat.items():
+        last = max(chat_rows, key=lambda r: r["id"])
+        db.query(Chat).filter(
+            Chat.id == chat_id,
+            func.coalesce(Chat.last_message_id, 0) < last["id"]
+        ).update({
+            "last_message_id": last["id"],
+            "last_message_username": last["username"],
+            "last_message_text": last["text"],
+            "last_message_at": last["timestamp"],
+        }, synchronize_session=False)
+
+        # +N непрочитанных всем участникам, затем вычитаем автору его собственные сообщения
+        db.query(ChatMember).filter(ChatMember.chat_id == chat_id).update(
+            {"unread_count": ChatMember.unread_count + len(chat_rows)}, synchronize_session=False)
+        for author, count in Counter(r["username"] for r in chat_rows).items():
+            own_last = max(r["id"] for r in chat_rows if r["username"] == author)
+            db.query(ChatMember).filter(
+                ChatMember.chat_id == chat_id,
+                ChatMember.username == author
+            ).update({
+                "unread_count": ChatMember.unread_count - count,
+                "last_read_id": func.max(func.coalesce(ChatMember.last_read_id, 0), own_last),
+            }, synchronize_session=False)
+
+
+def record_edit(db: Session, chat_id: str, msg_id: int, new_text: str):
+    db.query(Chat).filter(Chat.id == chat_id, Chat.last_message_id == msg_id).update(
+        {"last_message_text": new_text}, synchronize_session=False)
+
+
+def record_delete(db: Session, chat_id: str, msg_id: int, author: str):
+    """Вызывать после удаления строки из messages."""
+    # Сообщение ещё не прочитано у тех, чей курсор левее него
+    db.query(ChatMember).filter(
+        ChatMember.chat_id == chat_id,
+        ChatMember.username != author,
+        func.coalesce(ChatMember.last_read_id, 0) < msg_id,
+        ChatMember.unread_count > 0
+    ).update({"unread_count": ChatMember.unread_count - 1}, synchronize_session=False)
+
+    last_id = db.query(Chat.last_message_id).filter(Chat.id == chat_id).scalar()
+    if last_id == msg_id:
+        refresh_last_message(db, chat_id)
+
+
+def refresh_last_message(db: Session, chat_id: str):
+    last = (
+        db.query(Message)
+        .filter(Message.chat_id == chat_id)
+        .order_by(Message.id.desc())
+        .first()
+    )
+    db.query(Chat).filter(Chat.id == chat_id).update({
+        "last_message_id": last.id if last else None,
+        "last_message_username": last.username if last else None,
+        "last_message_text": last.text if last else None,
+        "last_message_at": last.timestamp if last else None,
+    }, synchronize_session=False)
+
+
+def mark_read(db: Session, username: str, chat_id: str, message_id: int = 0):
+    """Сдвигает курсор прочтения; message_id=0 — прочитано всё."""
+    member_filter = (ChatMember.chat_id == chat_id, ChatMember.username == username)
+    last_read_id = db.query(ChatMember.last_read_id).filter(*member_filter).scalar()
+    if last_read_id is None and not db.query(ChatMember.username).filter(*member_filter).first():
+        return
+    last_read_id = last_read_id or 0
+    latest = db.query(Chat.last_message_id).filter(Chat.id == chat_id).scalar() or 0
+
+    if not message_id or message_id >= latest:
+        values = {"last_read_id": max(last_read_id, latest), "unread_count": 0}
+    elif message_id <= last_read_id:
+        return
+    else:
+        # Считаем только хвост после курсора по индексу (chat_id, id), а не всю историю
+        unread = db.query(func.count(Message.id)).filter(
+            Message.chat_id == chat_id,
+            Message.id > message_id,
+            Message.username != username
+        ).scalar()
+        values = {"last_read_id": message_id, "unread_count": unread}
+    # Прочитанное тем более доставлено
+    values["delivered_id"] = func.max(func.coalesce(ChatMember.delivered_id, 0), values["last_read_id"])
+    db.query(ChatMember).filter(*member_filter).update(values, synchronize_session=False)
+
+
+def mark_delivered(db: Session, username: str, chat_id: str, message_id: int):
+    """Сдвигает курсор доставки; назад не двигается."""
+    db.query(ChatMember).filter(ChatMember.chat_id == chat_id, ChatMember.username == username).update(
+        {"delivered_id": func.max(func.coalesce(ChatMember.delivered_id, 0), message_id)},
+        synchronize_session=False
+    )
+
+
+def load_receipts(db: Session, chat_id: str) -> Dict[str, List[int]]:
+    """username -> [delivered_id, last_read_id] участников чата."""
+    rows = db.query(ChatMember.username, ChatMember.delivered_id, ChatMember.last_read_id).filter(
+        ChatMember.chat_id == chat_id
+    )
+    return {row.username: [max(row.delivered_id or 0, row.last_read_id or 0), row.last_read_id or 0] for row in rows}
@@ -0,0 +1,310 @@
+# connections.py
+import asyncio
+import logging
+import os
+import socket
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Iterable, List, Optional, Set, Tuple, Union
+
+from fastapi import WebSocket
+
+import metrics
+import protocol
+from protocol import Codec, Frame
+from pubsub import PubSub, create_pubsub
+
+logger = logging.getLogger(__name__)
+
+# Сколько ждём отправку одного кадра, прежде чем считать клиента "медленным" и отключить его
+SEND_TIMEOUT = 5.0
+
+# Очередь исходящих кадров на сокет и что делать, когда она полна:
+#   drop_oldest     - выбросить самый старый кадр
+#   coalesce_typing - кадр с ключом (typing, presence) заменяет свой же ещё не отправленный;
+#                     при переполнении сначала выбрасываются такие кадры, иначе клиент отключается
+#   disconnect      - отключить клиента (он переподключится и заново загрузит чат)
+OUTBOX_LIMIT = int(os.getenv("OUTBOX_LIMIT", "256"))
+OUTBOX_POLICY = os.getenv("OUTBOX_POLICY", "coalesce_typing")
+OUTBOX_POLICIES = ("drop_oldest", "coalesce_typing", "disconnect")
+# Код закрытия для вытесненного медленного клиента: "Try Again Later"
+SLOW_CONSUMER_CODE = 1013
+
+# Имя узла в событиях шины (несколько воркеров uvicorn — несколько узлов)
+NODE_NAME = f"{socket.gethostname()}:{os.getpid()}"
+
+EventHandler = Callable[[dict], Awaitable[None]]
+# (chat_id, событие или None, если чат изменён в обход событий)
+ChatObserver = Callable[[str, Optional[dict]], None]
+Event = Union[dict, Frame]
+
+
+def _frame(event: Event) -> Frame:
+    return event if isinstance(event, Frame) else Frame(event)
+
+
+class Outbox:
+    """Исходящие кадры одного сокета и задача, которая их отправляет.
+
+    Рассылка только кладёт кадр в очередь и не ждёт сеть, поэтому зависший
+    клиент задерживает лишь собственную очередь.
+    """
+
+    def __init__(self, manager: "ConnectionManager", websocket: WebSocket, username: str, codec: Codec):
+        self.manager = manager
+        self.websocket = websocket
+        self.username = username
+        self.codec = codec
+        # (ключ для склейки или None, кадр)
+        self.frames: Deque[Tuple[Optional[str], Frame]] = deque()
+        self.ready = asyncio.Event()
+        self.dropped = 0
+        # Когда начата текущая отправка (loop.time()); None — сокет не пишет
+        self.sending_since: Optional[float] = None
+        self.task = asyncio.create_task(self._run())
+
+    def put(self, frame: Frame, key: Optional[str] = None) -> bool:
+        """False — очередь переполнена и по политике клиента надо отключить."""
+        manager = self.manager
+        if key is not None and manager.outbox_policy == "coalesce_typing":
+            for i, (queued_key, _) in enumerate(self.frames):
+                if queued_key == key:
+                    self.frames[i] = (key, frame)
+                    manager.counters["coalesced"] += 1
+                    return True
+        if len(self.frames) >= manager.outbox_limit:
+            if manager.outbox_policy == "drop_oldest":
+                self.frames.popleft()
+            elif manager.outbox_policy == "coalesce_typing":
+                if key is not None:
+                    # Лишний «печатает» при полной очереди просто не ставим
+                    self._count_drop()
+                    return True
+                if not self._drop_ephemeral():
+                    return False
+            else:
+                return False
+            self._count_drop()
+        self.frames.append((key, frame))
+        self.ready.set()
+        return True
+
+    def _drop_ephemeral(self) -> bool:
+        # Место под обычный кадр уступает самый старый кадр с ключом
+        for i, (queued_key, _) in enumerate(self.frames):
+            if queued_key is not None:
+                del self.frames[i]
+                return True
+        return False
+
+    def _count_drop(self):
+        self.dropped += 1
+        self.manager.counters["dropped"] += 1
+
+    async def _run(self):
+        while True:
+            if not self.frames:
+                self.ready.clear()
+                await self.ready.wait()
+                continue
+            _, frame = self.frames.popleft()
+            # Зависшую отправку прерывает ConnectionManager._watch: wait_for на каждый кадр
+            # создавал бы лишнюю задачу
+            self.sending_since = asyncio.get_running_loop().time()
+            try:
+                await protocol.send(self.websocket, self.codec, frame.encode(self.codec))
+            except Exception:
+                # Мёртвый клиент: отключаем, остальных это не касается
+                await self.manager.evict(self.websocket, self.username, SLOW_CONSUMER_CODE)
+                return
+            self.sending_since = None
+
+
+class ConnectionManager:
+    """Маршрутизация событий по чатам: каждое событие уходит только участникам чата.
+
+    Рассылка идёт через шину (pubsub): событие публикуется один раз,
+    а каждый узел доставляет его своим локальным сокетам.
+    """
+
+    def __init__(self, resolve_members: Callable[[str], Awaitable[Iterable[str]]],
+                 pubsub: Optional[PubSub] = None, send_timeout: float = SEND_TIMEOUT,
+                 outbox_limit: int = OUTBOX_LIMIT, outbox_policy: str = OUTBOX_POLICY):
+        if outbox_policy not in OUTBOX_POLICIES:
+            raise ValueError(f"Unknown outbox policy: {outbox_policy}")
+        # username -> открытые сокеты (у пользователя может быть несколько вкладок)
+        self.active_connections: Dict[str, Set[WebSocket]] = {}
+        self.outboxes: Dict[WebSocket, Outbox] = {}
+        self.outbox_limit = outbox_limit
+        self.outbox_policy = outbox_policy
+        self.counters = {"dropped": 0, "coalesced": 0, "evicted": 0}
+        # chat_id -> участники (chat_members), кэш; сбрасывается invalidate_chat
+        self.chat_members: Dict[str, Set[str]] = {}
+        self.resolve_members = resolve_members
+        self.send_timeout = send_timeout
+        self.pubsub = pubsub or create_pubsub()
+        self.node = NODE_NAME
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._watcher: Optional[asyncio.Task] = None
+        self.observers: List[ChatObserver] = []
+        self.handlers: Dict[str, EventHandler] = {
+            "chat": self._on_chat,
+            "users": self._on_users,
+            "invalidate": self._on_invalidate,
+        }
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        self._watcher = asyncio.create_task(self._watch())
+        await self.pubsub.start(self._dispatch)
+
+    async def stop(self):
+        await self.pubsub.stop()
+        if self._watcher is not None:
+            self._watcher.cancel()
+            self._watcher = None
+        for outbox in self.outboxes.values():
+            outbox.task.cancel()
+
+    def on(self, kind: str, handler: EventHandler):
+        """Подписка на собственные события шины (typing, presence, ...)."""
+        self.handlers[kind] = handler
+
+    def observe(self, observer: ChatObserver):
+        """Наблюдатель за событиями чатов на этом узле (вызывается до доставки)."""
+        self.observers.append(observer)
+
+    async def publish(self, kind: str, **data):
+        await self.pubsub.publish({"k": kind, "node": self.node, **data})
+
+    async def connect(self, websocket: WebSocket, username: str,
+                      codec: Codec = protocol.JSON, subprotocol: Optional[str] = None):
+        await websocket.accept(subprotocol=subprotocol)
+        self.active_connections.setdefault(username, set()).add(websocket)
+        self.outboxes[websocket] = Outbox(self, websocket, username, codec)
+
+    def disconnect(self, websocket: WebSocket, username: str):
+        outbox = self.outboxes.pop(websocket, None)
+        if outbox is not None and outbox.task is not asyncio.current_task():
+            outbox.task.cancel()
+        sockets = self.active_connections.get(username)
+        if not sockets:
+            return
+        sockets.discard(websocket)
+        if not sockets:
+            del self.active_connections[username]
+
+    async def evict(self, websocket: WebSocket, username: str, code: int = SLOW_CONSUMER_CODE):
+        """Отключение клиента со стороны сервера; цикл приёма в endpoint завершится сам."""
+        if websocket not in self.outboxes:
+            return
+        self.counters["evicted"] += 1
+        logger.warning("Evicting slow consumer %s", username)
+        self.disconnect(websocket, username)
+        try:
+            await asyncio.wait_for(websocket.close(code=code), self.send_timeout)
+        except Exception:
+            pass
+
+    def send(self, websocket: WebSocket, event: Event, key: Optional[str] = None):
+        """Кадр одному сокету — через его очередь, чтобы не обгонять рассылку."""
+        outbox = self.outboxes.get(websocket)
+        if outbox is not None and not outbox.put(_frame(event), key):
+            asyncio.create_task(self.evict(websocket, outbox.username))
+
+    def outbox_stats(self) -> dict:
+        depths = [len(outbox.frames) for outbox in self.outboxes.values()]
+        return {
+            "connections": len(depths),
+            "queued": sum(depths),
+            "max_depth": max(depths, default=0),
+            **self.counters,
+        }
+
+    async def members(self, chat_id: str) -> Optional[Set[str]]:
+        """Участники чата; None означает «все подключённые» (глобальный чат)."""
+        if not chat_id or chat_id == "global":
+            return None
+        # И для личных чатов: после удаления из друзей имена в chat_id ещё не дают доступа
+        members = self.chat_members.get(chat_id)
+        if members is None:
+            members = set(await self.resolve_members(chat_id))
+            self.chat_members[chat_id] = members
+        return members
+
+    def invalidate_chat(self, chat_id: str):
+        """Сбрасывает кэш участников на всех узлах. Можно звать из потока обработчика HTTP."""
+        self.chat_members.pop(chat_id, None)
+        self.publish_soon("invalidate", chat_id=chat_id)
+
+    def publish_soon(self, kind: str, **data):
+        """publish без ожидания. Можно звать из потока обработчика HTTP."""
+        if self.loop is None:
+            return
+        publish = self.publish(kind, **data)
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            self.loop.create_task(publish)
+        else:
+            asyncio.run_coroutine_threadsafe(publish, self.loop)
+
+    async def broadcast(self, chat_id: str, event: dict, key: Optional[str] = None):
+        kind = event.get("type", "")
+        metrics.events_total.inc(kind)
+        with metrics.broadcast_seconds.time(kind):
+            await self.publish("chat", chat_id=chat_id, event=event, key=key)
+
+    async def send_to_users(self, usernames: Iterable[str], event: dict, key: Optional[str] = None):
+        await self.publish("users", users=list(usernames), event=event, key=key)
+
+    async def deliver(self, chat_id: str, event: Event, key: Optional[str] = None):
+        """Доставка только локальным сокетам этого узла.
+        key — кадры с одинаковым ключом можно склеивать (см. OUTBOX_POLICY)."""
+        members = await self.members(chat_id)
+        if members is None:
+            targets = list(self.active_connections)
+        else:
+            targets = [u for u in members if u in self.active_connections]
+        await self.deliver_to_users(targets, event, key)
+
+    async def deliver_to_users(self, usernames: Iterable[str], event: Event, key: Optional[str] = None):
+        # Один Frame на всех получателей: кодируется по разу на кодек
+        frame = _frame(event)
+        started = time.perf_counter()
+        recipients = 0
+        for username in usernames:
+            for websocket in list(self.active_connections.get(username, ())):
+                self.send(websocket, frame, key)
+                recipients += 1
+        metrics.fanout_seconds.observe(time.perf_counter() - started, frame.event.get("type", ""))
+        metrics.fanout_recipients.observe(recipients)
+
+    async def _dispatch(self, event: dict):
+        handler = self.handlers.get(event.get("k"))
+        if handler is not None:
+            await handler(event)
+
+    async def _on_chat(self, event: dict):
+        for observer in self.observers:
+            observer(event["chat_id"], event["event"])
+        await self.deliver(event["chat_id"], event["event"], event.get("key"))
+
+    async def _on_users(self, event: dict):
+        await self.deliver_to_users(event["users"], event["event"], event.get("key"))
+
+    async def _on_invalidate(self, event: dict):
+        self.chat_members.pop(event["chat_id"], None)
+        for observer in self.observers:
+            observer(event["chat_id"], None)
+
+    async def _watch(self):
+        """Отключает клиентов, у которых один кадр отправляется дольше send_timeout."""
+        while True:
+            await asyncio.sleep(self.send_timeout / 4)
+            deadline = self.loop.time() - self.send_timeout
+            stuck = [o for o in self.outboxes.values() if o.sending_since is not None and o.sending_since < deadline]
+            for outbox in stuck:
+                await self.evict(outbox.websocket, outbox.username)
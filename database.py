@@ -1,9 +1,37 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
 from sqlalchemy.orm import Session
+import metrics
 from models import SessionLocal
 
+# Отдельный пул потоков для работы с БД из async-кода (WebSocket).
+# SQLite всё равно сериализует запись, поэтому по умолчанию один поток.
+DB_WORKERS = int(os.getenv("DB_WORKERS", "1"))
+db_executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix="db")
+
 def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+def _call_with_session(fn, *args, **kwargs):
+    db = SessionLocal()
+    try:
+        return fn(db, *args, **kwargs)
+    finally:
+        db.close()
+
+async def run_db(fn, *args, **kwargs):
+    """Выполняет fn(db, *args, **kwargs) в потоке БД, не блокируя event loop."""
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    try:
+        return await loop.run_in_executor(db_executor, partial(_call_with_session, fn, *args, **kwargs))
+    finally:
+        metrics.db_call_seconds.observe(time.perf_counter() - started, fn.__name__)
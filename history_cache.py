@@ -0,0 +1,205 @@
+# history_cache.py
+"""Последние сообщения горячих чатов в памяти.
+
+Для каждого чата — до HISTORY_CACHE_MESSAGES последних сообщений в том же
+виде, в каком их отдаёт load_chat; чаты вытесняются по LRU, когда общий
+размер (по длине сериализованных сообщений) превышает HISTORY_CACHE_BYTES.
+Буфер заполняется при первой загрузке чата из БД, дальше его правят события
+чата с шины (новое сообщение, правка, удаление) — на каждом узле свои.
+Изменения в обход событий (системные сообщения, удаление чата) приходят
+как invalidate и сбрасывают буфер.
+
+Событие может прийти, пока идёт запрос заполнения, или раньше, чем другой
+узел допишет сообщение в БД. Поэтому события последних
+HISTORY_REPLAY_WINDOW_MS хранятся и накатываются на только что заполненный
+буфер.
+"""
+import os
+import time
+from collections import OrderedDict, deque
+from typing import Deque, List, Optional, Tuple
+
+import protocol
+
+HISTORY_CACHE_MESSAGES = int(os.getenv("HISTORY_CACHE_MESSAGES", "200"))
+HISTORY_CACHE_BYTES = int(os.getenv("HISTORY_CACHE_BYTES", str(64 * 1024 * 1024)))
+HISTORY_REPLAY_WINDOW_MS = int(os.getenv("HISTORY_REPLAY_WINDOW_MS", "2000"))
+
+# Служебные поля словаря, которые не считаем (в сообщении их нет)
+_ENTRY_OVERHEAD = 64
+
+
+def _size(message: dict) -> int:
+    return len(protocol.dumps(message)) + _ENTRY_OVERHEAD
+
+
+def history_row(msg) -> dict:
+    """Строка Message из БД -> сообщение истории (как в load_chat)."""
+    row = {
+        "id": msg.id,
+        "username": msg.username,
+        "text": msg.text,
+        "timestamp": msg.timestamp.isoformat() + "Z",
+        "chat_id": msg.chat_id,
+    }
+    if msg.attachment:
+        row["attachment"] = msg.attachment
+    return row
+
+
+def history_entry(event: dict) -> Optional[dict]:
+    """Событие рассылки -> строка истории в формате load_history_page."""
+    if event.get("type") == "message":
+        return {
+            "id": event["id"],
+            "username": event["username"],
+            "text": event["text"],
+            "timestamp": event["timestamp"],
+            "chat_id": event["chat_id"],
+        }
+    if event.get("type") == "attachment":
+        attachment = {"url": event["url"], "filename": event["filename"], "is_image": event["is_image"]}
+        return {
+            "id": event["id"],
+            "username": event["username"],
+            "text": f"[file] {event['filename']} -> {event['url']}",
+            "timestamp": event["timestamp"],
+            "chat_id": event["chat_id"],
+            "attachment": attachment,
+        }
+    return None
+
+
+class ChatBuffer:
+    __slots__ = ("messages", "complete", "size")
+
+    def __init__(self, messages: List[dict], complete: bool):
+        # По возрастанию id; complete — в чате нет сообщений старше первого
+        self.messages = messages
+        self.complete = complete
+        self.size = sum(_size(m) for m in messages)
+
+    def _index(self, msg_id: int) -> Optional[int]:
+        for i in range(len(self.messages) - 1, -1, -1):
+            if self.messages[i]["id"] == msg_id:
+                return i
+        return None
+
+    def add(self, entry: dict):
+        messages = self.messages
+        if messages and entry["id"] <= messages[-1]["id"]:
+            # Повтор при накате или запоздавшее сообщение другого узла
+            if self._index(entry["id"]) is not None:
+                return
+            if entry["id"] < messages[0]["id"] and not self.complete:
+                return
+            position = next(i for i, m in enumerate(messages) if m["id"] > entry["id"])
+            messages.insert(position, entry)
+        else:
+            messages.append(entry)
+        self.size += _size(entry)
+
+    def edit(self, msg_id: int, text: str):
+        i = self._index(msg_id)
+        if i is not None:
+            old = self.messages[i]
+            self.messages[i] = {**old, "text": text}
+            self.size += _size(self.messages[i]) - _size(old)
+
+    def delete(self, msg_id: int):
+        i = self._index(msg_id)
+        if i is not None:
+            self.size -= _size(self.messages.pop(i))
+
+    def trim(self, limit: int):
+        while len(self.messages) > limit:
+            self.size -= _size(self.messages.pop(0))
+            self.complete = False
+
+
+class HistoryCache:
+    def __init__(self, per_chat: int = HISTORY_CACHE_MESSAGES, max_bytes: int = HISTORY_CACHE_BYTES,
+                 replay_window_ms: int = HISTORY_REPLAY_WINDOW_MS):
+        self.per_chat = per_chat
+        self.max_bytes = max_bytes
+        self.replay_window = replay_window_ms / 1000.0
+        self.chats: "OrderedDict[str, ChatBuffer]" = OrderedDict()
+        self.size = 0
+        # (time.monotonic, chat_id, событие) за последние replay_window секунд
+        self.recent: Deque[Tuple[float, str, dict]] = deque()
+        self.counters = {"hits": 0, "misses": 0, "fills": 0, "evictions": 0}
+
+    def page(self, chat_id: str, before_id: int, limit: int) -> Optional[Tuple[List[dict], bool]]:
+        """(страница, has_more) как у load_history_page или None, если в памяти её нет."""
+        buffer = self.chats.get(chat_id)
+        if buffer is not None:
+            messages = buffer.messages
+            if before_id:
+                older = [m for m in messages if m["id"] < before_id]
+            else:
+                older = messages
+            if len(older) >= limit or buffer.complete:
+                self.chats.move_to_end(chat_id)
+                self.counters["hits"] += 1
+                return older[-limit:], len(older) > limit or not buffer.complete
+        self.counters["misses"] += 1
+        return None
+
+    def fill(self, chat_id: str, messages: List[dict], complete: bool):
+        """Последние сообщения чата из БД (по возрастанию id)."""
+        self.drop(chat_id)
+        buffer = ChatBuffer(list(messages[-self.per_chat:]), complete and len(messages) <= self.per_chat)
+        self.chats[chat_id] = buffer
+        self.size += buffer.size
+        self.counters["fills"] += 1
+        self._prune(time.monotonic())
+        for _, event_chat_id, event in self.recent:
+            if event_chat_id == chat_id:
+                self._patch(chat_id, buffer, event)
+        self._evict()
+
+    def apply(self, chat_id: str, event: Optional[dict]):
+        """Событие чата с шины; None — чат изменён в обход событий."""
+        if event is None:
+            self.drop(chat_id)
+            self.recent = deque(item for item in self.recent if item[1] != chat_id)
+            return
+        if event.get("type") not in ("message", "attachment", "message_edited", "message_deleted"):
+            return
+        now = time.monotonic()
+        self._prune(now)
+        self.recent.append((now, chat_id, event))
+        buffer = self.chats.get(chat_id)
+        if buffer is not None:
+            self._patch(chat_id, buffer, event)
+            self._evict()
+
+    def drop(self, chat_id: str):
+        buffer = self.chats.pop(chat_id, None)
+        if buffer is not None:
+            self.size -= buffer.size
+
+    def stats(self) -> dict:
+        return {"chats": len(self.chats), "bytes": self.size, **self.counters}
+
+    def _prune(self, now: float):
+        while self.recent and self.recent[0][0] < now - self.replay_window:
+            self.recent.popleft()
+
+    def _patch(self, chat_id: str, buffer: ChatBuffer, event: dict):
+        before = buffer.size
+        kind = event["type"]
+        if kind == "message_edited":
+            buffer.edit(event["message_id"], event["text"])
+        elif kind == "message_deleted":
+            buffer.delete(event["message_id"])
+        else:
+            buffer.add(history_entry(event))
+            buffer.trim(self.per_chat)
+        self.size += buffer.size - before
+
+    def _evict(self):
+        while self.size > self.max_bytes and self.chats:
+            _, buffer = self.chats.popitem(last=False)
+            self.size -= buffer.size
+            self.counters["evictions"] += 1
@@ -2,71 +2,189 @@
 from fastapi import FastAPI, Request, Depends, WebSocket, WebSocketDisconnect, HTTPException, Form, UploadFile, File
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from fastapi.responses import RedirectResponse
-from typing import List
-from models import Message, User
-from database import get_db
+from fastapi.responses import PlainTextResponse, RedirectResponse
+from typing import List, Optional
+from models import Chat, ChatMember, Friendship, Message, User, DB_POOL_SIZE, engine, init_db, next_message_id
+from database import get_db, run_db
+from connections import ConnectionManager
+from typing_tracker import TypingTracker
+from presence import Presence, load_friend_names, load_last_seen
+from history_cache import HistoryCache, history_row
+from message_queue import writer, insert_rows
+from migrations import run_migrations
+import uploads
+import page_cache
+import auth
+from auth import current_user, require_self, session_user
+import metrics
+import ratelimit
+from ratelimit import limiter, rate_limit
+import protocol
+import receipts
+import retention
+import sync
+import search
+import thumbnails
+import warmup
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm import Session
-import json
-import bcrypt
+from contextlib import asynccontextmanager
 from datetime import datetime, timezone
 import os
-import shutil
 import hashlib
-from pathlib import Path
+import time
+import anyio
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await start_node()
+    yield
+    await stop_node()
+
+app = FastAPI(lifespan=lifespan)
 app.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="templates")
+templates.env.filters["thumb"] = uploads.thumb_url
+app.include_router(uploads.router)
+app.include_router(search.router)
+app.include_router(page_cache.router)
+
+@app.middleware("http")
+async def time_requests(request: Request, call_next):
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # Шаблон маршрута, а не путь: /profile/{target_username}, а не имя каждого пользователя
+        route = request.scope.get("route")
+        metrics.http_request_seconds.observe(
+            time.perf_counter() - started, request.method,
+            route.path if route is not None else "unmatched", str(status)
+        )
 
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: List[WebSocket] = []
-
-    async def connect(self, websocket: WebSocket):
-        await websocket.accept()
-        self.active_connections.append(websocket)
+async def resolve_chat_members(chat_id: str):
+    """Участники чата для маршрутизации событий и проверки доступа (кэшируется в ConnectionManager)."""
+    info = await run_db(load_group_info, chat_id)
+    return info["participants"]
 
-    def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+manager = ConnectionManager(resolve_chat_members)
+presence = Presence(manager)
+pages = page_cache.Pages(templates, manager)
+history_cache = HistoryCache()
+manager.observe(history_cache.apply)
 
-    async def broadcast(self, message: str):
-        for connection in self.active_connections:
-            await connection.send_text(message)
+async def emit_typing(chat_id: str, users: List[str]):
+    await manager.deliver(chat_id, {
+        "type": "typing",
+        "chat_id": chat_id,
+        "users": users
+    }, key=f"typing:{chat_id}")
+
+typing_state = TypingTracker(emit_typing)
+retention_worker = retention.RetentionWorker(manager)
+receipt_state = receipts.Receipts(manager, writer)
+
+def on_messages_dropped(rows: List[dict]):
+    # Сообщения уже разосланы, но в БД их не будет — убираем их у участников
+    for row in rows:
+        manager.publish_soon("chat", chat_id=row["chat_id"], event={
+            "type": "message_deleted",
+            "chat_id": row["chat_id"],
+            "message_id": row["id"]
+        })
 
-manager = ConnectionManager()
-typing_users = {}
-online_users = set()
+writer.on_dropped(on_messages_dropped)
+
+async def on_typing_event(event: dict):
+    typing_state.apply(event["chat_id"], event["username"], event["is_typing"])
+
+async def on_typing_clear_event(event: dict):
+    typing_state.clear_user(event["username"])
+
+async def publish_typing(chat_id: str, username: str, is_typing: bool):
+    if typing_state.should_publish(chat_id, username, is_typing):
+        await manager.publish("typing", chat_id=chat_id, username=username, is_typing=is_typing)
+
+manager.on("typing", on_typing_event)
+manager.on("typing_clear", on_typing_clear_event)
+
+# Размер страницы истории для load_chat (клиент может запросить меньше/больше, но не выше максимума)
+HISTORY_PAGE_SIZE = 50
+HISTORY_PAGE_MAX = 200
+
+startup = warmup.Startup()
+
+async def start_node():
+    # Соединения принимаются только после прогрева: время до готовности — в /healthz
+    with startup.step("schema"):
+        await anyio.to_thread.run_sync(init_db)
+    with startup.step("pool"):
+        await anyio.to_thread.run_sync(warmup.prewarm_pool, engine, DB_POOL_SIZE)
+    with startup.step("migrations"):
+        await run_db(run_migrations)
+        await run_db(sync.prune_events)
+    with startup.step("indexes"):
+        await run_db(warmup.warm_indexes)
+    with startup.step("templates"):
+        warmup.compile_templates(templates.env)
+    with startup.step("assets"):
+        await anyio.to_thread.run_sync(page_cache.assets.load)
+    await manager.start()
+    await manager.publish("hello")
+    writer.start()
+    typing_state.start()
+    receipt_state.start()
+    presence.start()
+    await retention_worker.start()
+    await uploads.cleanup_stale_uploads()
+    with startup.step("history"):
+        for chat_id in await run_db(warmup.recent_chats):
+            await load_history(chat_id, 0, HISTORY_PAGE_SIZE)
+    startup.ready()
+
+async def stop_node():
+    # Гарантия сохранности: всё, что уже разослано клиентам, дописываем в БД
+    await receipt_state.stop()
+    await writer.stop()
+    await typing_state.stop()
+    await presence.stop()
+    await retention_worker.stop()
+    await manager.stop()
+    thumbnails.shutdown()
+    auth.shutdown()
 
 @app.get("/")
 async def get_login(request: Request):
     return templates.TemplateResponse("login.html", {"request": request})
 
+def login_error(request: Request, error: str, status_code: int = 200):
+    return templates.TemplateResponse("login.html", {
+        "request": request,
+        "error": error
+    }, status_code=status_code)
+
 @app.post("/register")
 async def register(
     request: Request,
     username: str = Form(...),
-    password: str = Form(...),
-    db: Session = Depends(get_db)
+    password: str = Form(...)
 ):
     if not username or not password:
-        return templates.TemplateResponse("login.html", {
-            "request": request,
-            "error": "Логин и пароль обязательны"
-        })
+        return login_error(request, "Логин и пароль обязательны")
 
-    db_user = db.query(User).filter(User.username == username).first()
-    if db_user:
-        return templates.TemplateResponse("login.html", {
-            "request": request,
-            "error": "Пользователь уже существует"
-        })
+    if await run_db(auth.user_exists, username):
+        return login_error(request, "Пользователь уже существует")
 
-    hashed = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
-    new_user = User(username=username, hashed_password=hashed.decode('utf-8'))
-    new_user.generate_friend_code()
-    db.add(new_user)
-    db.commit()
+    # bcrypt — в отдельном пуле, event loop и пул обработчиков не ждут его
+    try:
+        hashed = await auth.hash_password(password)
+    except auth.PasswordBusy:
+        return login_error(request, "Сервер перегружен, попробуйте позже", 503)
+    if not await run_db(auth.create_user, username, hashed):
+        return login_error(request, "Пользователь уже существует")
 
     return templates.TemplateResponse("login.html", {
         "request": request,
@@ -77,96 +195,184 @@ async def register(
 async def login(
     request: Request,
     username: str = Form(...),
-    password: str = Form(...),
-    db: Session = Depends(get_db)
+    password: str = Form(...)
 ):
-    user = db.query(User).filter(User.username == username).first()
-    if not user or not bcrypt.checkpw(password.encode('utf-8'), user.hashed_password.encode('utf-8')):
-        return templates.TemplateResponse("login.html", {
-            "request": request,
-            "error": "Неверный логин или пароль"
-        })
+    hashed = await run_db(auth.load_password_hash, username)
+    try:
+        valid = hashed is not None and await auth.check_password(password, hashed)
+    except auth.PasswordBusy:
+        return login_error(request, "Сервер перегружен, попробуйте позже", 503)
+    if not valid:
+        return login_error(request, "Неверный логин или пароль")
 
+    auth.users.add(username)
     response = RedirectResponse(url=f"/chat?username={username}", status_code=303)
+    auth.set_session(response, username)
     return response
 
+@app.get("/logout")
+async def logout():
+    response = RedirectResponse(url="/", status_code=303)
+    auth.clear_session(response)
+    return response
+
+# ?username= в ссылках страниц остался для совместимости; кто вошёл — решает сессия
 @app.get("/chat")
-async def get_chat(request: Request):
-    username = request.query_params.get("username")
+async def get_chat(request: Request, username: Optional[str] = Depends(session_user)):
     if not username:
         return RedirectResponse(url="/")
-    return templates.TemplateResponse("chat.html", {"request": request, "username": username})
+    return pages.render(request, "chat.html", {"username": username})
 
 @app.get("/friends")
-async def friends_list(request: Request, db: Session = Depends(get_db)):
-    username = request.query_params.get("username")
+def friends_list(request: Request, username: Optional[str] = Depends(session_user), db: Session = Depends(get_db)):
     if not username:
         return RedirectResponse(url="/")
 
-    friend_chats = db.query(Message.chat_id).filter(
-        Message.chat_id.contains(username),
-        Message.chat_id != "global"
-    ).distinct().all()
-
-    friends = set()
-    for chat_id in friend_chats:
-        users = chat_id[0].split(":")
-        for u in users:
-            if u != username:
-                friends.add(u)
-
-    friend_list = []
-    for friend_name in friends:
-        friend = db.query(User).filter(User.username == friend_name).first()
-        if friend:
-            friend_list.append({
-                "username": friend.username,
-                "avatar_url": friend.avatar_url,
-                "bio": friend.bio
-            })
-
-    return templates.TemplateResponse("friends.html", {
-        "request": request,
+    names = pages.cache.get(f"friends:{username}", [f"friends:{username}"],
+                            lambda: sorted(load_friend_names(db, username)))
+    # Статус меняется постоянно — он в ключе карточки, а не в кэше
+    last_seen = load_last_seen(db, names)
+    statuses = {name: presence.status(name, last_seen.get(name)) for name in names if name in last_seen}
+    keys = {friend_card_key(name, status): name for name, status in statuses.items()}
+
+    def render_cards(missing):
+        profiles = {friend["username"]: friend for friend in load_users(db, [keys[key] for key in missing])}
+        return {
+            key: pages.fragment("friend_card.html", friend={**profiles[keys[key]], **statuses[keys[key]]})
+            for key in missing if keys[key] in profiles
+        }
+
+    cards = pages.cache.get_many({key: [f"user:{name}"] for key, name in keys.items()}, render_cards)
+    return pages.render(request, "friends.html", {
         "username": username,
-        "friends": friend_list
+        "cards": [card for card in cards.values() if card is not None]
     })
 
+def friend_card_key(username: str, status: dict) -> str:
+    # last_seen на карточке — с точностью до минуты
+    seen = "online" if status["online"] else (status["last_seen"] or "")[:16]
+    return f"friend_card:{username}:{seen}"
+
 # ✅ НОВЫЙ ЭНДПОИНТ: API для получения списка друзей в JSON
 @app.get("/api/friends_list")
-async def get_friends_list(username: str, db: Session = Depends(get_db)):
+def get_friends_list(username: str, user: str = Depends(current_user), db: Session = Depends(get_db)):
     """Возвращает список друзей в JSON формате для использования в create_chat.html"""
-    friend_chats = db.query(Message.chat_id).filter(
-        Message.chat_id.contains(username),
-        Message.chat_id != "global"
-    ).distinct().all()
-
-    friends = set()
-    for chat_id in friend_chats:
-        users = chat_id[0].split(":")
-        for u in users:
-            if u != username:
-                friends.add(u)
-
-    friend_list = []
-    for friend_name in friends:
-        friend = db.query(User).filter(User.username == friend_name).first()
-        if friend:
-            friend_list.append({
-                "username": friend.username,
-                "avatar_url": friend.avatar_url,
-                "bio": friend.bio
-            })
+    require_self(username, user)
+    friend_list = load_friends(db, username)
 
     return {"friends": friend_list}
 
+@app.get("/api/presence")
+async def get_presence(usernames: str, user: str = Depends(current_user)):
+    """Онлайн-статус и last_seen списка пользователей: ?usernames=a,b,c"""
+    return {"presence": await presence.lookup(u for u in usernames.split(",") if u)}
+
+def collect_node_metrics():
+    outbox = manager.outbox_stats()
+    cache = history_cache.stats()
+    limits = limiter.stats()
+    yield metrics.gauge("ws_connections", "Open WebSocket connections on this node", outbox["connections"])
+    yield metrics.gauge("users_online", "Users online in the cluster", len(presence.online))
+    yield metrics.gauge("outbox_queued_frames", "Frames waiting in socket outboxes", outbox["queued"])
+    yield metrics.gauge("outbox_max_depth", "Deepest socket outbox", outbox["max_depth"])
+    yield "outbox_frames_total", "counter", "Outbox frames not sent as is", [
+        ({"outcome": name}, outbox[name]) for name in ("dropped", "coalesced")
+    ]
+    yield "outbox_evicted_total", "counter", "Slow consumers disconnected", [({}, outbox["evicted"])]
+    yield metrics.gauge("writer_pending_ops", "Writes waiting in the message writer", len(writer.pending))
+    yield metrics.gauge("history_cache_chats", "Chats in the history cache", cache["chats"])
+    yield metrics.gauge("history_cache_bytes", "History cache size", cache["bytes"])
+    yield "history_cache_requests_total", "counter", "History cache lookups", [
+        ({"result": "hit"}, cache["hits"]), ({"result": "miss"}, cache["misses"])
+    ]
+    yield "history_cache_evictions_total", "counter", "Chats evicted from the history cache", [({}, cache["evictions"])]
+    yield "user_cache_requests_total", "counter", "User cache lookups", [
+        ({"result": "hit"}, auth.users.counters["hits"]), ({"result": "miss"}, auth.users.counters["misses"])
+    ]
+    yield "retention_messages_total", "counter", "Messages moved to the archive or purged with their chat", [
+        ({"action": "archived"}, retention_worker.counters["archived_messages"]),
+        ({"action": "purged"}, retention_worker.counters["purged_messages"]),
+    ]
+    yield "retention_vacuumed_pages_total", "counter", "Pages returned by incremental vacuum", [
+        ({}, retention_worker.counters["vacuumed_pages"])
+    ]
+    page_stats = pages.cache.stats()
+    yield metrics.gauge("page_cache_entries", "Rendered fragments in the page cache", page_stats["entries"])
+    yield "page_cache_requests_total", "counter", "Page fragment cache lookups", [
+        ({"result": "hit"}, page_stats["hits"]), ({"result": "miss"}, page_stats["misses"])
+    ]
+    if startup.ready_s is not None:
+        yield metrics.gauge("startup_ready_seconds", "Seconds from process start to ready", startup.ready_s)
+    yield metrics.gauge("rate_limit_buckets", "Active rate limit buckets", limits["buckets"])
+    yield "rate_limited_total", "counter", "Events rejected by rate limits", [
+        ({"event": event}, count) for event, count in sorted(limits["throttled"].items())
+    ]
+
+metrics.registry.collect(collect_node_metrics)
+
+@app.get("/metrics")
+async def get_metrics():
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/debug/profile")
+async def get_profile(seconds: float = 10, hz: int = 100):
+    """Свёрнутые стеки всех потоков за seconds секунд (только с PROFILER_ENABLED=1)."""
+    if not metrics.PROFILER_ENABLED:
+        raise HTTPException(status_code=404)
+    hz = max(1, min(hz, 1000))
+    return PlainTextResponse(await anyio.to_thread.run_sync(metrics.sample_stacks, seconds, hz))
+
+@app.get("/healthz")
+async def get_health():
+    """Готовность узла для балансировщика и выкатки: время до готовности и шаги прогрева."""
+    return startup.status()
+
+@app.get("/api/stats")
+async def get_stats():
+    """Счётчики узла: очереди сокетов, кэш истории, пользователи, лимиты, хранение, страницы, подтверждения."""
+    return {
+        "outbox": manager.outbox_stats(),
+        "history_cache": history_cache.stats(),
+        "users": auth.users.counters,
+        "rate_limit": limiter.stats(),
+        "retention": retention_worker.stats(),
+        "pages": pages.cache.stats(),
+        "receipts": receipt_state.stats()
+    }
+
+def load_friends(db: Session, username: str):
+    # Один запрос: рёбра дружбы по PK + сразу строки User через join
+    friends = (
+        db.query(User)
+        .join(Friendship, Friendship.friend == User.username)
+        .filter(Friendship.username == username)
+        .order_by(User.username)
+        .all()
+    )
+    return [user_card(friend) for friend in friends]
+
+def load_users(db: Session, usernames: List[str]):
+    return [user_card(u) for u in db.query(User).filter(User.username.in_(usernames))]
+
+def user_card(user: User):
+    return {
+        "username": user.username,
+        "avatar_url": user.avatar_url,
+        "bio": user.bio
+    }
+
 @app.get("/profile/{target_username}")
-async def view_profile(request: Request, target_username: str, db: Session = Depends(get_db)):
-    username = request.query_params.get("username")
+def view_profile(request: Request, target_username: str, username: Optional[str] = Depends(session_user),
+                 db: Session = Depends(get_db)):
     if not username:
         return RedirectResponse(url="/")
 
-    target_user = db.query(User).filter(User.username == target_username).first()
-    if not target_user:
+    def render_card():
+        target_user = db.query(User).filter(User.username == target_username).first()
+        return pages.fragment("profile_card.html", profile=target_user) if target_user else None
+
+    card = pages.cache.get(f"profile:{target_username}", [f"user:{target_username}"], render_card)
+    if card is None:
         return templates.TemplateResponse("error.html", {
             "request": request,
             "message": "Пользователь не найден"
@@ -174,16 +380,15 @@ async def view_profile(request: Request, target_username: str, db: Session = Dep
 
     is_self = (username == target_username)
 
-    return templates.TemplateResponse("view_profile.html", {
-        "request": request,
+    return pages.render(request, "view_profile.html", {
         "viewer": username,
-        "profile": target_user,
+        "target_username": target_username,
+        "card": card,
         "is_self": is_self
     })
 
 @app.get("/edit_profile")
-async def edit_profile_page(request: Request, db: Session = Depends(get_db)):
-    username = request.query_params.get("username")
+def edit_profile_page(request: Request, username: Optional[str] = Depends(session_user), db: Session = Depends(get_db)):
     if not username:
         return RedirectResponse(url="/")
 
@@ -191,19 +396,18 @@ async def edit_profile_page(request: Request, db: Session = Depends(get_db)):
     if not user:
         return RedirectResponse(url="/")
 
-    return templates.TemplateResponse("edit_profile.html", {
-        "request": request,
-        "user": user
-    })
+    return pages.render(request, "edit_profile.html", {"user": user})
 
 @app.post("/edit_profile")
-async def edit_profile(
+def edit_profile(
     request: Request,
     bio: str = Form(""),
     avatar: UploadFile = File(None),
     username: str = Form(...),
+    session_username: str = Depends(current_user),
     db: Session = Depends(get_db)
 ):
+    require_self(username, session_username)
     user = db.query(User).filter(User.username == username).first()
     if not user:
         return RedirectResponse(url="/")
@@ -211,26 +415,28 @@ async def edit_profile(
     user.bio = bio[:500]
 
     if avatar and avatar.filename:
-        os.makedirs("static/avatars", exist_ok=True)
-        ext = avatar.filename.split('.')[-1]
-        filename = f"{username}.{ext}"
-        filepath = f"static/avatars/{filename}"
-        with open(filepath, "wb") as f:
-            shutil.copyfileobj(avatar.file, f)
-        user.avatar_url = f"/static/avatars/{filename}"
+        # Аватар — обычный файл в хранилище по хэшу; уменьшенные копии строятся в фоне
+        avatar_url = uploads.store_stream(
+            db, avatar.file, username, os.path.basename(avatar.filename),
+            (avatar.content_type or "application/octet-stream").lower()
+        )
+        if avatar_url:
+            user.avatar_url = avatar_url
 
     db.commit()
+    pages.invalidate(f"user:{username}")
 
     return RedirectResponse(url=f"/profile/{username}?username={username}", status_code=303)
 
-@app.post("/api/add_friend")
-async def add_friend(
+@app.post("/api/add_friend", dependencies=[Depends(rate_limit("add_friend"))])
+def add_friend(
     request: Request,
     friend_code: str = Form(...),
     username: str = Form(...),
+    user: str = Depends(current_user),
     db: Session = Depends(get_db)
 ):
-    user = db.query(User).filter(User.username == username).first()
+    require_self(username, user)
     friend = db.query(User).filter(User.friend_code == friend_code).first()
 
     if not friend:
@@ -239,27 +445,39 @@ async def add_friend(
     if friend.username == username:
         return {"error": "Нельзя добавить себя"}
 
+    is_friend = db.query(Friendship).filter(
+        Friendship.username == username,
+        Friendship.friend == friend.username
+    ).first()
+    if not is_friend:
+        db.add_all([
+            Friendship(username=username, friend=friend.username),
+            Friendship(username=friend.username, friend=username),
+        ])
+
     chat_id = ":".join(sorted([username, friend.username]))
-    exists = db.query(Message).filter(Message.chat_id == chat_id).first()
+    exists = db.query(Chat).filter(Chat.id == chat_id).first()
     if not exists:
-        welcome = Message(
-            username="system",
-            text=f"Вы добавили {friend.username} в друзья!",
-            chat_id=chat_id
-        )
-        db.add(welcome)
-        db.commit()
+        db.add(Chat(id=chat_id, type="private"))
+        db.add_all([ChatMember(chat_id=chat_id, username=u) for u in (username, friend.username)])
+        add_system_message(db, chat_id, f"Вы добавили {friend.username} в друзья!")
+    db.commit()
+    manager.invalidate_chat(chat_id)
+    if not is_friend:
+        pages.invalidate(f"friends:{username}", f"friends:{friend.username}")
 
     return {"success": True, "chat_id": chat_id, "friend": friend.username}
 
 @app.post("/api/create_group")
-async def create_group(
+def create_group(
     request: Request,
     participants: str = Form(...),
     group_name: str = Form(...),
     creator: str = Form(...),
+    user: str = Depends(current_user),
     db: Session = Depends(get_db)
 ):
+    require_self(creator, user)
     user_list = [creator] + [u.strip() for u in participants.split(",") if u.strip()]
     user_list = list(set(user_list))
 
@@ -269,16 +487,14 @@ async def create_group(
     hash_input = ":".join(sorted(user_list))
     chat_id = "group:" + hashlib.md5(hash_input.encode()).hexdigest()[:8]
 
-    exists = db.query(Message).filter(Message.chat_id == chat_id).first()
+    exists = db.query(Chat).filter(Chat.id == chat_id).first()
     if not exists:
+        db.add(Chat(id=chat_id, type="group", name=group_name))
+        db.add_all([ChatMember(chat_id=chat_id, username=u) for u in user_list])
         welcome_text = f"Группа '{group_name}' создана! Участники: {', '.join(user_list)}"
-        welcome = Message(
-            username="system",
-            text=welcome_text,
-            chat_id=chat_id
-        )
-        db.add(welcome)
+        add_system_message(db, chat_id, welcome_text)
         db.commit()
+        manager.invalidate_chat(chat_id)
 
     return {
         "success": True,
@@ -288,83 +504,61 @@ async def create_group(
     }
 
 @app.get("/create_chat")
-async def create_chat_page(request: Request):
-    username = request.query_params.get("username")
+async def create_chat_page(request: Request, username: Optional[str] = Depends(session_user)):
     if not username:
         return RedirectResponse(url="/")
-    return templates.TemplateResponse("create_chat.html", {"request": request, "username": username})
-
-@app.get("/api/user/chats")
-async def get_user_chats(username: str, db: Session = Depends(get_db)):
-    # Чаты, где пользователь явно писал сообщения
-    chat_ids = db.query(Message.chat_id).filter(
-        Message.username == username
-    ).distinct().all()
+    return pages.render(request, "create_chat.html", {"username": username})
 
-    # Личные чаты, где chat_id содержит имя пользователя
-    other_chats = db.query(Message.chat_id).filter(
-        Message.chat_id.contains(username),
-        Message.chat_id != "global"
-    ).distinct().all()
-
-    all_chat_ids = {chat_id[0] for chat_id in chat_ids + other_chats}
-
-    # Также добавим все групповые чаты, в которых пользователь является участником,
-    # определяя участников по приветственному системному сообщению при создании группы
-    group_candidates = db.query(Message.chat_id).filter(
-        Message.chat_id.like("group:%")
-    ).distinct().all()
+def chat_preview(chat: Chat):
+    if not chat.last_message_id:
+        return None
+    return {
+        "id": chat.last_message_id,
+        "username": chat.last_message_username,
+        "text": chat.last_message_text,
+        "timestamp": chat.last_message_at.isoformat() + "Z" if chat.last_message_at else None
+    }
 
-    for gc in group_candidates:
-        all_chat_ids.add(gc[0])
+@app.get("/api/user/chats")
+def get_user_chats(username: str, user: str = Depends(current_user), db: Session = Depends(get_db)):
+    require_self(username, user)
+    # Один запрос по индексу chat_members(username): только чаты самого пользователя
+    # Превью и счётчики уже лежат в chats/chat_members — историю сообщений не трогаем
+    rows = (
+        db.query(Chat, ChatMember.unread_count)
+        .join(ChatMember, ChatMember.chat_id == Chat.id)
+        .filter(ChatMember.username == username)
+        .order_by(Chat.created_at)
+        .all()
+    )
 
     group_chats = []
     private_chats = []
 
-    for cid in all_chat_ids:
-        if cid.startswith("group:"):
-            # Берём последнее СИСТЕМНОЕ сообщение, в котором указан список участников
-            sys_msg = (
-                db.query(Message)
-                .filter(
-                    Message.chat_id == cid,
-                    Message.username == "system",
-                    Message.text.contains("Участники:")
-                )
-                .order_by(Message.id.desc())
-                .first()
-            )
-            if sys_msg:
-                try:
-                    name_part = sys_msg.text.split("'")
-                    name = name_part[1] if len(name_part) >= 2 else "Без названия"
-                except Exception:
-                    name = "Без названия"
-
-                participants = []
-                try:
-                    participants_text = sys_msg.text.split("Участники:", 1)[1]
-                    participants = [u.strip() for u in participants_text.split(',') if u.strip()]
-                except Exception:
-                    participants = []
-
-                if username in participants:
-                    group_chats.append({
-                        "chat_id": cid,
-                        "name": name,
-                        "type": "group",
-                        "display_name": f"👥 {name}"
-                    })
+    for chat, unread_count in rows:
+        summary = {
+            "last_message": chat_preview(chat),
+            "unread_count": unread_count or 0
+        }
+        if chat.type == "group":
+            name = chat.name or "Без названия"
+            group_chats.append({
+                "chat_id": chat.id,
+                "name": name,
+                "type": "group",
+                "display_name": f"👥 {name}",
+                **summary
+            })
         else:
-            users = cid.split(":")
-            if len(users) == 2 and username in users:
-                other_user = users[0] if users[1] == username else users[1]
-                private_chats.append({
-                    "chat_id": cid,
-                    "name": other_user,
-                    "type": "private",
-                    "display_name": f"💬 С {other_user}"
-                })
+            users = chat.id.split(":")
+            other_user = users[0] if users[1] == username else users[1]
+            private_chats.append({
+                "chat_id": chat.id,
+                "name": other_user,
+                "type": "private",
+                "display_name": f"💬 С {other_user}",
+                **summary
+            })
 
     return {
         "group_chats": group_chats,
@@ -372,127 +566,139 @@ async def get_user_chats(username: str, db: Session = Depends(get_db)):
     }
 
 @app.post("/api/delete_chat")
-async def delete_chat(
+def delete_chat(
     chat_id: str = Form(...),
+    user: str = Depends(current_user),
     db: Session = Depends(get_db)
 ):
-    # Удаляем все сообщения данного чата
-    db.query(Message).filter(Message.chat_id == chat_id).delete()
+    require_member(db, chat_id, user)
+    drop_chat(db, chat_id)
     db.commit()
+    manager.invalidate_chat(chat_id)
+    retention_worker.wake()
     return {"success": True}
 
 @app.post("/api/remove_friend")
-async def remove_friend(
+def remove_friend(
     username: str = Form(...),
     friend_username: str = Form(...),
+    user: str = Depends(current_user),
     db: Session = Depends(get_db)
 ):
-    # Дружба у нас имплицитна: личный чат = дружба. Удаляем личный чат.
+    require_self(username, user)
+    # Удаляем обе стороны дружбы и личный чат
+    db.query(Friendship).filter(
+        ((Friendship.username == username) & (Friendship.friend == friend_username)) |
+        ((Friendship.username == friend_username) & (Friendship.friend == username))
+    ).delete(synchronize_session=False)
     chat_id = ":".join(sorted([username, friend_username]))
-    db.query(Message).filter(Message.chat_id == chat_id).delete()
+    drop_chat(db, chat_id)
     db.commit()
+    manager.invalidate_chat(chat_id)
+    pages.invalidate(f"friends:{username}", f"friends:{friend_username}")
+    retention_worker.wake()
     return {"success": True, "chat_id": chat_id}
 
-# ====== Upload attachments ======
-@app.post("/api/upload")
-async def upload_attachment(
-    username: str = Form(...),
+@app.post("/api/chat_retention")
+def set_chat_retention(
     chat_id: str = Form(...),
-    file: UploadFile = File(...)
+    archive_after_days: Optional[int] = Form(None),
+    keep_recent: Optional[int] = Form(None),
+    user: str = Depends(current_user),
+    db: Session = Depends(get_db)
 ):
-    if not chat_id:
-        raise HTTPException(status_code=400, detail="chat_id is required")
-
-    uploads_dir = Path("static") / "uploads" / chat_id
-    uploads_dir.mkdir(parents=True, exist_ok=True)
-
-    # Sanitize filename
-    original_name = os.path.basename(file.filename or "attachment")
-    timestamp = datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S%f")
-    safe_name = f"{timestamp}_{original_name}"
-    file_path = uploads_dir / safe_name
-
-    with open(file_path, "wb") as f:
-        shutil.copyfileobj(file.file, f)
-
-    rel_url = f"/static/uploads/{chat_id}/{safe_name}"
-    content_type = (file.content_type or "application/octet-stream").lower()
-    is_image = content_type.startswith("image/")
-
-    return {
-        "success": True,
-        "url": rel_url,
-        "filename": original_name,
-        "content_type": content_type,
-        "is_image": is_image
-    }
+    """Политика хранения чата; не переданное поле — значение по умолчанию."""
+    require_member(db, chat_id, user)
+    if (archive_after_days or 0) < 0 or (keep_recent or 0) < 0:
+        raise HTTPException(status_code=400, detail="Retention values must be non-negative")
+    return retention.set_policy(db, chat_id, archive_after_days, keep_recent)
 
+# ====== Upload attachments ======
 # ====== Group info and updates ======
 @app.get("/api/group_info")
-async def api_group_info(chat_id: str, db: Session = Depends(get_db)):
+def api_group_info(chat_id: str, user: str = Depends(current_user), db: Session = Depends(get_db)):
     if not chat_id.startswith("group:"):
         raise HTTPException(status_code=400, detail="Not a group chat")
-    # latest SYSTEM message that includes participants
-    last_msg = (
-        db.query(Message)
-        .filter(
-            Message.chat_id == chat_id,
-            Message.username == "system",
-            Message.text.contains("Участники:")
-        )
-        .order_by(Message.id.desc())
-        .first()
-    )
-    if not last_msg:
+    require_member(db, chat_id, user)
+    return load_group_info(db, chat_id)
+
+def require_member(db: Session, chat_id: str, username: str):
+    if not db.query(ChatMember).filter(ChatMember.chat_id == chat_id, ChatMember.username == username).first():
+        raise HTTPException(status_code=403, detail="Not a chat member")
+
+def load_group_info(db: Session, chat_id: str):
+    chat = db.query(Chat).filter(Chat.id == chat_id).first()
+    if not chat:
         return {"chat_id": chat_id, "name": "Без названия", "participants": []}
-    try:
-        name_part = last_msg.text.split("'")
-        name = name_part[1] if len(name_part) >= 2 else "Без названия"
-    except Exception:
-        name = "Без названия"
-    participants = []
-    if "Участники:" in last_msg.text:
-        try:
-            participants_text = last_msg.text.split("Участники:", 1)[1]
-            participants = [u.strip() for u in participants_text.split(',') if u.strip()]
-        except Exception:
-            participants = []
-    return {"chat_id": chat_id, "name": name, "participants": participants}
+    participants = [
+        u for (u,) in db.query(ChatMember.username)
+        .filter(ChatMember.chat_id == chat_id)
+        .order_by(ChatMember.username)
+    ]
+    return {"chat_id": chat_id, "name": chat.name or "Без названия", "participants": participants}
+
+def set_chat_members(db: Session, chat_id: str, members):
+    # Оставшимся участникам сохраняем курсоры прочтения
+    current = {u for (u,) in db.query(ChatMember.username).filter(ChatMember.chat_id == chat_id)}
+    removed = current - set(members)
+    if removed:
+        db.query(ChatMember).filter(
+            ChatMember.chat_id == chat_id,
+            ChatMember.username.in_(removed)
+        ).delete(synchronize_session=False)
+    db.add_all([ChatMember(chat_id=chat_id, username=u) for u in set(members) - current])
+
+def add_system_message(db: Session, chat_id: str, text: str):
+    # Чат и участники могут быть ещё не записаны — превью обновляется UPDATE-ом
+    db.flush()
+    insert_rows(db, [{
+        "id": next_message_id(),
+        "username": "system",
+        "text": text,
+        "timestamp": datetime.now(timezone.utc),
+        "chat_id": chat_id,
+    }])
+
+def drop_chat(db: Session, chat_id: str):
+    # Сообщения, архив и журнал чата retention удаляет порциями в фоне
+    retention.schedule_purge(db, chat_id)
+    db.query(ChatMember).filter(ChatMember.chat_id == chat_id).delete()
+    db.query(Chat).filter(Chat.id == chat_id).delete()
 
 @app.post("/api/group_update_members")
-async def api_group_update_members(
+def api_group_update_members(
     chat_id: str = Form(...),
     members: str = Form(...),
     actor: str = Form(...),
+    user: str = Depends(current_user),
     db: Session = Depends(get_db)
 ):
+    require_self(actor, user)
     if not chat_id.startswith("group:"):
         raise HTTPException(status_code=400, detail="Not a group chat")
+    require_member(db, chat_id, user)
     # Normalize members
     member_list = sorted({u.strip() for u in members.split(',') if u.strip()})
     if len(member_list) < 2:
         return {"error": "В группе должно быть минимум 2 участника"}
 
-    # Get current name from latest message
-    last_msg = db.query(Message).filter(Message.chat_id == chat_id).order_by(Message.id.desc()).first()
-    group_name = "Без названия"
-    if last_msg:
-        try:
-            group_name = last_msg.text.split("'")[1]
-        except Exception:
-            pass
+    chat = db.query(Chat).filter(Chat.id == chat_id).first()
+    if not chat:
+        raise HTTPException(status_code=404, detail="Group not found")
+    group_name = chat.name or "Без названия"
+    set_chat_members(db, chat_id, member_list)
 
     # Add system message reflecting new composition
     text = f"Группа '{group_name}' обновлена! Участники: {', '.join(member_list)}"
-    sys_msg = Message(username="system", text=text, chat_id=chat_id)
-    db.add(sys_msg)
+    add_system_message(db, chat_id, text)
     db.commit()
+    manager.invalidate_chat(chat_id)
 
     return {"success": True, "chat_id": chat_id, "participants": member_list}
 
 # Resolve friend code to username
 @app.get("/api/resolve_friend_code")
-async def resolve_friend_code(code: str, db: Session = Depends(get_db)):
+def resolve_friend_code(code: str, user: str = Depends(current_user), db: Session = Depends(get_db)):
     friend = db.query(User).filter(User.friend_code == code.upper()).first()
     if not friend:
         return {"found": False}
@@ -500,16 +706,18 @@ async def resolve_friend_code(code: str, db: Session = Depends(get_db)):
 
 # Leave group
 @app.post("/api/group_leave")
-async def group_leave(
+def group_leave(
     chat_id: str = Form(...),
     username: str = Form(...),
+    user: str = Depends(current_user),
     db: Session = Depends(get_db)
 ):
+    require_self(username, user)
     if not chat_id.startswith("group:"):
         raise HTTPException(status_code=400, detail="Not a group chat")
 
     # get latest participants
-    info_resp = await api_group_info(chat_id, db)
+    info_resp = load_group_info(db, chat_id)
     participants = [u for u in info_resp.get("participants", []) if u]
     if username not in participants:
         return {"success": True}
@@ -517,180 +725,321 @@ async def group_leave(
     # keep at least 1 member
     if not new_members:
         # if empty, delete chat
-        db.query(Message).filter(Message.chat_id == chat_id).delete()
+        drop_chat(db, chat_id)
         db.commit()
+        manager.invalidate_chat(chat_id)
+        retention_worker.wake()
         return {"success": True, "chat_deleted": True}
 
-    # persist via system message
+    set_chat_members(db, chat_id, new_members)
+    # system message for the chat history
     group_name = info_resp.get("name") or "Без названия"
     text = f"Группа '{group_name}' обновлена! Участники: {', '.join(new_members)}"
-    sys_msg = Message(username="system", text=text, chat_id=chat_id)
-    db.add(sys_msg)
+    add_system_message(db, chat_id, text)
     db.commit()
+    manager.invalidate_chat(chat_id)
     return {"success": True, "participants": new_members}
 
-@app.websocket("/ws/{username}")
-async def websocket_endpoint(websocket: WebSocket, username: str, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.username == username).first()
-    if not user:
-        await websocket.close(code=1008)
+# ====== WebSocket DB helpers (выполняются в потоке БД через run_db) ======
+def load_history_page(db: Session, chat_id: str, before_id: int, limit: int):
+    # Страница от новых к старым: берём на одну запись больше, чтобы узнать has_more
+    query = db.query(Message).filter(Message.chat_id == chat_id)
+    if before_id:
+        query = query.filter(Message.id < before_id)
+    purged_before = retention.purge_watermark(db, chat_id)
+    if purged_before:
+        # Чат удалён и, возможно, создан заново — старые сообщения ещё дочищаются
+        query = query.filter(Message.id >= purged_before)
+    rows = query.order_by(Message.id.desc()).limit(limit + 1).all()
+    has_more = len(rows) > limit
+    # Вложение уже лежит в отдельной колонке — один проход без разбора текста
+    history = [history_row(msg) for msg in reversed(rows[:limit])]
+    segments = []
+    if not has_more and not purged_before:
+        # Живые сообщения кончились — продолжение в архиве
+        boundary = history[0]["id"] if history else before_id
+        segments, has_more = retention.segments_before(db, chat_id, boundary, limit - len(history))
+    return history, has_more, segments
+
+async def read_history(chat_id: str, before_id: int, limit: int):
+    history, has_more, segments = await run_db(load_history_page, chat_id, before_id, limit)
+    if segments:
+        # Архивные сегменты читаем и распаковываем вне потока БД
+        older, has_more = await anyio.to_thread.run_sync(
+            retention.read_archived, segments, history[0]["id"] if history else before_id,
+            limit - len(history), has_more
+        )
+        history = older + history
+    return history, has_more
+
+async def load_history(chat_id: str, before_id: int, limit: int):
+    page = history_cache.page(chat_id, before_id, limit)
+    if page is not None:
+        return page
+    # Сообщения из write-behind очереди должны попасть в историю
+    await writer.flush()
+    if before_id or limit > history_cache.per_chat:
+        return await read_history(chat_id, before_id, limit)
+    # Последние сообщения: берём сразу на весь буфер кэша
+    history, has_more = await read_history(chat_id, 0, history_cache.per_chat)
+    history_cache.fill(chat_id, history, not has_more)
+    return history[-limit:], has_more or len(history) > limit
+
+async def is_member(chat_id: str, username: str) -> bool:
+    members = await manager.members(chat_id)
+    return members is not None and username in members
+
+# Поля кадров, которые попадают в очередь записи: только строки ограниченной длины
+MESSAGE_MAX_LENGTH = int(os.getenv("MESSAGE_MAX_LENGTH", "10000"))
+CHAT_ID_MAX_LENGTH = 128
+FILENAME_MAX_LENGTH = 255
+URL_MAX_LENGTH = 2048
+
+def parse_message_id(value):
+    try:
+        msg_id = int(value)
+    except (TypeError, ValueError):
+        return None
+    # INTEGER в SQLite — 64 бита со знаком, большее число не привязать к запросу
+    return msg_id if 0 <= msg_id < 2 ** 63 else None
+
+def parse_string(value, max_length: int) -> Optional[str]:
+    """Непустая строка не длиннее max_length, иначе None."""
+    if isinstance(value, str) and 0 < len(value) <= max_length:
+        return value
+    return None
+
+# Через сколько клиенту повторить запрос, если база была занята
+DB_RETRY_AFTER_S = 1
+
+def send_db_unavailable(websocket: WebSocket, event: str, chat_id: str):
+    # Соединение не рвём: клиент повторит запрос сам
+    manager.send(websocket, {
+        "type": "error",
+        "event": event,
+        "chat_id": chat_id,
+        "retry_after": DB_RETRY_AFTER_S
+    }, key=f"error:{event}")
+
+async def handle_frame(websocket: WebSocket, username: str, message_data: dict):
+    """Один кадр клиента (лимиты уже проверены)."""
+    if message_data.get("type") == "load_chat":
+        chat_id = parse_string(message_data.get("chat_id"), CHAT_ID_MAX_LENGTH)
+        if not chat_id or not await is_member(chat_id, username):
+            return
+        try:
+            before_id = int(message_data.get("before_id") or 0)
+            limit = int(message_data.get("limit") or HISTORY_PAGE_SIZE)
+        except (TypeError, ValueError):
+            return
+        limit = max(1, min(limit, HISTORY_PAGE_MAX))
+
+        # Позиция журнала — до снимка истории: событие на границе клиент получит ещё раз при sync
+        seq = sync.cursor()
+        try:
+            history, has_more = await load_history(chat_id, before_id, limit)
+            receipts_page = None if before_id else await receipt_state.load(chat_id)
+        except OperationalError:
+            send_db_unavailable(websocket, "load_chat", chat_id)
+            return
+        page = {
+            "type": "history",
+            "chat_id": chat_id,
+            "messages": history,
+            "before_id": before_id or None,
+            "has_more": has_more,
+            "seq": seq
+        }
+        if receipts_page is not None:
+            page["receipts"] = receipts_page
+        manager.send(websocket, page)
         return
 
-    user.last_seen = datetime.now(timezone.utc)
-    db.commit()
+    if message_data.get("type") == "sync":
+        chat_id = parse_string(message_data.get("chat_id"), CHAT_ID_MAX_LENGTH)
+        since_id = parse_message_id(message_data.get("since_id"))
+        since_seq = parse_message_id(message_data.get("since_seq"))
+        if not chat_id or since_id is None or since_seq is None or not await is_member(chat_id, username):
+            return
+        try:
+            # Правки и удаления из write-behind очереди должны попасть в журнал
+            await writer.flush()
+            changes = await run_db(sync.load_changes, chat_id, since_id, since_seq)
+        except OperationalError:
+            send_db_unavailable(websocket, "sync", chat_id)
+            return
+        manager.send(websocket, {"type": "sync", "chat_id": chat_id, **changes})
+        return
 
-    await manager.connect(websocket)
-    online_users.add(username)
+    if message_data.get("type") == "mark_read":
+        chat_id = parse_string(message_data.get("chat_id"), CHAT_ID_MAX_LENGTH)
+        if chat_id and await is_member(chat_id, username):
+            message_id = parse_message_id(message_data.get("message_id")) or 0
+            writer.mark_read(username, chat_id, message_id)
+            if message_id:
+                receipt_state.read(username, chat_id, message_id)
+        return
 
-    try:
-        await websocket.send_text(json.dumps({
-            "type": "history",
-            "chat_id": "",
-            "messages": []
-        }))
+    if message_data.get("type") == "delivered":
+        chat_id = parse_string(message_data.get("chat_id"), CHAT_ID_MAX_LENGTH)
+        message_id = parse_message_id(message_data.get("message_id"))
+        if chat_id and message_id and await is_member(chat_id, username):
+            receipt_state.delivered(username, chat_id, message_id)
+        return
 
-        while True:
-            data = await websocket.receive_text()
-            message_data = json.loads(data)
-
-            if message_data.get("type") == "load_chat":
-                chat_id = message_data.get("chat_id", "")
-                messages = db.query(Message).filter(Message.chat_id == chat_id).order_by(Message.timestamp).all()
-                history = [
-                    {
-                        "id": msg.id,
-                        "username": msg.username,
-                        "text": msg.text,
-                        "timestamp": msg.timestamp.isoformat() + "Z",
-                        "chat_id": msg.chat_id
-                    }
-                    for msg in messages
-                ]
-                # augment messages with attachment info if detected in placeholder
-                for h in history:
-                    t = h.get("text") or ""
-                    if t.startswith("[file] ") and "->" in t:
-                        try:
-                            rest = t[len("[file] "):]
-                            fname, url = [p.strip() for p in rest.split("->", 1)]
-                            is_image = url.lower().endswith((".png", ".jpg", ".jpeg", ".gif", ".webp"))
-                            h["attachment"] = {"url": url, "filename": fname, "is_image": is_image}
-                        except Exception:
-                            pass
-                await websocket.send_text(json.dumps({
-                    "type": "history",
-                    "chat_id": chat_id,
-                    "messages": history
-                }))
-                continue
+    if message_data.get("type") == "typing":
+        chat_id = parse_string(message_data.get("chat_id"), CHAT_ID_MAX_LENGTH)
+        if chat_id and await is_member(chat_id, username):
+            # Список печатающих собирает каждый узел из событий шины; рассылка — пачками в TypingTracker
+            await publish_typing(chat_id, username, bool(message_data.get("is_typing", False)))
+        return
 
-            if message_data.get("type") == "typing":
-                chat_id = message_data.get("chat_id")
-                is_typing = message_data.get("is_typing", False)
+    if message_data.get("type") == "attachment":
+        chat_id = parse_string(message_data.get("chat_id"), CHAT_ID_MAX_LENGTH)
+        url = parse_string(message_data.get("url"), URL_MAX_LENGTH)
+        filename = parse_string(message_data.get("filename"), FILENAME_MAX_LENGTH)
+        is_image = bool(message_data.get("is_image", False))
+        if not chat_id or not url or not filename or not await is_member(chat_id, username):
+            return
+
+        client_id = receipts.parse_client_id(message_data.get("client_id"))
+        if client_id and await receipt_state.recall(websocket, username, client_id, bool(message_data.get("retry"))):
+            return
+
+        placeholder_text = f"[file] {filename} -> {url}"
+        attachment = {"url": url, "filename": filename, "is_image": is_image}
+        msg_id, timestamp = writer.insert(username, placeholder_text, chat_id, attachment, client_id)
+        if client_id:
+            receipt_state.remember(websocket, username, client_id, msg_id, chat_id)
+        await publish_typing(chat_id, username, False)
+
+        await manager.broadcast(chat_id, {
+            "type": "attachment",
+            "id": msg_id,
+            "client_id": client_id,
+            "username": username,
+            "chat_id": chat_id,
+            **attachment,
+            "timestamp": timestamp
+        })
+        return
 
-                if chat_id not in typing_users:
-                    typing_users[chat_id] = set()
+    # Edit message
+    if message_data.get("type") == "edit_message":
+        msg_id = parse_message_id(message_data.get("message_id"))
+        new_text = (parse_string(message_data.get("text"), MESSAGE_MAX_LENGTH) or "").strip()
+        if not msg_id or not new_text:
+            return
+        owner = await writer.lookup(msg_id)
+        if not owner or owner[0] != username:
+            return
+        chat_id = owner[1]
+        seq = writer.edit(msg_id, new_text, chat_id)
+        await manager.broadcast(chat_id, {
+            "type": "message_edited",
+            "chat_id": chat_id,
+            "seq": seq,
+            "message_id": msg_id,
+            "text": new_text,
+            "edited": True
+        })
+        return
 
-                if is_typing:
-                    typing_users[chat_id].add(username)
-                else:
-                    typing_users[chat_id].discard(username)
+    # Delete message
+    if message_data.get("type") == "delete_message":
+        msg_id = parse_message_id(message_data.get("message_id"))
+        if not msg_id:
+            return
+        owner = await writer.lookup(msg_id)
+        if not owner or owner[0] != username:
+            return
+        chat_id = owner[1]
+        seq = writer.delete(msg_id, chat_id, username)
+        await manager.broadcast(chat_id, {
+            "type": "message_deleted",
+            "chat_id": chat_id,
+            "seq": seq,
+            "message_id": msg_id
+        })
+        return
 
-                typing_list = list(typing_users[chat_id])
-                await manager.broadcast(json.dumps({
-                    "type": "typing",
-                    "chat_id": chat_id,
-                    "users": typing_list
-                }))
-                continue
+    text = parse_string(message_data.get("text"), MESSAGE_MAX_LENGTH)
+    if not text:
+        return
 
-            if message_data.get("type") == "attachment":
-                chat_id = message_data.get("chat_id", "")
-                url = message_data.get("url")
-                filename = message_data.get("filename")
-                is_image = message_data.get("is_image", False)
-                if not chat_id or not url:
-                    continue
-
-                placeholder_text = f"[file] {filename} -> {url}"
-                db_message = Message(username=username, text=placeholder_text, chat_id=chat_id)
-                db.add(db_message)
-                db.commit()
-                db.refresh(db_message)
-
-                await manager.broadcast(json.dumps({
-                    "type": "attachment",
-                    "username": username,
-                    "chat_id": chat_id,
-                    "url": url,
-                    "filename": filename,
-                    "is_image": is_image,
-                    "timestamp": db_message.timestamp.isoformat() + "Z"
-                }))
-                continue
+    chat_id = parse_string(message_data.get("chat_id"), CHAT_ID_MAX_LENGTH)
+    if not chat_id or not await is_member(chat_id, username):
+        return
 
-            # Edit message
-            if message_data.get("type") == "edit_message":
-                msg_id = message_data.get("message_id")
-                new_text = (message_data.get("text") or "").strip()
-                if not msg_id or not new_text:
-                    continue
-                db_msg = db.query(Message).filter(Message.id == msg_id).first()
-                if not db_msg or db_msg.username != username:
-                    continue
-                db_msg.text = new_text
-                db.commit()
-                await manager.broadcast(json.dumps({
-                    "type": "message_edited",
-                    "message_id": msg_id,
-                    "text": new_text,
-                    "edited": True
-                }))
-                continue
+    # Повтор после обрыва: сообщение уже принято — только подтверждение
+    client_id = receipts.parse_client_id(message_data.get("client_id"))
+    if client_id and await receipt_state.recall(websocket, username, client_id, bool(message_data.get("retry"))):
+        return
 
-            # Delete message
-            if message_data.get("type") == "delete_message":
-                msg_id = message_data.get("message_id")
-                if not msg_id:
-                    continue
-                db_msg = db.query(Message).filter(Message.id == msg_id).first()
-                if not db_msg or db_msg.username != username:
-                    continue
-                db.delete(db_msg)
-                db.commit()
-                await manager.broadcast(json.dumps({
-                    "type": "message_deleted",
-                    "message_id": msg_id
-                }))
-                continue
+    msg_id, timestamp = writer.insert(username, text, chat_id, client_id=client_id)
+    if client_id:
+        receipt_state.remember(websocket, username, client_id, msg_id, chat_id)
+    await publish_typing(chat_id, username, False)
 
-            text = message_data.get("text", "")
-            if not text:
-                continue
+    response = {
+        "type": "message",
+        "id": msg_id,
+        "client_id": client_id,
+        "username": username,
+        "text": text,
+        "timestamp": timestamp,
+        "chat_id": chat_id,
+        "edited": False
+    }
+    await manager.broadcast(chat_id, response)
 
-            chat_id = message_data.get("chat_id", "")
-            if not chat_id:
-                continue
+@app.websocket("/ws/{username}")
+async def websocket_endpoint(websocket: WebSocket, username: str):
+    # Сессия проверяется по подписи; существование пользователя — из кэша
+    if await session_user(websocket) != username:
+        await websocket.close(code=1008)
+        return
+
+    # Кодек кадров: json по умолчанию или msgpack, если клиент предложил его в подпротоколе
+    codec, subprotocol = protocol.negotiate(websocket.scope.get("subprotocols") or [])
+    await manager.connect(websocket, username, codec, subprotocol)
+    await presence.connect(username)
+
+    try:
+        manager.send(websocket, {
+            "type": "history",
+            "chat_id": "",
+            "messages": []
+        })
 
-            db_message = Message(username=username, text=text, chat_id=chat_id)
-            db.add(db_message)
-            db.commit()
-            db.refresh(db_message)
-
-            response = {
-                "type": "message",
-                "id": db_message.id,
-                "username": username,
-                "text": text,
-                "timestamp": db_message.timestamp.isoformat() + "Z",
-                "chat_id": chat_id,
-                "edited": False
-            }
-            await manager.broadcast(json.dumps(response))
+        while True:
+            message_data = await protocol.receive(websocket, codec)
+            # Лимиты — до любой работы с БД и шиной
+            if not limiter.allow(websocket, "frame") or not isinstance(message_data, dict):
+                continue
+            event = message_data.get("type")
+            if event not in ratelimit.FRAME_EVENTS:
+                event = "message"
+            metrics.ws_frames_total.inc(event)
+            retry_after = limiter.check(username, event)
+            if retry_after:
+                if event not in ratelimit.QUIET_EVENTS:
+                    manager.send(websocket, {
+                        "type": "rate_limited",
+                        "event": event,
+                        "retry_after": round(retry_after, 2)
+                    }, key=f"rate_limited:{event}")
+                continue
 
+            with metrics.ws_command_seconds.time(event):
+                await handle_frame(websocket, username, message_data)
     except WebSocketDisconnect:
-        manager.disconnect(websocket)
-        online_users.discard(username)
+        pass
     finally:
-        user.last_seen = datetime.now(timezone.utc)
-        db.commit()
\ No newline at end of file
+        manager.disconnect(websocket, username)
+        limiter.forget(websocket, "frame")
+        receipt_state.forget_socket(websocket)
+        # Закрылась одна из вкладок — набор в остальных не сбрасываем
+        if presence.connections.get(username, 0) <= 1 and typing_state.is_typing(username):
+            await manager.publish("typing_clear", username=username)
+        await presence.disconnect(username)
\ No newline at end of file
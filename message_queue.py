@@ -0,0 +1,228 @@
+# message_queue.py
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import insert
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+
+import chat_summary
+import metrics
+from database import run_db
+from models import ChatEvent, Message, next_message_id
+
+logger = logging.getLogger(__name__)
+
+# Как часто и какими пачками сбрасываем накопленные изменения в БД
+FLUSH_INTERVAL_MS = int(os.getenv("MESSAGE_FLUSH_INTERVAL_MS", "50"))
+FLUSH_BATCH_SIZE = int(os.getenv("MESSAGE_FLUSH_BATCH_SIZE", "500"))
+
+
+def format_timestamp(ts: datetime) -> str:
+    return ts.replace(tzinfo=None).isoformat() + "Z"
+
+
+def insert_rows(db: Session, rows: List[dict]):
+    db.execute(insert(Message), rows)
+    chat_summary.record_inserts(db, rows)
+
+
+def apply_ops(db: Session, ops: List[tuple]):
+    """Применяет пачку операций одной транзакцией (один fsync на пачку)."""
+    inserts = []
+    # Журнал для синхронизации (sync.py) пишется той же транзакцией
+    events = []
+    for op in ops:
+        kind = op[0]
+        if kind == "insert":
+            inserts.append(op[1])
+            continue
+        # Порядок важен: правка/удаление могут относиться к сообщению из этой же пачки
+        if inserts:
+            insert_rows(db, inserts)
+            inserts = []
+        if kind == "edit":
+            _, msg_id, new_text, chat_id, seq = op
+            db.query(Message).filter(Message.id == msg_id).update({"text": new_text}, synchronize_session=False)
+            chat_summary.record_edit(db, chat_id, msg_id, new_text)
+            events.append({"seq": seq, "chat_id": chat_id, "kind": "edit", "message_id": msg_id, "text": new_text})
+        elif kind == "delete":
+            _, msg_id, chat_id, author, seq = op
+            db.query(Message).filter(Message.id == msg_id).delete(synchronize_session=False)
+            chat_summary.record_delete(db, chat_id, msg_id, author)
+            events.append({"seq": seq, "chat_id": chat_id, "kind": "delete", "message_id": msg_id, "text": None})
+        elif kind == "mark_read":
+            _, username, chat_id, message_id = op
+            chat_summary.mark_read(db, username, chat_id, message_id)
+        elif kind == "mark_delivered":
+            _, username, chat_id, message_id = op
+            chat_summary.mark_delivered(db, username, chat_id, message_id)
+    if inserts:
+        insert_rows(db, inserts)
+    if events:
+        db.execute(insert(ChatEvent), events)
+    started = time.perf_counter()
+    db.commit()
+    metrics.db_commit_seconds.observe(time.perf_counter() - started)
+    metrics.db_batch_ops.observe(len(ops))
+
+
+class MessageWriter:
+    """Write-behind очередь: id и время выдаются сразу, запись в БД — пачками в фоне."""
+
+    def __init__(self, flush_interval_ms: int = FLUSH_INTERVAL_MS, batch_size: int = FLUSH_BATCH_SIZE):
+        self.flush_interval = flush_interval_ms / 1000.0
+        self.batch_size = batch_size
+        self.pending: List[tuple] = []
+        # id -> (username, chat_id) для ещё не записанных сообщений (проверка автора при правке)
+        self.unflushed: Dict[int, Tuple[str, str]] = {}
+        self._wake = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._flushing: Optional[asyncio.Task] = None
+        self._task: Optional[asyncio.Task] = None
+        # Вызываются после коммита пачки со списком записанных сообщений
+        self.persisted_handlers: List[Callable[[List[dict]], None]] = []
+        # Вызываются со списком сообщений, которые БД отвергла и которые уже не будут записаны
+        self.dropped_handlers: List[Callable[[List[dict]], None]] = []
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Останавливает фоновый цикл и дописывает всё, что осталось в очереди."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def on_persisted(self, handler: Callable[[List[dict]], None]):
+        self.persisted_handlers.append(handler)
+
+    def on_dropped(self, handler: Callable[[List[dict]], None]):
+        self.dropped_handlers.append(handler)
+
+    def insert(self, username: str, text: str, chat_id: str, attachment: Optional[dict] = None,
+               client_id: Optional[str] = None) -> Tuple[int, str]:
+        msg_id = next_message_id()
+        timestamp = datetime.now(timezone.utc)
+        self._enqueue(("insert", {
+            "id": msg_id,
+            "username": username,
+            "text": text,
+            "timestamp": timestamp,
+            "chat_id": chat_id,
+            "attachment": attachment,
+            "client_id": client_id,
+        }))
+        self.unflushed[msg_id] = (username, chat_id)
+        return msg_id, format_timestamp(timestamp)
+
+    def edit(self, msg_id: int, new_text: str, chat_id: str) -> int:
+        """Возвращает seq записи в журнале chat_events."""
+        seq = next_message_id()
+        self._enqueue(("edit", msg_id, new_text, chat_id, seq))
+        return seq
+
+    def delete(self, msg_id: int, chat_id: str, author: str) -> int:
+        seq = next_message_id()
+        self._enqueue(("delete", msg_id, chat_id, author, seq))
+        return seq
+
+    def mark_read(self, username: str, chat_id: str, message_id: int = 0):
+        # Через очередь, чтобы курсор не обогнал ещё не записанные сообщения
+        self._enqueue(("mark_read", username, chat_id, message_id))
+
+    def mark_delivered(self, username: str, chat_id: str, message_id: int):
+        self._enqueue(("mark_delivered", username, chat_id, message_id))
+
+    async def lookup(self, msg_id: int) -> Optional[Tuple[str, str]]:
+        """(username, chat_id) сообщения — из очереди или из БД."""
+        if msg_id in self.unflushed:
+            return self.unflushed[msg_id]
+        return await run_db(_lookup_message, msg_id)
+
+    async def flush(self):
+        """Дописывает очередь в БД. Пишет отдельная задача: отмена ожидающего
+        (stop, обработчик сокета) не прерывает пачку на полпути, а с очереди её
+        снимает только сама запись после коммита — дважды в БД она не попадёт."""
+        if self._flushing is None or self._flushing.done():
+            self._flushing = asyncio.ensure_future(self._flush())
+        await asyncio.shield(self._flushing)
+
+    async def _flush(self):
+        async with self._flush_lock:
+            while self.pending:
+                ops = self.pending[:self.batch_size]
+                try:
+                    await run_db(apply_ops, ops)
+                except OperationalError:
+                    # База занята или недоступна — пачка остаётся в очереди до следующей попытки
+                    logger.exception("Message batch flush failed, will retry")
+                    raise
+                except Exception:
+                    # Ошибка в данных одной операции не должна останавливать запись всех остальных
+                    logger.exception("Message batch rejected, applying its ops one by one")
+                    await self._apply_separately(ops)
+                    continue
+                self._done(ops)
+
+    async def _apply_separately(self, ops: List[tuple]):
+        for op in ops:
+            try:
+                await run_db(apply_ops, [op])
+            except OperationalError:
+                logger.exception("Message batch flush failed, will retry")
+                raise
+            except Exception:
+                logger.exception("Dropping message op %r that the database rejects", op[0])
+                self._done([op], persisted=False)
+                continue
+            self._done([op])
+
+    def _done(self, ops: List[tuple], persisted: bool = True):
+        """Снимает с очереди записанные (или отброшенные) операции — они всегда в её начале."""
+        del self.pending[:len(ops)]
+        rows = [op[1] for op in ops if op[0] == "insert"]
+        for row in rows:
+            self.unflushed.pop(row["id"], None)
+        if persisted:
+            for handler in self.persisted_handlers:
+                handler(rows)
+        elif rows:
+            for handler in self.dropped_handlers:
+                handler(rows)
+
+    def _enqueue(self, op: tuple):
+        self.pending.append(op)
+        if len(self.pending) >= self.batch_size:
+            self._wake.set()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception:
+                # Операции остались в очереди — повторим на следующем тике
+                await asyncio.sleep(self.flush_interval)
+
+
+def _lookup_message(db: Session, msg_id: int):
+    row = db.query(Message.username, Message.chat_id).filter(Message.id == msg_id).first()
+    return (row.username, row.chat_id) if row else None
+
+
+writer = MessageWriter()
@@ -0,0 +1,201 @@
+# metrics.py
+"""Метрики узла в формате Prometheus (GET /metrics) и сэмплирующий профайлер.
+
+Счётчики и гистограммы обновляются прямо в горячем пути: observe — это
+bisect по границам корзин и пара сложений под локом (пишут и event loop,
+и поток БД). Всё, что уже считается в модулях (очереди сокетов, кэш
+истории, лимиты), снимается функциями-сборщиками в момент запроса.
+
+Профайлер включается PROFILER_ENABLED=1: GET /debug/profile?seconds=10
+раз в 1/hz секунды снимает стеки всех потоков и отдаёт их в свёрнутом
+виде (строка «поток;кадр;кадр N» — вход для flamegraph.pl/speedscope).
+"""
+import bisect
+import os
+import sys
+import threading
+import time
+from collections import Counter as StackCounter
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+
+PROFILER_ENABLED = os.getenv("PROFILER_ENABLED", "") == "1"
+PROFILE_MAX_SECONDS = 60
+
+# Границы корзин в секундах: от 0.1 мс до 10 с
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 10.0)
+
+Labels = Tuple[str, ...]
+# Сборщик отдаёт [(имя, тип, help, [(метки, значение)])]
+Collector = Callable[[], Iterable[Tuple[str, str, str, List[Tuple[Dict[str, str], float]]]]]
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values: Dict[Labels, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels: str, amount: float = 1):
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # метки -> [счётчики по корзинам (последняя — +Inf), сумма]
+        self.values: Dict[Labels, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels: str):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self.values.get(labels)
+            if series is None:
+                series = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def time(self, *labels: str) -> "_Timer":
+        return _Timer(self, labels)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound!r}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+            suffix = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{suffix} {total}")
+            lines.append(f"{self.name}_count{suffix} {cumulative}")
+        return lines
+
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "started")
+
+    def __init__(self, histogram: Histogram, labels: Labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: List = []
+        self.collectors: List[Collector] = []
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        metric = Counter(name, help, labelnames)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        metric = Histogram(name, help, labelnames, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def collect(self, collector: Collector):
+        self.collectors.append(collector)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        for collector in self.collectors:
+            for name, kind, help, samples in collector():
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    lines.append(f"{name}{_format_labels(list(labels), list(labels.values()))} {value}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+# ====== Метрики горячего пути ======
+http_request_seconds = registry.histogram(
+    "http_request_seconds", "HTTP request handling time", ("method", "route", "status"))
+ws_frames_total = registry.counter(
+    "ws_frames_total", "WebSocket frames received, by type", ("type",))
+ws_command_seconds = registry.histogram(
+    "ws_command_seconds", "WebSocket command handling time", ("type",))
+broadcast_seconds = registry.histogram(
+    "broadcast_seconds", "Publishing a chat event to the bus", ("type",))
+fanout_seconds = registry.histogram(
+    "fanout_seconds", "Queueing an event to local sockets", ("type",))
+fanout_recipients = registry.histogram(
+    "fanout_recipients", "Local sockets per delivered event", (),
+    (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 5000))
+events_total = registry.counter(
+    "chat_events_total", "Chat events broadcast, by type", ("type",))
+db_call_seconds = registry.histogram(
+    "db_call_seconds", "run_db call time including the wait for the DB thread", ("fn",))
+db_commit_seconds = registry.histogram(
+    "db_commit_seconds", "Message writer batch commit time")
+db_batch_ops = registry.histogram(
+    "db_batch_ops", "Operations per message writer batch", (),
+    (1, 5, 10, 25, 50, 100, 250, 500, 1000))
+
+
+def gauge(name: str, help: str, value: float, **labels) -> tuple:
+    return name, "gauge", help, [(labels, value)]
+
+
+# ====== Профайлер ======
+def _stack(frame) -> List[str]:
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+
+def sample_stacks(seconds: float, hz: int) -> str:
+    """Блокирующий вызов: запускать в отдельном потоке."""
+    samples: StackCounter = StackCounter()
+    own = threading.get_ident()
+    deadline = time.monotonic() + min(seconds, PROFILE_MAX_SECONDS)
+    interval = 1.0 / hz
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            samples[";".join([names.get(ident, str(ident))] + _stack(frame))] += 1
+        time.sleep(interval)
+    return "".join(f"{stack} {count}\n" for stack, count in samples.most_common())
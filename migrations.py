@@ -0,0 +1,141 @@
+# migrations.py
+"""Одноразовые миграции данных. Запускаются при старте приложения или вручную: python migrations.py"""
+from sqlalchemy import func, text, update
+from sqlalchemy.orm import Session
+
+import chat_summary
+import search
+
+from models import Chat, ChatMember, Friendship, Message, SchemaMigration, SessionLocal, init_db
+
+
+def parse_group_system_text(text: str):
+    """Имя группы и участники из системного сообщения вида
+    "Группа 'Имя' создана! Участники: a, b"."""
+    name_part = text.split("'")
+    name = name_part[1] if len(name_part) >= 2 else "Без названия"
+    participants = []
+    if "Участники:" in text:
+        participants_text = text.split("Участники:", 1)[1]
+        participants = [u.strip() for u in participants_text.split(',') if u.strip()]
+    return name, participants
+
+
+def backfill_chats(db: Session):
+    """Заполняет chats/chat_members по существующим сообщениям."""
+    existing = {cid for (cid,) in db.query(Chat.id).all()}
+    chat_ids = [cid for (cid,) in db.query(Message.chat_id).distinct().all()]
+
+    for cid in chat_ids:
+        if not cid or cid in existing or cid == "global":
+            continue
+        if cid.startswith("group:"):
+            # Актуальный состав — в последнем системном сообщении со списком участников
+            sys_msg = (
+                db.query(Message)
+                .filter(
+                    Message.chat_id == cid,
+                    Message.username == "system",
+                    Message.text.contains("Участники:")
+                )
+                .order_by(Message.id.desc())
+                .first()
+            )
+            if not sys_msg:
+                continue
+            name, participants = parse_group_system_text(sys_msg.text)
+            created_at = db.query(func.min(Message.timestamp)).filter(Message.chat_id == cid).scalar()
+            db.add(Chat(id=cid, type="group", name=name, created_at=created_at))
+            db.add_all([ChatMember(chat_id=cid, username=u) for u in set(participants)])
+        else:
+            users = cid.split(":")
+            if len(users) != 2:
+                continue
+            created_at = db.query(func.min(Message.timestamp)).filter(Message.chat_id == cid).scalar()
+            db.add(Chat(id=cid, type="private", name="", created_at=created_at))
+            db.add_all([ChatMember(chat_id=cid, username=u) for u in set(users)])
+    db.flush()
+
+
+def backfill_friendships(db: Session):
+    """Дружба раньше была имплицитной: личный чат = дружба."""
+    existing = set(db.query(Friendship.username, Friendship.friend).all())
+    for (cid,) in db.query(Chat.id).filter(Chat.type == "private"):
+        a, b = cid.split(":")
+        for pair in ((a, b), (b, a)):
+            if pair not in existing:
+                db.add(Friendship(username=pair[0], friend=pair[1]))
+                existing.add(pair)
+    db.flush()
+
+
+def backfill_chat_summaries(db: Session):
+    """Превью последнего сообщения; существующую историю считаем прочитанной."""
+    for (cid,) in db.query(Chat.id).all():
+        chat_summary.refresh_last_message(db, cid)
+        last_id = db.query(Chat.last_message_id).filter(Chat.id == cid).scalar() or 0
+        db.query(ChatMember).filter(ChatMember.chat_id == cid).update(
+            {"last_read_id": last_id, "unread_count": 0}, synchronize_session=False)
+    db.flush()
+
+
+def parse_attachment_text(text: str):
+    """Вложение из старого текста-заглушки "[file] имя -> url"."""
+    if not text.startswith("[file] ") or "->" not in text:
+        return None
+    filename, url = [p.strip() for p in text[len("[file] "):].split("->", 1)]
+    is_image = url.lower().endswith((".png", ".jpg", ".jpeg", ".gif", ".webp"))
+    return {"url": url, "filename": filename, "is_image": is_image}
+
+
+def backfill_message_attachments(db: Session, batch_size: int = 1000):
+    """Вложения раньше хранились только в тексте и разбирались при каждой загрузке истории."""
+    rows = (
+        db.query(Message.id, Message.text)
+        .filter(Message.text.like("[file] %"), Message.attachment.is_(None))
+        .yield_per(batch_size)
+    )
+    batch = []
+    for row in rows:
+        attachment = parse_attachment_text(row.text)
+        if attachment:
+            batch.append({"id": row.id, "attachment": attachment})
+    for start in range(0, len(batch), batch_size):
+        db.execute(update(Message), batch[start:start + batch_size])
+    db.flush()
+
+
+def null_empty_attachments(db: Session):
+    """Сообщения без вложения записывались со строкой JSON 'null' вместо SQL NULL."""
+    db.execute(text("UPDATE messages SET attachment = NULL WHERE attachment = 'null'"))
+    db.flush()
+
+
+# Порядок важен: новые миграции добавляются в конец
+MIGRATIONS = [
+    ("0001_backfill_chats", backfill_chats),
+    ("0002_backfill_friendships", backfill_friendships),
+    ("0003_backfill_chat_summaries", backfill_chat_summaries),
+    ("0004_message_search", search.install),
+    ("0005_message_attachments", backfill_message_attachments),
+    ("0006_null_attachments", null_empty_attachments),
+]
+
+
+def run_migrations(db: Session):
+    applied = {name for (name,) in db.query(SchemaMigration.name).all()}
+    for name, migrate in MIGRATIONS:
+        if name in applied:
+            continue
+        migrate(db)
+        db.add(SchemaMigration(name=name))
+        db.commit()
+
+
+if __name__ == "__main__":
+    init_db()
+    session = SessionLocal()
+    try:
+        run_migrations(session)
+    finally:
+        session.close()
@@ -1,12 +1,55 @@
 # models.py
-from sqlalchemy import Column, Integer, String, DateTime, create_engine
+from sqlalchemy import JSON, Column, Float, Integer, String, DateTime, ForeignKey, Index, create_engine, event, inspect, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from datetime import datetime, timezone
+import atexit
+import logging
+import os
 import secrets
+import socket
+import threading
+import time
+
+logger = logging.getLogger(__name__)
 
 Base = declarative_base()
 
+# id сообщений выдаём сами, а не через AUTOINCREMENT: так write-behind очередь может
+# сразу отдать id клиенту, а запись в БД произойдёт позже пачкой.
+# Формат: миллисекунды от ID_EPOCH_MS << 12 | номер узла (7 бит) << 5 | счётчик (5 бит).
+# Влезает в 53 бита, т.е. без потерь передаётся в JS Number, и растёт со временем.
+# Номер узла у каждого процесса свой: его выдаёт аренда в node_leases (init_db),
+# так что воркеры uvicorn с одинаковым окружением не выдают одинаковые id.
+ID_EPOCH_MS = 1704067200000  # 2024-01-01 UTC
+NODE_ID_BITS = 7
+ID_SEQ_BITS = 5
+ID_NODE = None
+_id_lock = threading.Lock()
+_id_last_ms = 0
+_id_seq = 0
+
+def next_message_id():
+    global _id_last_ms, _id_seq
+    if ID_NODE is None:
+        raise RuntimeError("Node id is not leased yet: call models.init_db() first")
+    with _id_lock:
+        now_ms = max(int(time.time() * 1000) - ID_EPOCH_MS, _id_last_ms)
+        if now_ms == _id_last_ms:
+            _id_seq += 1
+            if _id_seq >= 1 << ID_SEQ_BITS:
+                # Счётчик на эту миллисекунду исчерпан — «занимаем» следующую
+                now_ms += 1
+                _id_seq = 0
+        else:
+            _id_seq = 0
+        _id_last_ms = now_ms
+        return (now_ms << 12) | (ID_NODE << ID_SEQ_BITS) | _id_seq
+
+def message_id_at(timestamp_ms: int) -> int:
+    """Наименьший id, который мог быть выдан в этот момент (курсоры синхронизации)."""
+    return max(timestamp_ms - ID_EPOCH_MS, 0) << 12
+
 class User(Base):
     __tablename__ = 'users'
     id = Column(Integer, primary_key=True, index=True)
@@ -22,12 +65,243 @@ class User(Base):
 
 class Message(Base):
     __tablename__ = 'messages'
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True, index=True, default=next_message_id)
     username = Column(String, index=True)
     text = Column(String)
     timestamp = Column(DateTime, default=lambda: datetime.now(timezone.utc))
     chat_id = Column(String, index=True)
+    # Вложение: {"url", "filename", "is_image"}; text для него — "[file] имя -> url" (превью, поиск)
+    # none_as_null: сообщение без вложения хранит SQL NULL, а не строку 'null'
+    attachment = Column(JSON(none_as_null=True), nullable=True)
+    # id, выданный клиентом: повторная отправка после обрыва не создаёт дубль
+    client_id = Column(String, nullable=True)
+
+    # Курсорная пагинация истории: WHERE chat_id = ? AND id < ? ORDER BY id DESC
+    __table_args__ = (
+        Index("ix_messages_chat_id_id", "chat_id", "id"),
+        Index("ix_messages_username_client_id", "username", "client_id"),
+    )
+
+class ChatEvent(Base):
+    __tablename__ = 'chat_events'
+    # Журнал правок и удалений для догоняющей синхронизации клиента.
+    # seq выдаёт next_message_id при постановке в очередь, поэтому он
+    # сравним с id сообщений и известен до записи в БД.
+    seq = Column(Integer, primary_key=True, autoincrement=False)
+    chat_id = Column(String, nullable=False)
+    kind = Column(String, nullable=False)  # edit | delete
+    message_id = Column(Integer, nullable=False)
+    text = Column(String, nullable=True)
+    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+
+    __table_args__ = (Index("ix_chat_events_chat_id_seq", "chat_id", "seq"),)
+
+class Chat(Base):
+    __tablename__ = 'chats'
+    id = Column(String, primary_key=True)  # тот же chat_id, что и в Message: "a:b" или "group:xxxxxxxx"
+    type = Column(String, default="private")  # private | group
+    name = Column(String, default="")
+    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+    # Кэш последнего сообщения для превью в списке чатов (обновляется при записи сообщений)
+    last_message_id = Column(Integer)
+    last_message_username = Column(String)
+    last_message_text = Column(String)
+    last_message_at = Column(DateTime)
 
-engine = create_engine("sqlite:///./chat.db", connect_args={"check_same_thread": False})
+class ChatMember(Base):
+    __tablename__ = 'chat_members'
+    chat_id = Column(String, ForeignKey('chats.id'), primary_key=True)
+    username = Column(String, primary_key=True)
+    # Курсор прочтения: id последнего прочитанного сообщения и сколько после него непрочитанных
+    last_read_id = Column(Integer, default=0)
+    unread_count = Column(Integer, default=0)
+    # Курсор доставки: id последнего сообщения, полученного клиентом участника
+    delivered_id = Column(Integer, default=0)
+
+    # Список чатов пользователя: WHERE username = ?
+    __table_args__ = (Index("ix_chat_members_username_chat_id", "username", "chat_id"),)
+
+class Friendship(Base):
+    __tablename__ = 'friendships'
+    # Храним обе стороны дружбы: (a, b) и (b, a), чтобы список друзей был одним range-scan по PK
+    username = Column(String, primary_key=True)
+    friend = Column(String, primary_key=True, index=True)
+    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+
+class StoredFile(Base):
+    __tablename__ = 'stored_files'
+    # Файл хранится один раз под своим SHA-256, сколько бы раз его ни загрузили
+    sha256 = Column(String, primary_key=True)
+    size = Column(Integer, nullable=False)
+    content_type = Column(String)
+    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+
+class UserFile(Base):
+    __tablename__ = 'user_files'
+    # Кто и под каким именем загрузил файл; по этой таблице считается квота
+    id = Column(Integer, primary_key=True, index=True)
+    username = Column(String, index=True)
+    sha256 = Column(String, ForeignKey('stored_files.sha256'), index=True)
+    filename = Column(String)
+    chat_id = Column(String)
+    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+
+class Upload(Base):
+    __tablename__ = 'uploads'
+    # Незавершённая загрузка по частям; received — сколько байт уже на диске
+    id = Column(String, primary_key=True)
+    username = Column(String, index=True)
+    chat_id = Column(String)
+    filename = Column(String)
+    content_type = Column(String)
+    size = Column(Integer, nullable=False)
+    received = Column(Integer, default=0)
+    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+
+class ChatRetention(Base):
+    __tablename__ = 'chat_retention'
+    # Политика хранения чата; нет строки или NULL — значения по умолчанию (retention.py)
+    chat_id = Column(String, primary_key=True)
+    archive_after_days = Column(Integer, nullable=True)  # 0 — не архивировать
+    keep_recent = Column(Integer, nullable=True)  # столько последних сообщений всегда в messages
+
+class ArchiveSegment(Base):
+    __tablename__ = 'archive_segments'
+    # Неизменяемый сжатый файл со старыми сообщениями чата, id от first_id до last_id
+    id = Column(Integer, primary_key=True)
+    chat_id = Column(String, nullable=False)
+    first_id = Column(Integer, nullable=False)
+    last_id = Column(Integer, nullable=False)
+    count = Column(Integer, nullable=False)
+    path = Column(String, nullable=False)  # относительно ARCHIVE_ROOT
+    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+
+    # Архивная страница истории: WHERE chat_id = ? AND first_id < ? ORDER BY last_id DESC
+    __table_args__ = (Index("ix_archive_segments_chat_id_last_id", "chat_id", "last_id"),)
+
+class ChatPurge(Base):
+    __tablename__ = 'chat_purges'
+    # Удалённый чат: его сообщения с id < before_id дочищаются порциями в фоне
+    chat_id = Column(String, primary_key=True)
+    before_id = Column(Integer, nullable=False)
+
+class NodeLease(Base):
+    __tablename__ = 'node_leases'
+    # Номер узла в id сообщений занят, пока владелец продлевает аренду
+    node_id = Column(Integer, primary_key=True, autoincrement=False)
+    owner = Column(String, nullable=False)
+    expires_at = Column(Float, nullable=False)  # time.time()
+
+class SchemaMigration(Base):
+    __tablename__ = 'schema_migrations'
+    name = Column(String, primary_key=True)
+    applied_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+
+# Настройки SQLite для каждого соединения пула
+SQLITE_CACHE_MB = int(os.getenv("SQLITE_CACHE_MB", "64"))
+SQLITE_MMAP_MB = int(os.getenv("SQLITE_MMAP_MB", "256"))
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+NODE_LEASE_TTL_S = int(os.getenv("NODE_LEASE_TTL_S", "60"))
+
+# create_engine не открывает соединений: первое откроет прогрев при старте (warmup.py)
+engine = create_engine("sqlite:///./chat.db", connect_args={"check_same_thread": False}, pool_size=DB_POOL_SIZE)
+
+@event.listens_for(engine, "connect")
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL: читатели не блокируют писателя, а коммит не требует перезаписи основного файла
+    cursor = dbapi_connection.cursor()
+    # Освобождённые страницы отдаёт retention через incremental_vacuum. Для новой
+    # базы действует сразу, существующую переводит разовый VACUUM (retention.py vacuum)
+    cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    cursor.execute("PRAGMA journal_mode=WAL")
+    # В WAL NORMAL делает fsync только на checkpoint: при отключении питания теряются
+    # последние транзакции, но база не портится
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    # Кэш страниц у каждого соединения свой; mmap читает напрямую из кэша ОС, общего для всех
+    cursor.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_MB * 1024}")
+    cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_MB * 1024 * 1024}")
+    cursor.close()
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-Base.metadata.create_all(bind=engine)
\ No newline at end of file
+
+_schema_lock = threading.Lock()
+_schema_ready = False
+
+def init_db():
+    """Создаёт таблицы, недостающие колонки и индексы и берёт номер узла для id.
+    Идемпотентна: приложение зовёт её при старте, скрипты — до первого обращения к базе."""
+    global _schema_ready
+    with _schema_lock:
+        if _schema_ready:
+            return
+        Base.metadata.create_all(bind=engine)
+        # create_all не добавляет новые колонки и индексы в уже существующие таблицы
+        inspector = inspect(engine)
+        with engine.begin() as conn:
+            for table in Base.metadata.sorted_tables:
+                existing = {c["name"] for c in inspector.get_columns(table.name)}
+                for column in table.columns:
+                    if column.name not in existing:
+                        column_type = column.type.compile(dialect=engine.dialect)
+                        conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(bind=engine, checkfirst=True)
+        lease_node_id()
+        _schema_ready = True
+
+# ====== Аренда номера узла ======
+_lease_owner = f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(4)}"
+_lease_timer = None
+
+def lease_node_id() -> int:
+    """Занимает свободный (или просроченный) номер узла и продлевает его в фоне."""
+    global ID_NODE
+    now = time.time()
+    with engine.begin() as conn:
+        for node_id in range(1 << NODE_ID_BITS):
+            # Один оператор — атомарно: чужую живую аренду WHERE не перезапишет
+            taken = conn.execute(text(
+                "INSERT INTO node_leases (node_id, owner, expires_at) VALUES (:node_id, :owner, :expires) "
+                "ON CONFLICT(node_id) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+                "WHERE node_leases.expires_at < :now OR node_leases.owner = excluded.owner"
+            ), {"node_id": node_id, "owner": _lease_owner, "expires": now + NODE_LEASE_TTL_S, "now": now}).rowcount
+            if taken:
+                break
+        else:
+            raise RuntimeError(f"All {1 << NODE_ID_BITS} node ids are leased, cannot issue message ids")
+    with _id_lock:
+        ID_NODE = node_id
+    _schedule_lease_renewal()
+    return node_id
+
+def _schedule_lease_renewal():
+    global _lease_timer
+    _lease_timer = threading.Timer(NODE_LEASE_TTL_S / 3, _renew_node_lease)
+    _lease_timer.daemon = True
+    _lease_timer.start()
+
+def _renew_node_lease():
+    try:
+        with engine.begin() as conn:
+            renewed = conn.execute(text(
+                "UPDATE node_leases SET expires_at = :expires WHERE node_id = :node_id AND owner = :owner"
+            ), {"expires": time.time() + NODE_LEASE_TTL_S, "node_id": ID_NODE, "owner": _lease_owner}).rowcount
+        if not renewed:
+            # Аренду не продлили вовремя и номер мог уйти другому процессу — берём новый
+            logger.warning("Node id %s lease was lost, leasing a new one", ID_NODE)
+            lease_node_id()
+            return
+    except Exception:
+        logger.exception("Node id lease renewal failed")
+    _schedule_lease_renewal()
+
+@atexit.register
+def _release_node_lease():
+    if _lease_timer is None:
+        return
+    _lease_timer.cancel()
+    try:
+        with engine.begin() as conn:
+            conn.execute(text("DELETE FROM node_leases WHERE owner = :owner"), {"owner": _lease_owner})
+    except Exception:
+        pass
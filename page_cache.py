@@ -0,0 +1,259 @@
+# page_cache.py
+"""Кэш отрендеренных фрагментов страниц, ETag страниц и статика с отпечатками.
+
+Фрагменты. Общие для всех зрителей куски страниц (карточка профиля,
+карточка друга, список друзей пользователя) хранятся по ключу с набором
+тегов: user:<имя> — профиль пользователя, friends:<имя> — его список
+друзей. Изменение в обработчике сбрасывает тег на всех узлах (событие
+шины pages). Перед загрузкой фрагмента запоминаются версии его тегов;
+если тег сбросили, пока фрагмент строился, результат в кэш не попадает.
+
+Страницы. render отдаёт слабый ETag по телу страницы и 304 на совпавший
+If-None-Match — страница всё равно собирается (из кэшированных
+фрагментов), но не передаётся. Страницы личные: private, no-cache.
+
+Статика. JS и CSS из static/ при старте читаются в память, получают
+отпечаток по содержимому и заранее сжимаются (gzip, brotli — если
+установлен). В шаблонах адрес даёт asset_url("script.js") ->
+/assets/script.<отпечаток>.js; такие ответы кэшируются браузером на год.
+Файл поменялся — поменялся адрес; отпечатки пересчитываются при старте.
+"""
+import gzip
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Sequence
+
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import HTMLResponse, Response
+from markupsafe import Markup
+
+try:
+    import brotli
+except ImportError:  # brotli не обязателен, тогда только gzip
+    brotli = None
+
+PAGE_CACHE_ENTRIES = int(os.getenv("PAGE_CACHE_ENTRIES", "20000"))
+
+STATIC_DIR = Path("static")
+ASSET_EXTENSIONS = (".js", ".css")
+ASSET_MAX_AGE_S = 365 * 86400
+# Меньше этого сжимать нет смысла
+COMPRESS_MIN_BYTES = 512
+
+router = APIRouter()
+
+
+# ====== Фрагменты ======
+class FragmentCache:
+    def __init__(self, max_entries: int = PAGE_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        # ключ -> (значение, теги); по LRU
+        self.entries: "OrderedDict[str, tuple]" = OrderedDict()
+        # тег -> ключи и версия тега (растёт при сбросе)
+        self.tagged: Dict[str, set] = {}
+        self.versions: Dict[str, int] = {}
+        self.counters = {"hits": 0, "misses": 0, "invalidations": 0}
+        # Обработчики страниц работают в пуле потоков
+        self._lock = threading.Lock()
+
+    def get(self, key: str, tags: Sequence[str], load: Callable[[], Optional[object]]):
+        """Значение из кэша или load(); None от load не кэшируется."""
+        return self.get_many({key: tags}, lambda keys: {key: load()})[key]
+
+    def get_many(self, items: Dict[str, Sequence[str]],
+                 load_many: Callable[[List[str]], Dict[str, Optional[object]]]) -> Dict[str, Optional[object]]:
+        """Пачка фрагментов: недостающие строятся одним вызовом load_many(ключи)."""
+        found, missing = {}, []
+        with self._lock:
+            for key in items:
+                entry = self.entries.get(key)
+                if entry is None:
+                    missing.append(key)
+                    continue
+                self.entries.move_to_end(key)
+                found[key] = entry[0]
+            self.counters["hits"] += len(found)
+            self.counters["misses"] += len(missing)
+            versions = {key: [self.versions.get(tag, 0) for tag in items[key]] for key in missing}
+        if not missing:
+            return found
+        loaded = load_many(missing)
+        with self._lock:
+            for key in missing:
+                value = loaded.get(key)
+                found[key] = value
+                if value is None or versions[key] != [self.versions.get(tag, 0) for tag in items[key]]:
+                    continue
+                self._store(key, value, tuple(items[key]))
+        return {key: found[key] for key in items}
+
+    def invalidate(self, tags: Iterable[str]):
+        with self._lock:
+            for tag in tags:
+                self.versions[tag] = self.versions.get(tag, 0) + 1
+                for key in self.tagged.pop(tag, ()):
+                    self._drop(key)
+                self.counters["invalidations"] += 1
+
+    def stats(self) -> dict:
+        return {"entries": len(self.entries), **self.counters}
+
+    def _store(self, key: str, value, tags: tuple):
+        self._drop(key)
+        self.entries[key] = (value, tags)
+        for tag in tags:
+            self.tagged.setdefault(tag, set()).add(key)
+        while len(self.entries) > self.max_entries:
+            self._drop(next(iter(self.entries)))
+
+    def _drop(self, key: str):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry[1]:
+            keys = self.tagged.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tagged[tag]
+
+
+class Pages:
+    def __init__(self, templates, manager, cache: Optional[FragmentCache] = None):
+        self.templates = templates
+        self.manager = manager
+        self.cache = cache or FragmentCache()
+        templates.env.globals["asset_url"] = assets.url
+        manager.on("pages", self._on_invalidate)
+
+    def fragment(self, name: str, **context) -> Markup:
+        return Markup(self.templates.get_template(name).render(context))
+
+    def invalidate(self, *tags: str):
+        """Сбросить теги здесь и на остальных узлах. Можно звать из потока обработчика HTTP."""
+        self.cache.invalidate(tags)
+        self.manager.publish_soon("pages", tags=list(tags))
+
+    def render(self, request: Request, name: str, context: dict) -> Response:
+        body = self.templates.get_template(name).render({"request": request, **context})
+        etag = 'W/"' + hashlib.blake2b(body.encode(), digest_size=12).hexdigest() + '"'
+        headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+        if etag_matches(request, etag):
+            return Response(status_code=304, headers=headers)
+        return HTMLResponse(body, headers=headers)
+
+    async def _on_invalidate(self, event: dict):
+        if event["node"] != self.manager.node:
+            self.cache.invalidate(event["tags"])
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    # Сравнение слабое: W/"x" и "x" — одно и то же
+    bare = etag[2:] if etag.startswith("W/") else etag
+    candidates = {c.strip()[2:] if c.strip().startswith("W/") else c.strip() for c in header.split(",")}
+    return bare in candidates or "*" in candidates
+
+
+# ====== Статика с отпечатками ======
+class Asset:
+    __slots__ = ("name", "content_type", "digest", "body", "encoded")
+
+    def __init__(self, name: str, content_type: str, body: bytes):
+        self.name = name
+        self.content_type = content_type
+        self.body = body
+        self.digest = hashlib.sha256(body).hexdigest()[:16]
+        # кодировка -> сжатое тело; только если вышло короче
+        self.encoded: Dict[str, bytes] = {}
+        if len(body) >= COMPRESS_MIN_BYTES:
+            if brotli is not None:
+                self.encoded["br"] = brotli.compress(body, quality=11)
+            self.encoded["gzip"] = gzip.compress(body, compresslevel=9, mtime=0)
+            self.encoded = {k: v for k, v in self.encoded.items() if len(v) < len(body)}
+
+    @property
+    def etag(self) -> str:
+        return f'"{self.digest}"'
+
+    @property
+    def fingerprinted(self) -> str:
+        stem, ext = os.path.splitext(self.name)
+        return f"{stem}.{self.digest}{ext}"
+
+
+CONTENT_TYPES = {".js": "text/javascript; charset=utf-8", ".css": "text/css; charset=utf-8"}
+
+
+class Assets:
+    def __init__(self, directory: Path = STATIC_DIR):
+        self.directory = directory
+        # имя файла -> Asset; отпечатанное имя -> Asset
+        self.by_name: Dict[str, Asset] = {}
+        self.by_fingerprint: Dict[str, Asset] = {}
+
+    def load(self):
+        by_name = {}
+        for path in sorted(self.directory.rglob("*")):
+            if path.suffix in ASSET_EXTENSIONS and path.is_file():
+                name = path.relative_to(self.directory).as_posix()
+                by_name[name] = Asset(name, CONTENT_TYPES[path.suffix], path.read_bytes())
+        self.by_name = by_name
+        self.by_fingerprint = {asset.fingerprinted: asset for asset in by_name.values()}
+
+    def url(self, name: str) -> str:
+        asset = self.by_name.get(name)
+        # Не нашли (файл появился после старта) — обычный адрес без долгого кэша
+        return f"/assets/{asset.fingerprinted}" if asset is not None else f"/static/{name}"
+
+    def stats(self) -> dict:
+        return {
+            name: {"bytes": len(a.body), **{enc: len(body) for enc, body in a.encoded.items()}}
+            for name, a in self.by_name.items()
+        }
+
+
+# Заполняется при старте узла (main.start_node), до приёма соединений
+assets = Assets()
+
+
+def choose_encoding(accept_encoding: str, available: Iterable[str]) -> Optional[str]:
+    accepted = {}
+    for item in accept_encoding.split(","):
+        coding, _, params = item.strip().partition(";")
+        q = 1.0
+        if params.strip().startswith("q="):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        accepted[coding.strip().lower()] = q
+    # br короче gzip — он первый, если клиент его принимает
+    for coding in ("br", "gzip"):
+        if coding in available and accepted.get(coding, 0) > 0:
+            return coding
+    return None
+
+
+@router.get("/assets/{name:path}")
+async def get_asset(name: str, request: Request):
+    asset = assets.by_fingerprint.get(name)
+    if asset is None:
+        raise HTTPException(status_code=404)
+    headers = {
+        "Cache-Control": f"public, max-age={ASSET_MAX_AGE_S}, immutable",
+        "ETag": asset.etag,
+        "Vary": "Accept-Encoding",
+    }
+    if etag_matches(request, asset.etag):
+        return Response(status_code=304, headers=headers)
+    coding = choose_encoding(request.headers.get("accept-encoding", ""), asset.encoded)
+    if coding is None:
+        return Response(asset.body, media_type=asset.content_type, headers=headers)
+    headers["Content-Encoding"] = coding
+    return Response(asset.encoded[coding], media_type=asset.content_type, headers=headers)
@@ -0,0 +1,184 @@
+# presence.py
+"""Онлайн-статус пользователей и last_seen.
+
+Узел считает свои сокеты по пользователю (вкладок может быть несколько).
+Кто онлайн во всём кластере, каждый узел собирает из событий шины
+presence: username -> узлы, где у пользователя есть сокет. О переходе
+онлайн/офлайн узнают только друзья пользователя, которые сейчас онлайн.
+
+last_seen копится в памяти и раз в PRESENCE_FLUSH_INTERVAL_MS пишется
+в users одним пакетным UPDATE — вместо коммита на каждое подключение
+и отключение.
+"""
+import asyncio
+import logging
+import os
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Set
+
+from sqlalchemy import bindparam
+from sqlalchemy.orm import Session
+
+from database import run_db
+from models import Friendship, User
+
+logger = logging.getLogger(__name__)
+
+PRESENCE_FLUSH_INTERVAL_MS = int(os.getenv("PRESENCE_FLUSH_INTERVAL_MS", "5000"))
+# Сколько пользователей можно спросить в одном /api/presence
+PRESENCE_LOOKUP_MAX = 200
+
+
+def utcnow() -> datetime:
+    # В users.last_seen SQLite хранит время без зоны — держим так же
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def format_time(value: Optional[datetime]) -> Optional[str]:
+    return value.isoformat() + "Z" if value else None
+
+
+def load_friend_names(db: Session, username: str) -> List[str]:
+    return [row.friend for row in db.query(Friendship.friend).filter(Friendship.username == username)]
+
+
+def load_last_seen(db: Session, usernames: List[str]) -> Dict[str, Optional[datetime]]:
+    rows = db.query(User.username, User.last_seen).filter(User.username.in_(usernames))
+    return {row.username: row.last_seen for row in rows}
+
+
+def write_last_seen(db: Session, values: Dict[str, datetime]):
+    statement = (
+        User.__table__.update()
+        .where(User.__table__.c.username == bindparam("b_username"))
+        .values(last_seen=bindparam("b_last_seen"))
+    )
+    db.execute(statement, [{"b_username": u, "b_last_seen": ts} for u, ts in values.items()])
+    db.commit()
+
+
+class Presence:
+    def __init__(self, manager, flush_interval_ms: int = PRESENCE_FLUSH_INTERVAL_MS):
+        self.manager = manager
+        self.interval = flush_interval_ms / 1000.0
+        # username -> открытые сокеты на этом узле
+        self.connections: Dict[str, int] = {}
+        # username -> узлы, где пользователь онлайн (копия состояния кластера)
+        self.online: Dict[str, Set[str]] = {}
+        # last_seen, ещё не записанный в БД
+        self.pending: Dict[str, datetime] = {}
+        self._task: Optional[asyncio.Task] = None
+        manager.on("presence", self._on_presence)
+        manager.on("hello", self._on_hello)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # Узел уходит: его пользователи для остальных офлайн
+        for username in list(self.connections):
+            self.touch(username)
+            await self.manager.publish("presence", username=username, online=False)
+        self.connections.clear()
+        await self.flush()
+
+    def touch(self, username: str):
+        self.pending[username] = utcnow()
+
+    def is_online(self, username: str) -> bool:
+        return username in self.online
+
+    async def connect(self, username: str):
+        self.touch(username)
+        count = self.connections.get(username, 0) + 1
+        self.connections[username] = count
+        if count > 1:
+            return
+        # Первый сокет на узле; друзьям сообщаем, только если пользователя не было нигде
+        appeared = not self.online.get(username)
+        self._apply(username, self.manager.node, True)
+        await self.manager.publish("presence", username=username, online=True)
+        if appeared:
+            await self._notify_friends(username, True)
+
+    async def disconnect(self, username: str):
+        self.touch(username)
+        count = self.connections.get(username, 0) - 1
+        if count > 0:
+            self.connections[username] = count
+            return
+        self.connections.pop(username, None)
+        self._apply(username, self.manager.node, False)
+        await self.manager.publish("presence", username=username, online=False)
+        if not self.online.get(username):
+            await self._notify_friends(username, False)
+
+    def status(self, username: str, stored_last_seen: Optional[datetime]) -> dict:
+        return {
+            "online": self.is_online(username),
+            "last_seen": format_time(self.pending.get(username, stored_last_seen)),
+        }
+
+    async def lookup(self, usernames: Iterable[str]) -> Dict[str, dict]:
+        """Статус пачкой: онлайн — из памяти, last_seen — одним запросом (неизвестные пропускаем)."""
+        usernames = list(dict.fromkeys(usernames))[:PRESENCE_LOOKUP_MAX]
+        if not usernames:
+            return {}
+        stored = await run_db(load_last_seen, usernames)
+        return {username: self.status(username, stored[username]) for username in usernames if username in stored}
+
+    async def flush(self):
+        if not self.pending:
+            return
+        values, self.pending = self.pending, {}
+        try:
+            await run_db(write_last_seen, values)
+        except Exception:
+            logger.exception("last_seen flush failed")
+            # Вернём в очередь, не затирая более свежие значения
+            for username, ts in values.items():
+                self.pending.setdefault(username, ts)
+
+    def _apply(self, username: str, node: str, online: bool):
+        if online:
+            self.online.setdefault(username, set()).add(node)
+            return
+        nodes = self.online.get(username)
+        if nodes is not None:
+            nodes.discard(node)
+            if not nodes:
+                del self.online[username]
+
+    async def _notify_friends(self, username: str, online: bool):
+        friends = [f for f in await run_db(load_friend_names, username) if f in self.online]
+        if not friends:
+            return
+        await self.manager.send_to_users(friends, {
+            "type": "presence",
+            "username": username,
+            "online": online,
+            "last_seen": format_time(self.pending.get(username)),
+        }, key=f"presence:{username}")
+
+    async def _on_presence(self, event: dict):
+        self._apply(event["username"], event["node"], event["online"])
+
+    async def _on_hello(self, event: dict):
+        # Новый узел: сообщаем ему, кто подключён к нам
+        if event["node"] == self.manager.node:
+            return
+        for username in list(self.connections):
+            await self.manager.publish("presence", username=username, online=True)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
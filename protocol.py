@@ -0,0 +1,92 @@
+# protocol.py
+"""Кодирование кадров WebSocket и событий шины.
+
+Кодек выбирается при подключении через Sec-WebSocket-Protocol:
+  json    - текстовые кадры (по умолчанию, и если клиент ничего не предложил)
+  msgpack - бинарные кадры, если установлен msgpack
+JSON кодирует orjson, если он установлен, иначе stdlib json.
+
+Событие для рассылки оборачивается в Frame: каждый кодек кодирует его
+один раз, и готовые байты/строка уходят всем получателям на узле.
+"""
+import json
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple, Union
+
+from starlette.websockets import WebSocket, WebSocketDisconnect
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+Payload = Union[str, bytes]
+
+
+class Codec(NamedTuple):
+    name: str
+    binary: bool
+    encode: Callable[[Any], Payload]
+    decode: Callable[[Payload], Any]
+
+
+if orjson is not None:
+    def dumps(value) -> str:
+        return orjson.dumps(value).decode()
+
+    loads = orjson.loads
+else:
+    def dumps(value) -> str:
+        return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+    loads = json.loads
+
+JSON = Codec("json", False, dumps, loads)
+MSGPACK = Codec("msgpack", True, msgpack.packb, msgpack.unpackb) if msgpack is not None else None
+
+# Порядок — предпочтение сервера, если клиент предложил несколько
+CODECS: Dict[str, Codec] = {codec.name: codec for codec in (MSGPACK, JSON) if codec is not None}
+
+
+def negotiate(offered: List[str]) -> Tuple[Codec, Optional[str]]:
+    """(кодек, подпротокол для accept). Без подходящего предложения — JSON без подпротокола."""
+    for name, codec in CODECS.items():
+        if name in offered:
+            return codec, name
+    return JSON, None
+
+
+class Frame:
+    """Событие, закодированное не больше одного раза на кодек."""
+    __slots__ = ("event", "_encoded")
+
+    def __init__(self, event: dict):
+        self.event = event
+        self._encoded: Dict[str, Payload] = {}
+
+    def encode(self, codec: Codec) -> Payload:
+        payload = self._encoded.get(codec.name)
+        if payload is None:
+            payload = self._encoded[codec.name] = codec.encode(self.event)
+        return payload
+
+
+async def send(websocket: WebSocket, codec: Codec, payload: Payload):
+    if codec.binary:
+        await websocket.send_bytes(payload)
+    else:
+        await websocket.send_text(payload)
+
+
+async def receive(websocket: WebSocket, codec: Codec) -> Any:
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000))
+    # Текстовый кадр — всегда JSON, бинарный — кодек соединения
+    if message.get("text") is not None:
+        return loads(message["text"])
+    return codec.decode(message["bytes"])
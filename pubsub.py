@@ -0,0 +1,227 @@
+# pubsub.py
+"""Шина событий между процессами/узлами для ConnectionManager.
+
+Сообщения шины — словари. LocalPubSub — по умолчанию, всё внутри одного
+процесса: словарь передаётся обработчику как есть, без сериализации.
+RedisPubSub — протокол Redis (RESP): PUBLISH/SUBSCRIBE на одном канале,
+словарь кодируется в JSON на отправке и разбирается на приёме.
+Подойдёт настоящий Redis или встроенная заглушка-брокер:
+
+    python pubsub.py --port 6390
+    PUBSUB_URL=redis://127.0.0.1:6390 uvicorn main:app --workers 4
+"""
+import argparse
+import asyncio
+import logging
+import os
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+from urllib.parse import urlparse
+
+import protocol
+
+logger = logging.getLogger(__name__)
+
+Handler = Callable[[dict], Awaitable[None]]
+
+PUBSUB_URL = os.getenv("PUBSUB_URL", "")
+PUBSUB_CHANNEL = os.getenv("PUBSUB_CHANNEL", "messenger")
+
+
+class PubSub:
+    async def start(self, handler: Handler):
+        raise NotImplementedError
+
+    async def publish(self, message: dict):
+        raise NotImplementedError
+
+    async def stop(self):
+        pass
+
+
+class LocalPubSub(PubSub):
+    """Один процесс: publish сразу вызывает обработчик с тем же словарём."""
+
+    def __init__(self):
+        self.handler: Optional[Handler] = None
+
+    async def start(self, handler: Handler):
+        self.handler = handler
+
+    async def publish(self, message: dict):
+        if self.handler is not None:
+            await self.handler(message)
+
+
+# ====== RESP ======
+def encode_command(*parts) -> bytes:
+    out = [b"*%d\r\n" % len(parts)]
+    for part in parts:
+        data = part if isinstance(part, bytes) else str(part).encode("utf-8")
+        out.append(b"$%d\r\n%s\r\n" % (len(data), data))
+    return b"".join(out)
+
+
+async def read_reply(reader: asyncio.StreamReader):
+    line = await reader.readline()
+    if not line:
+        raise ConnectionError("connection closed")
+    prefix, rest = line[:1], line[1:-2]
+    if prefix == b"+":
+        return rest.decode()
+    if prefix == b"-":
+        raise RuntimeError(rest.decode())
+    if prefix == b":":
+        return int(rest)
+    if prefix == b"$":
+        size = int(rest)
+        if size < 0:
+            return None
+        data = await reader.readexactly(size + 2)
+        return data[:-2]
+    if prefix == b"*":
+        count = int(rest)
+        if count < 0:
+            return None
+        return [await read_reply(reader) for _ in range(count)]
+    raise RuntimeError(f"unexpected RESP reply: {line!r}")
+
+
+class RedisPubSub(PubSub):
+    """Два соединения: одно подписано на канал, второе публикует (ответы читаем в фоне)."""
+
+    def __init__(self, url: str, channel: str = PUBSUB_CHANNEL, reconnect_delay: float = 1.0):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "127.0.0.1"
+        self.port = parsed.port or 6379
+        self.channel = channel
+        self.reconnect_delay = reconnect_delay
+        self.handler: Optional[Handler] = None
+        self._pub_writer: Optional[asyncio.StreamWriter] = None
+        self._tasks: List[asyncio.Task] = []
+        # Подписка и соединение для публикации переподключаются независимо
+        self._connected = asyncio.Event()
+        self._pub_ready = asyncio.Event()
+
+    async def start(self, handler: Handler):
+        self.handler = handler
+        self._tasks.append(asyncio.create_task(self._subscribe_loop()))
+        self._tasks.append(asyncio.create_task(self._publisher_loop()))
+        await self._connected.wait()
+        await self._pub_ready.wait()
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._pub_writer is not None:
+            self._pub_writer.close()
+
+    async def publish(self, message: dict):
+        payload = protocol.dumps(message)
+        # Пока публикующее соединение переподключается, ждём его, а не роняем обработчик
+        while self._pub_writer is None:
+            await self._pub_ready.wait()
+        self._pub_writer.write(encode_command("PUBLISH", self.channel, payload))
+        await self._pub_writer.drain()
+
+    async def _subscribe_loop(self):
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(self.host, self.port)
+                writer.write(encode_command("SUBSCRIBE", self.channel))
+                await writer.drain()
+                while True:
+                    reply = await read_reply(reader)
+                    if not isinstance(reply, list) or len(reply) < 3:
+                        continue
+                    kind = reply[0].decode() if isinstance(reply[0], bytes) else reply[0]
+                    if kind == "subscribe":
+                        self._connected.set()
+                    elif kind == "message":
+                        try:
+                            await self.handler(protocol.loads(reply[2]))
+                        except Exception:
+                            logger.exception("pub/sub handler failed")
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                logger.warning("pub/sub subscriber disconnected: %s", exc)
+                await asyncio.sleep(self.reconnect_delay)
+
+    async def _publisher_loop(self):
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(self.host, self.port)
+                self._pub_writer = writer
+                self._pub_ready.set()
+                # Ответы на PUBLISH (число подписчиков) нам не нужны — просто вычитываем
+                while True:
+                    await read_reply(reader)
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                logger.warning("pub/sub publisher disconnected: %s", exc)
+                self._pub_writer = None
+                self._pub_ready.clear()
+                await asyncio.sleep(self.reconnect_delay)
+
+
+def create_pubsub(url: str = PUBSUB_URL) -> PubSub:
+    if url.startswith("redis://"):
+        return RedisPubSub(url)
+    return LocalPubSub()
+
+
+# ====== Заглушка Redis: только SUBSCRIBE / PUBLISH / PING ======
+class Broker:
+    def __init__(self):
+        self.subscribers: Dict[str, Set[asyncio.StreamWriter]] = {}
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        channels: Set[str] = set()
+        try:
+            while True:
+                command = await read_reply(reader)
+                if not isinstance(command, list) or not command:
+                    continue
+                name = command[0].decode().upper()
+                args = [a.decode("utf-8") for a in command[1:]]
+                if name == "SUBSCRIBE":
+                    for channel in args:
+                        channels.add(channel)
+                        self.subscribers.setdefault(channel, set()).add(writer)
+                        writer.write(b"*3\r\n" + encode_command("subscribe", channel)[4:] + b":%d\r\n" % len(channels))
+                elif name == "PUBLISH":
+                    channel, payload = args[0], args[1]
+                    targets = list(self.subscribers.get(channel, ()))
+                    frame = b"*3\r\n" + encode_command("message", channel, payload)[4:]
+                    for target in targets:
+                        target.write(frame)
+                    writer.write(b":%d\r\n" % len(targets))
+                elif name == "PING":
+                    writer.write(b"+PONG\r\n")
+                else:
+                    writer.write(b"-ERR unknown command\r\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            for channel in channels:
+                self.subscribers.get(channel, set()).discard(writer)
+            writer.close()
+
+
+async def serve_broker(host: str, port: int):
+    broker = Broker()
+    server = await asyncio.start_server(broker.handle, host, port)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Minimal Redis-protocol pub/sub broker")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6390)
+    args = parser.parse_args()
+    asyncio.run(serve_broker(args.host, args.port))
@@ -0,0 +1,134 @@
+# ratelimit.py
+"""Ограничение частоты событий: token bucket в памяти узла.
+
+Корзины две:
+  (username, событие) — для каждого типа кадра WebSocket и для тяжёлых
+      HTTP-вызовов; общая на все вкладки пользователя на этом узле;
+  соединение — все входящие кадры сокета, включая мусорные, на которые
+      нет отдельного лимита.
+Лимит — «событий в секунду/запас», задаётся в RATE_LIMITS:
+  RATE_LIMITS="message=5/20,typing=3/10"
+Перечисленные события переопределяют значения по умолчанию. Проверка —
+до любой работы с БД и шиной. Отклонённые события считаются в stats().
+"""
+import os
+import time
+from typing import Dict, Hashable, Tuple
+
+from fastapi import Depends, HTTPException
+
+from auth import current_user
+
+DEFAULT_LIMITS = {
+    # Кадры WebSocket
+    "message": (5, 20),
+    "attachment": (1, 5),
+    "edit_message": (2, 10),
+    "delete_message": (2, 10),
+    "typing": (3, 10),
+    "mark_read": (10, 30),
+    "delivered": (10, 30),
+    "load_chat": (10, 30),
+    "sync": (5, 10),
+    # Все кадры одного соединения
+    "frame": (30, 60),
+    # HTTP
+    "upload": (2, 10),
+    "add_friend": (0.5, 5),
+}
+# Типы кадров с отдельным лимитом; остальные кадры — это текстовые сообщения
+FRAME_EVENTS = ("attachment", "edit_message", "delete_message", "typing", "mark_read", "delivered", "load_chat", "sync")
+# О них клиенту не сообщаем: отброшенное обновится следующим же кадром
+QUIET_EVENTS = ("typing", "mark_read", "delivered")
+# Корзины, не тронутые дольше этого, всё равно полные — выбрасываем
+RATE_IDLE_S = 300
+
+
+def parse_limits(value: str) -> Dict[str, Tuple[float, float]]:
+    limits = {}
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        event, _, spec = item.partition("=")
+        rate, _, burst = spec.partition("/")
+        rate, burst = float(rate), float(burst or rate)
+        # Ошибку конфигурации видно при старте, а не делением на ноль в первом запросе
+        if not rate > 0 or not burst >= 1:
+            raise ValueError(f"RATE_LIMITS: {item.strip()!r} needs rate > 0 and burst >= 1")
+        limits[event.strip()] = (rate, burst)
+    return limits
+
+
+RATE_LIMITS = {**DEFAULT_LIMITS, **parse_limits(os.getenv("RATE_LIMITS", ""))}
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, now: float) -> float:
+        """0 — разрешено; иначе через сколько секунд появится жетон."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    def __init__(self, limits: Dict[str, Tuple[float, float]] = RATE_LIMITS, idle_s: float = RATE_IDLE_S):
+        self.limits = limits
+        self.idle = idle_s
+        self.buckets: Dict[Tuple[Hashable, str], TokenBucket] = {}
+        # событие -> сколько отклонено
+        self.throttled: Dict[str, int] = {}
+        self._swept = time.monotonic()
+
+    def check(self, key: Hashable, event: str) -> float:
+        """0 — событие разрешено; иначе retry_after в секундах. Событие без лимита разрешено."""
+        limit = self.limits.get(event)
+        if limit is None:
+            return 0.0
+        now = time.monotonic()
+        bucket = self.buckets.get((key, event))
+        if bucket is None:
+            if now - self._swept > self.idle:
+                self._sweep(now)
+            bucket = self.buckets[(key, event)] = TokenBucket(limit[0], limit[1], now)
+        retry_after = bucket.take(now)
+        if retry_after:
+            self.throttled[event] = self.throttled.get(event, 0) + 1
+        return retry_after
+
+    def allow(self, key: Hashable, event: str) -> bool:
+        return not self.check(key, event)
+
+    def forget(self, key: Hashable, event: str):
+        self.buckets.pop((key, event), None)
+
+    def stats(self) -> dict:
+        return {"buckets": len(self.buckets), "throttled": dict(self.throttled)}
+
+    def _sweep(self, now: float):
+        self._swept = now
+        for key in [k for k, b in self.buckets.items() if now - b.updated > self.idle]:
+            del self.buckets[key]
+
+
+limiter = RateLimiter()
+
+
+def rate_limit(event: str):
+    """Зависимость для HTTP: 429 с Retry-After, если пользователь превысил лимит события."""
+    async def dependency(username: str = Depends(current_user)):
+        retry_after = limiter.check(username, event)
+        if retry_after:
+            raise HTTPException(status_code=429, detail="Too many requests",
+                                headers={"Retry-After": str(max(1, round(retry_after)))})
+    return dependency
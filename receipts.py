@@ -0,0 +1,244 @@
+# receipts.py
+"""Подтверждения отправки и отметки о доставке и прочтении.
+
+Отправка. Клиент присваивает сообщению client_id и, пока не получил ack,
+после переподключения шлёт его повторно с retry=true. Повтор не создаёт
+второе сообщение: недавние client_id узел помнит IDEMPOTENCY_TTL_S, а
+повтор, пришедший на другой узел, находится в БД по индексу (username,
+client_id). ack — {"type": "ack", "messages": [{client_id, id, chat_id}]} —
+уходит отправившему сокету после коммита пачки write-behind очереди, то
+есть подтверждает запись, а не только приём; одна пачка — один кадр на сокет.
+Если БД отвергла сообщение, вместо ack приходит nack с тем же составом полей:
+повторять его бесполезно, client_id забывается.
+
+Доставка и прочтение. У участника чата два курсора: delivered (клиент
+получил сообщения до этого id) и read (mark_read). Кадры клиентов только
+сдвигают курсоры в памяти; раз в RECEIPTS_INTERVAL_MS узел рассылает по
+каждому изменившемуся чату один кадр receipts со всеми сдвигами за
+интервал и ставит их запись в очередь — сколько бы участников ни читали.
+Последние курсоры чатов держатся в кэше (события receipts с шины
+обновляют его на всех узлах), чтобы load_chat отдавал их без запроса к БД.
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from fastapi import WebSocket
+from sqlalchemy.orm import Session
+
+import chat_summary
+from database import run_db
+from models import Message
+
+logger = logging.getLogger(__name__)
+
+RECEIPTS_INTERVAL_MS = int(os.getenv("RECEIPTS_INTERVAL_MS", "1000"))
+IDEMPOTENCY_TTL_S = int(os.getenv("IDEMPOTENCY_TTL_S", "600"))
+RECEIPTS_CACHE_CHATS = int(os.getenv("RECEIPTS_CACHE_CHATS", "10000"))
+CLIENT_ID_MAX_LENGTH = 64
+
+
+def parse_client_id(value) -> Optional[str]:
+    if isinstance(value, str) and 0 < len(value) <= CLIENT_ID_MAX_LENGTH:
+        return value
+    return None
+
+
+def find_client_message(db: Session, username: str, client_id: str):
+    row = db.query(Message.id, Message.chat_id).filter(
+        Message.username == username, Message.client_id == client_id
+    ).first()
+    return {"client_id": client_id, "id": row.id, "chat_id": row.chat_id} if row else None
+
+
+class SentMessage:
+    __slots__ = ("ack", "persisted", "expires")
+
+    def __init__(self, ack: dict, expires: float):
+        self.ack = ack
+        self.persisted = False
+        self.expires = expires
+
+
+class Receipts:
+    def __init__(self, manager, writer, interval_ms: int = RECEIPTS_INTERVAL_MS,
+                 ttl_s: int = IDEMPOTENCY_TTL_S, cache_chats: int = RECEIPTS_CACHE_CHATS):
+        self.manager = manager
+        self.writer = writer
+        self.interval = interval_ms / 1000.0
+        self.ttl = ttl_s
+        # (username, client_id) -> отправленное сообщение
+        self.sent: Dict[Tuple[str, str], SentMessage] = {}
+        # id сообщения -> (сокет, ключ в sent): ждут коммита
+        self.awaiting: Dict[int, Tuple[WebSocket, Tuple[str, str]]] = {}
+        # chat_id -> username -> [delivered, read]: сдвиги за текущий интервал
+        self.pending: Dict[str, Dict[str, List[int]]] = {}
+        # chat_id -> username -> [delivered, read]: последние известные курсоры, LRU
+        self.cursors: "OrderedDict[str, Dict[str, List[int]]]" = OrderedDict()
+        self.cache_chats = cache_chats
+        self.counters = {"acks": 0, "duplicates": 0, "receipt_frames": 0}
+        self._task: Optional[asyncio.Task] = None
+        writer.on_persisted(self._on_persisted)
+        writer.on_dropped(self._on_dropped)
+        manager.observe(self._observe)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self._emit()
+
+    # ====== Отправка ======
+    async def recall(self, websocket: WebSocket, username: str, client_id: str, retry: bool) -> bool:
+        """True — сообщение с этим client_id уже принято: ack отправлен или придёт после коммита."""
+        key = (username, client_id)
+        sent = self.sent.get(key)
+        if sent is not None and sent.expires > time.monotonic():
+            self.counters["duplicates"] += 1
+            if sent.persisted:
+                self._ack(websocket, [sent.ack])
+            else:
+                # Переподключились, пока пачка не записана — ack уйдёт новому сокету
+                self.awaiting[sent.ack["id"]] = (websocket, key)
+            return True
+        if not retry:
+            return False
+        # Повтор мог прийти на другой узел, чем первая попытка
+        ack = await run_db(find_client_message, username, client_id)
+        if ack is None:
+            return False
+        self.counters["duplicates"] += 1
+        self._ack(websocket, [ack])
+        return True
+
+    def remember(self, websocket: WebSocket, username: str, client_id: str, msg_id: int, chat_id: str):
+        key = (username, client_id)
+        self.sent[key] = SentMessage({"client_id": client_id, "id": msg_id, "chat_id": chat_id},
+                                     time.monotonic() + self.ttl)
+        self.awaiting[msg_id] = (websocket, key)
+
+    def forget_socket(self, websocket: WebSocket):
+        for msg_id in [i for i, (ws, _) in self.awaiting.items() if ws is websocket]:
+            del self.awaiting[msg_id]
+
+    def _on_persisted(self, rows: List[dict]):
+        acks: Dict[WebSocket, List[dict]] = {}
+        for row in rows:
+            waiting = self.awaiting.pop(row["id"], None)
+            if waiting is None:
+                continue
+            websocket, key = waiting
+            sent = self.sent.get(key)
+            if sent is None:
+                continue
+            sent.persisted = True
+            acks.setdefault(websocket, []).append(sent.ack)
+        for websocket, messages in acks.items():
+            self._ack(websocket, messages)
+
+    def _on_dropped(self, rows: List[dict]):
+        nacks: Dict[WebSocket, List[dict]] = {}
+        for row in rows:
+            waiting = self.awaiting.pop(row["id"], None)
+            if waiting is None:
+                continue
+            websocket, key = waiting
+            sent = self.sent.pop(key, None)
+            if sent is not None:
+                nacks.setdefault(websocket, []).append(sent.ack)
+        for websocket, messages in nacks.items():
+            self.manager.send(websocket, {"type": "nack", "messages": messages})
+
+    def _ack(self, websocket: WebSocket, messages: List[dict]):
+        self.counters["acks"] += len(messages)
+        self.manager.send(websocket, {"type": "ack", "messages": messages})
+
+    # ====== Доставка и прочтение ======
+    def delivered(self, username: str, chat_id: str, message_id: int):
+        self._advance(chat_id, username, message_id, 0)
+
+    def read(self, username: str, chat_id: str, message_id: int):
+        # Прочитанное тем более доставлено
+        self._advance(chat_id, username, message_id, message_id)
+
+    async def load(self, chat_id: str) -> Dict[str, dict]:
+        """Курсоры участников для load_chat: {username: {"delivered", "read"}}."""
+        cursors = self.cursors.get(chat_id)
+        if cursors is None:
+            cursors = await run_db(chat_summary.load_receipts, chat_id)
+            # Сдвиги этого интервала ещё не в БД
+            for username, values in self.pending.get(chat_id, {}).items():
+                _merge(cursors, username, values)
+            self._cache(chat_id, cursors)
+        else:
+            self.cursors.move_to_end(chat_id)
+        return {username: {"delivered": d, "read": r} for username, (d, r) in cursors.items()}
+
+    def stats(self) -> dict:
+        return {**self.counters, "idempotency_keys": len(self.sent), "awaiting_ack": len(self.awaiting),
+                "cached_chats": len(self.cursors)}
+
+    def _advance(self, chat_id: str, username: str, delivered: int, read: int):
+        known = self.cursors.get(chat_id, {}).get(username)
+        if known is not None and delivered <= known[0] and read <= known[1]:
+            return
+        _merge(self.pending.setdefault(chat_id, {}), username, [delivered, read])
+
+    def _observe(self, chat_id: str, event: Optional[dict]):
+        if event is None:
+            self.cursors.pop(chat_id, None)
+            return
+        if event.get("type") != "receipts":
+            return
+        cursors = self.cursors.get(chat_id)
+        if cursors is None:
+            return
+        for username, values in event["receipts"].items():
+            _merge(cursors, username, [values["delivered"], values["read"]])
+
+    def _cache(self, chat_id: str, cursors: Dict[str, List[int]]):
+        self.cursors[chat_id] = cursors
+        while len(self.cursors) > self.cache_chats:
+            self.cursors.popitem(last=False)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            for key in [k for k, sent in self.sent.items() if sent.expires <= now]:
+                del self.sent[key]
+            try:
+                await self._emit()
+            except Exception:
+                logger.exception("Receipts flush failed")
+
+    async def _emit(self):
+        pending, self.pending = self.pending, {}
+        for chat_id, changes in pending.items():
+            for username, (delivered, read) in changes.items():
+                # До read курсор доставки сдвигает сам mark_read
+                if delivered > read:
+                    self.writer.mark_delivered(username, chat_id, delivered)
+            self.counters["receipt_frames"] += 1
+            await self.manager.broadcast(chat_id, {
+                "type": "receipts",
+                "chat_id": chat_id,
+                "receipts": {u: {"delivered": d, "read": r} for u, (d, r) in changes.items()}
+            })
+
+
+def _merge(cursors: Dict[str, List[int]], username: str, values: List[int]):
+    current = cursors.setdefault(username, [0, 0])
+    current[0] = max(current[0], values[0], values[1])
+    current[1] = max(current[1], values[1])
@@ -0,0 +1,387 @@
+# retention.py
+"""Хранение истории: архив старых сообщений, фоновое удаление чатов, vacuum.
+
+Архив. Выключен, пока не задан RETENTION_ARCHIVE_AFTER_DAYS или политика
+чата. Сообщения старше archive_after_days дней, кроме keep_recent
+последних в чате, переезжают из messages в сжатые сегменты на диске:
+ARCHIVE_ROOT/<xx>/<хэш чата>/<first_id>-<last_id>-<суффикс>.jsonl.gz, по
+строке JSON на сообщение (тот же вид, что в load_chat). Сегмент пишется
+один раз и не меняется, новые только добавляются; учёт — в archive_segments.
+Файл пишется вне потока БД и появляется на диске до коммита, который
+удаляет строки из messages, поэтому при сбое между ними остаётся лишний
+файл, а не потерянные сообщения.
+Политика задаётся на чат (chat_retention), по умолчанию — из окружения.
+Архивные сообщения только читаются: правка, удаление и поиск их не видят —
+поэтому архив включается явно.
+
+История. load_history_page, дойдя до начала живых сообщений, возвращает
+сегменты, а читает и распаковывает их read_archived — вне потока БД.
+Распакованные сегменты кэшируются (они неизменяемы).
+
+Удаление чата. drop_chat только ставит отметку в chat_purges с границей
+before_id; сообщения, сегменты и журнал чата удаляются здесь порциями по
+RETENTION_PURGE_CHUNK, между которыми поток БД свободен для остальных.
+Пока отметка есть, история чата показывает только сообщения новее границы —
+на случай, если чат с тем же id создан заново.
+
+Место. SQLite не отдаёт освободившиеся страницы сам; при auto_vacuum=
+INCREMENTAL они возвращаются PRAGMA incremental_vacuum порциями по
+RETENTION_VACUUM_PAGES. Новая база создаётся в этом режиме, существующую
+переводит разовый VACUUM: python retention.py vacuum (сервис остановлен).
+"""
+import asyncio
+import gzip
+import hashlib
+import logging
+import os
+import secrets
+import sys
+import time
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import anyio
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+import protocol
+from database import run_db
+from history_cache import history_row
+from message_queue import writer
+from models import (ArchiveSegment, Chat, ChatEvent, ChatPurge, ChatRetention, Message, engine,
+                    message_id_at, next_message_id)
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_ROOT = Path(os.getenv("ARCHIVE_ROOT", "archive"))
+# Политика по умолчанию; 0 дней — не архивировать
+RETENTION_ARCHIVE_AFTER_DAYS = int(os.getenv("RETENTION_ARCHIVE_AFTER_DAYS", "0"))
+RETENTION_KEEP_RECENT = int(os.getenv("RETENTION_KEEP_RECENT", "1000"))
+# Проход архивации; удаление чатов начинается сразу по wake()
+RETENTION_INTERVAL_S = int(os.getenv("RETENTION_INTERVAL_S", "3600"))
+ARCHIVE_SEGMENT_MESSAGES = int(os.getenv("ARCHIVE_SEGMENT_MESSAGES", "1000"))
+ARCHIVE_CACHE_SEGMENTS = int(os.getenv("ARCHIVE_CACHE_SEGMENTS", "32"))
+RETENTION_PURGE_CHUNK = int(os.getenv("RETENTION_PURGE_CHUNK", "2000"))
+RETENTION_VACUUM_PAGES = int(os.getenv("RETENTION_VACUUM_PAGES", "1000"))
+# Сколько чатов проверять на архивацию за один вызов в потоке БД
+RETENTION_CHATS_PER_STEP = 200
+
+AUTO_VACUUM_INCREMENTAL = 2
+
+
+# ====== Политики ======
+def effective_policy(row: Optional[ChatRetention]) -> Dict[str, int]:
+    days = row.archive_after_days if row is not None else None
+    keep = row.keep_recent if row is not None else None
+    return {
+        "archive_after_days": RETENTION_ARCHIVE_AFTER_DAYS if days is None else days,
+        "keep_recent": RETENTION_KEEP_RECENT if keep is None else keep,
+    }
+
+
+def set_policy(db: Session, chat_id: str, archive_after_days: Optional[int], keep_recent: Optional[int]) -> dict:
+    """NULL в поле — значение по умолчанию."""
+    row = db.merge(ChatRetention(chat_id=chat_id, archive_after_days=archive_after_days, keep_recent=keep_recent))
+    db.commit()
+    return {"chat_id": chat_id, **effective_policy(row)}
+
+
+def find_archivable(db: Session, after_chat_id: str, limit: int, now_ms: int) -> Tuple[List[Tuple[str, int]], Optional[str]]:
+    """Чаты после after_chat_id, где есть что архивировать: [(chat_id, архивировать id < этого)], следующий курсор."""
+    chats = [c for (c,) in db.query(Chat.id).filter(Chat.id > after_chat_id).order_by(Chat.id).limit(limit)]
+    policies = {p.chat_id: p for p in db.query(ChatRetention).filter(ChatRetention.chat_id.in_(chats))}
+    result = []
+    for chat_id in chats:
+        policy = effective_policy(policies.get(chat_id))
+        if policy["archive_after_days"] <= 0:
+            continue
+        upto = message_id_at(now_ms - policy["archive_after_days"] * 86400 * 1000)
+        if policy["keep_recent"] > 0:
+            # Самое старое из keep_recent последних — один шаг по индексу (chat_id, id)
+            kept = (
+                db.query(Message.id)
+                .filter(Message.chat_id == chat_id)
+                .order_by(Message.id.desc())
+                .offset(policy["keep_recent"] - 1)
+                .limit(1)
+                .scalar()
+            )
+            if kept is None:
+                continue
+            upto = min(upto, kept)
+        if db.query(Message.id).filter(Message.chat_id == chat_id, Message.id < upto).first() is not None:
+            result.append((chat_id, upto))
+    return result, (chats[-1] if len(chats) == limit else None)
+
+
+# ====== Сегменты ======
+def segment_path(chat_id: str, first_id: int, last_id: int) -> str:
+    digest = hashlib.sha1(chat_id.encode()).hexdigest()
+    # Суффикс — чтобы два узла, архивирующие одно и то же, не писали в один файл
+    return f"{digest[:2]}/{digest}/{first_id}-{last_id}-{secrets.token_hex(4)}.jsonl.gz"
+
+
+def write_segment(path: Path, rows: List[dict]):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    partial = path.with_name(path.name + ".part")
+    with open(partial, "wb") as f:
+        with gzip.GzipFile(fileobj=f, mode="wb", mtime=0) as gz:
+            gz.write("".join(protocol.dumps(row) + "\n" for row in rows).encode())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(partial, path)
+
+
+@lru_cache(maxsize=ARCHIVE_CACHE_SEGMENTS)
+def read_segment(path: str) -> Tuple[dict, ...]:
+    with gzip.open(ARCHIVE_ROOT / path, "rb") as gz:
+        return tuple(protocol.loads(line) for line in gz.read().splitlines() if line)
+
+
+def load_archive_chunk(db: Session, chat_id: str, upto_id: int) -> Optional[Tuple[int, int, List[dict]]]:
+    """До ARCHIVE_SEGMENT_MESSAGES самых старых сообщений чата с id < upto_id: (first_id, last_id, строки)."""
+    rows = (
+        db.query(Message)
+        .filter(Message.chat_id == chat_id, Message.id < upto_id)
+        .order_by(Message.id)
+        .limit(ARCHIVE_SEGMENT_MESSAGES)
+        .all()
+    )
+    if not rows:
+        return None
+    return rows[0].id, rows[-1].id, [history_row(msg) for msg in rows]
+
+
+def commit_archive_chunk(db: Session, chat_id: str, first_id: int, last_id: int, count: int,
+                         relative: str, since_seq: int) -> bool:
+    """Удаляет записанные в сегмент строки. False — их меняли после чтения, сегмент не нужен."""
+    edited = db.query(ChatEvent.seq).filter(
+        ChatEvent.chat_id == chat_id,
+        ChatEvent.seq > since_seq,
+        ChatEvent.message_id >= first_id,
+        ChatEvent.message_id <= last_id
+    ).first()
+    if edited is not None:
+        return False
+    deleted = (
+        db.query(Message)
+        .filter(Message.chat_id == chat_id, Message.id >= first_id, Message.id <= last_id)
+        .delete(synchronize_session=False)
+    )
+    if deleted != count:
+        db.rollback()
+        return False
+    db.add(ArchiveSegment(chat_id=chat_id, first_id=first_id, last_id=last_id, count=count, path=relative))
+    db.commit()
+    return True
+
+
+def segments_before(db: Session, chat_id: str, before_id: int, need: int) -> Tuple[List[dict], bool]:
+    """Сегменты (от новых к старым), из которых набирается need сообщений старше before_id, и есть ли ещё старше."""
+    query = db.query(ArchiveSegment).filter(ArchiveSegment.chat_id == chat_id)
+    if before_id:
+        query = query.filter(ArchiveSegment.first_id < before_id)
+    if need <= 0:
+        return [], query.first() is not None
+    segments = query.order_by(ArchiveSegment.last_id.desc()).limit(need + 1).all()
+    chosen, total = [], 0
+    for segment in segments:
+        if total > need:
+            break
+        chosen.append({"path": segment.path, "first_id": segment.first_id, "last_id": segment.last_id})
+        total += segment.count
+    return chosen, len(chosen) < len(segments)
+
+
+def read_archived(segments: List[dict], before_id: int, need: int, more: bool) -> Tuple[List[dict], bool]:
+    """Блокирующий вызов: (need последних архивных сообщений старше before_id по возрастанию id, has_more)."""
+    rows: List[dict] = []
+    for segment in segments:
+        chunk = [row for row in read_segment(segment["path"]) if not before_id or row["id"] < before_id]
+        rows = chunk + rows
+        if len(rows) > need:
+            break
+    # Копии: кэш истории правит свои строки на месте
+    return [dict(row) for row in rows[-need:]], len(rows) > need or more
+
+
+# ====== Удаление чатов ======
+def schedule_purge(db: Session, chat_id: str):
+    """Вызывается из drop_chat в его транзакции; всё выданное до этого момента будет удалено."""
+    db.query(ChatRetention).filter(ChatRetention.chat_id == chat_id).delete()
+    db.merge(ChatPurge(chat_id=chat_id, before_id=next_message_id()))
+
+
+def purge_watermark(db: Session, chat_id: str) -> int:
+    """Сообщения чата с id меньше этого удалены (0 — ничего не удаляется)."""
+    return db.query(ChatPurge.before_id).filter(ChatPurge.chat_id == chat_id).scalar() or 0
+
+
+def purge_step(db: Session, limit: int) -> Optional[Tuple[int, List[str]]]:
+    """Одна порция: (удалено сообщений, файлы сегментов к удалению) или None, если удалять нечего."""
+    purge = db.query(ChatPurge).order_by(ChatPurge.chat_id).first()
+    if purge is None:
+        return None
+    ids = [
+        i for (i,) in db.query(Message.id)
+        .filter(Message.chat_id == purge.chat_id, Message.id < purge.before_id)
+        .limit(limit)
+    ]
+    if ids:
+        db.query(Message).filter(Message.id.in_(ids)).delete(synchronize_session=False)
+        db.commit()
+        return len(ids), []
+    # Сообщений не осталось: архив и журнал, затем сама отметка
+    segments = db.query(ArchiveSegment).filter(
+        ArchiveSegment.chat_id == purge.chat_id, ArchiveSegment.last_id < purge.before_id
+    )
+    paths = [str(ARCHIVE_ROOT / s.path) for s in segments]
+    segments.delete(synchronize_session=False)
+    db.query(ChatEvent).filter(
+        ChatEvent.chat_id == purge.chat_id, ChatEvent.seq < purge.before_id
+    ).delete(synchronize_session=False)
+    db.delete(purge)
+    db.commit()
+    return 0, paths
+
+
+# ====== Место в файле БД ======
+def auto_vacuum_mode(db: Session) -> int:
+    return db.execute(text("PRAGMA auto_vacuum")).scalar()
+
+
+def vacuum_step(db: Session, pages: int) -> int:
+    """Возвращает до pages свободных страниц файлу; 0 — свободных нет."""
+    free = db.execute(text("PRAGMA freelist_count")).scalar()
+    if not free:
+        return 0
+    db.commit()
+    # incremental_vacuum освобождает по странице на шаг, а execute в sqlite3 делает один шаг;
+    # executescript выполняет оператор до конца
+    db.connection().connection.driver_connection.executescript(f"PRAGMA incremental_vacuum({int(pages)})")
+    return min(free, pages)
+
+
+class RetentionWorker:
+    def __init__(self, manager, interval_s: int = RETENTION_INTERVAL_S):
+        self.manager = manager
+        self.interval = interval_s
+        self.incremental = False
+        self.counters = {"archived_messages": 0, "archive_segments": 0, "purged_messages": 0, "vacuumed_pages": 0}
+        self._task: Optional[asyncio.Task] = None
+        self._wake: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    async def start(self):
+        if self._task is not None:
+            return
+        self.incremental = await run_db(auto_vacuum_mode) == AUTO_VACUUM_INCREMENTAL
+        if not self.incremental:
+            logger.warning("chat.db is not in auto_vacuum=INCREMENTAL mode, freed pages stay in the file; "
+                           "run `python retention.py vacuum` once with the service stopped")
+        self._loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def wake(self):
+        """Начать удаление чатов сейчас. Можно звать из потока обработчика HTTP."""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wake.set)
+
+    def stats(self) -> dict:
+        return {**self.counters, "incremental_vacuum": self.incremental}
+
+    async def _run(self):
+        next_archive = time.monotonic()
+        while True:
+            self._wake.clear()
+            try:
+                await self.purge()
+                if time.monotonic() >= next_archive:
+                    next_archive = time.monotonic() + self.interval
+                    await self.archive()
+                await self.vacuum()
+            except Exception:
+                logger.exception("retention pass failed")
+            try:
+                await asyncio.wait_for(self._wake.wait(), max(0.0, next_archive - time.monotonic()))
+            except asyncio.TimeoutError:
+                pass
+
+    async def purge(self):
+        # Сообщения удаляемых чатов из write-behind очереди должны попасть под удаление
+        await writer.flush()
+        while True:
+            step = await run_db(purge_step, RETENTION_PURGE_CHUNK)
+            if step is None:
+                return
+            deleted, paths = step
+            self.counters["purged_messages"] += deleted
+            for path in paths:
+                await anyio.Path(path).unlink(missing_ok=True)
+
+    async def archive(self):
+        now_ms = int(time.time() * 1000)
+        after: Optional[str] = ""
+        while after is not None:
+            chats, after = await run_db(find_archivable, after, RETENTION_CHATS_PER_STEP, now_ms)
+            for chat_id, upto_id in chats:
+                archived = 0
+                while True:
+                    count = await self.archive_chunk(chat_id, upto_id)
+                    if not count:
+                        break
+                    archived += count
+                    self.counters["archive_segments"] += 1
+                if archived:
+                    self.counters["archived_messages"] += archived
+                    # Буферы кэша истории считали эти сообщения полной историей чата
+                    self.manager.invalidate_chat(chat_id)
+
+    async def archive_chunk(self, chat_id: str, upto_id: int) -> int:
+        # Правки и удаления, поставленные в очередь до этой точки, попадут в БД до чтения;
+        # более поздние найдутся в chat_events по seq
+        since_seq = next_message_id()
+        await writer.flush()
+        chunk = await run_db(load_archive_chunk, chat_id, upto_id)
+        if chunk is None:
+            return 0
+        first_id, last_id, rows = chunk
+        relative = segment_path(chat_id, first_id, last_id)
+        # gzip и fsync — вне потока БД, он в это время обслуживает остальных
+        await anyio.to_thread.run_sync(write_segment, ARCHIVE_ROOT / relative, rows)
+        if not await run_db(commit_archive_chunk, chat_id, first_id, last_id, len(rows), relative, since_seq):
+            # Чат изменился между чтением и удалением — попробуем на следующем проходе
+            await anyio.Path(ARCHIVE_ROOT / relative).unlink(missing_ok=True)
+            return 0
+        return len(rows)
+
+    async def vacuum(self):
+        if not self.incremental:
+            return
+        while True:
+            pages = await run_db(vacuum_step, RETENTION_VACUUM_PAGES)
+            if not pages:
+                return
+            self.counters["vacuumed_pages"] += pages
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["vacuum"]:
+        raise SystemExit("usage: python retention.py vacuum")
+    # Разовый перевод существующей базы в auto_vacuum=INCREMENTAL (переписывает файл целиком)
+    with engine.connect() as connection:
+        connection.exec_driver_sql("PRAGMA auto_vacuum=INCREMENTAL")
+        connection.exec_driver_sql("VACUUM")
+        mode = connection.exec_driver_sql("PRAGMA auto_vacuum").scalar()
+    print(f"auto_vacuum={mode}")
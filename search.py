@@ -0,0 +1,264 @@
+# search.py
+"""Полнотекстовый поиск по сообщениям (SQLite FTS5).
+
+messages_fts — external content поверх представления messages_fts_source:
+сам текст хранится только в messages, в индексе — токены текста и chat_key
+(один токен на чат). Поэтому условие «только мои чаты» FTS5 проверяет сам,
+пересекая списки токенов, и не читает строки сообщений, не попавшие в ответ.
+Индекс поддерживают триггеры на messages: вставка, правка текста, удаление
+(в том числе удаление чата целиком).
+"""
+import html
+import math
+import re
+import unicodedata
+from typing import List, Optional, Tuple
+
+from fastapi import APIRouter, Depends
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from auth import current_user, require_self
+from database import get_db
+from models import ChatMember, Message
+
+router = APIRouter()
+
+SEARCH_PAGE_SIZE = 20
+SEARCH_PAGE_MAX = 100
+# Сколько слов запроса учитываем и с какой длины последнее слово ищем как префикс
+MAX_QUERY_TERMS = 8
+PREFIX_MIN_LENGTH = 3
+# Ранжируем не больше стольких самых свежих совпадений
+SEARCH_MAX_CANDIDATES = 2000
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Длина сниппета в словах
+SNIPPET_TOKENS = 12
+
+SCHEMA = [
+    """
+    CREATE VIEW IF NOT EXISTS messages_fts_source AS
+    SELECT id, text, 'c' || hex(chat_id) AS chat_key FROM messages
+    """,
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+        text, chat_key,
+        content='messages_fts_source', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts(rowid, text, chat_key)
+        VALUES (new.id, new.text, 'c' || hex(new.chat_id));
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, text, chat_key)
+        VALUES ('delete', old.id, old.text, 'c' || hex(old.chat_id));
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF text, chat_id ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, text, chat_key)
+        VALUES ('delete', old.id, old.text, 'c' || hex(old.chat_id));
+        INSERT INTO messages_fts(rowid, text, chat_key)
+        VALUES (new.id, new.text, 'c' || hex(new.chat_id));
+    END
+    """,
+]
+
+
+def install(db: Session):
+    """Создаёт индекс и триггеры и индексирует уже существующие сообщения."""
+    for statement in SCHEMA:
+        db.execute(text(statement))
+    db.execute(text("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')"))
+
+
+def chat_key(chat_id: str) -> str:
+    return "c" + chat_id.encode("utf-8").hex().upper()
+
+
+def _latin_fold_table():
+    # Как remove_diacritics у unicode61: é -> e, ñ -> n; кириллица (й, ё) не меняется
+    table = {}
+    for code in range(0xC0, 0x250):
+        decomposed = unicodedata.normalize("NFD", chr(code))
+        if len(decomposed) > 1 and decomposed[0].isascii() and all(unicodedata.combining(c) for c in decomposed[1:]):
+            table[code] = decomposed[0]
+    return table
+
+
+_LATIN_FOLD = _latin_fold_table()
+_TOKEN_RE = re.compile(r"[^\W_]+")
+
+
+_QUERY_TERM_RE = re.compile(r"([^\W_]+)(\*?)")
+
+
+def tokenize(value: str) -> List[str]:
+    """Токены так же, как их видит FTS5 (unicode61 remove_diacritics 2)."""
+    return _TOKEN_RE.findall(fold(value))
+
+
+def fold(token: str) -> str:
+    return token.lower().translate(_LATIN_FOLD)
+
+
+def query_terms(query: str) -> List[Tuple[str, bool]]:
+    """(слово, искать как префикс). Префикс — только если пользователь сам поставил «*»:
+    без префиксного индекса FTS5 перебирает все слова с этим началом, на частых — сотни мс."""
+    terms = []
+    for match in _QUERY_TERM_RE.finditer(query):
+        word = fold(match.group(1))
+        terms.append((word, bool(match.group(2)) and len(word) >= PREFIX_MIN_LENGTH))
+    return terms[:MAX_QUERY_TERMS]
+
+
+def build_match(terms: List[Tuple[str, bool]]) -> str:
+    """Синтаксис FTS5 из ввода не пропускаем: каждое слово в кавычках, между словами AND."""
+    return "text : (" + " ".join(f'"{word}"' + ("*" if prefix else "") for word, prefix in terms) + ")"
+
+
+def _term_matches(token: str, terms: List[Tuple[str, bool]]) -> bool:
+    return any(token.startswith(word) if prefix else token == word for word, prefix in terms)
+
+
+def make_snippet(value: str, terms: List[Tuple[str, bool]], size: int = SNIPPET_TOKENS) -> str:
+    """Фрагмент текста вокруг первого совпадения, совпадения в <mark>; результат — готовый HTML.
+    Строим по уже загруженному тексту: snippet() FTS5 заново вычислял бы MATCH для каждой строки."""
+    tokens = list(_TOKEN_RE.finditer(value))
+    hits = {i for i, token in enumerate(tokens) if _term_matches(fold(token.group()), terms)}
+    if not tokens:
+        return html.escape(value)
+    first = min(hits) if hits else 0
+    start = max(0, min(first - size // 4, len(tokens) - size))
+    end = min(len(tokens), start + size)
+
+    parts = ["…"] if start > 0 else []
+    position = tokens[start].start() if start > 0 else 0
+    for i in range(start, end):
+        token = tokens[i]
+        parts.append(html.escape(value[position:token.start()]))
+        word = html.escape(token.group())
+        parts.append(f"<mark>{word}</mark>" if i in hits else word)
+        position = token.end()
+    if end < len(tokens):
+        parts.append("…")
+    else:
+        parts.append(html.escape(value[position:]))
+    return "".join(parts)
+
+
+def _count(db: Session, match: str) -> int:
+    return db.execute(text("SELECT count(*) FROM messages_fts WHERE messages_fts MATCH :match"),
+                      {"match": match}).scalar()
+
+
+def rank_bm25(db: Session, rows, terms: List[Tuple[str, bool]], scope: str, complete: bool):
+    """BM25 по чатам пользователя. Встроенный bm25() FTS5 для idf проходит весь список
+    документов каждого слова по всей базе — на частых словах это сотни миллисекунд.
+    Здесь коллекция — только чаты пользователя: df считается запросом с тем же
+    ограничением по chat_key, а tf и длины берутся из текстов кандидатов."""
+    docs = [(row, tokenize(row.text or "")) for row in rows]
+    total = _count(db, scope)
+    avgdl = (sum(len(tokens) for _, tokens in docs) / len(docs)) or 1.0
+
+    idf = {}
+    for word, prefix in terms:
+        if len(terms) == 1 and complete:
+            df = len(docs)
+        else:
+            df = _count(db, f"{build_match([(word, prefix)])} AND {scope}")
+        idf[word] = math.log((total - df + 0.5) / (df + 0.5) + 1)
+
+    scored = []
+    for row, tokens in docs:
+        length = len(tokens)
+        score = 0.0
+        for word, prefix in terms:
+            if prefix:
+                tf = sum(1 for token in tokens if token.startswith(word))
+            else:
+                tf = tokens.count(word)
+            if tf:
+                score += idf[word] * tf * (BM25_K1 + 1) / (tf + BM25_K1 * (1 - BM25_B + BM25_B * length / avgdl))
+        scored.append((score, row))
+    scored.sort(key=lambda item: (-item[0], -item[1].id))
+    return scored
+
+
+def search_messages(db: Session, username: str, query: str, limit: int, offset: int,
+                    chat_id: Optional[str] = None):
+    terms = query_terms(query)
+    if not terms:
+        return [], False
+
+    chats_query = db.query(ChatMember.chat_id).filter(ChatMember.username == username)
+    if chat_id:
+        chats_query = chats_query.filter(ChatMember.chat_id == chat_id)
+    chat_ids = [row.chat_id for row in chats_query]
+    if not chat_ids:
+        return [], False
+    text_match = build_match(terms)
+    scope = "chat_key : (" + " OR ".join(chat_key(c) for c in chat_ids) + ")"
+
+    # 1) Кандидаты: пересечение слов и чатов делает FTS5. Обычно их меньше лимита и
+    # порядок не важен (прямой обход быстрее); если больше — берём самые свежие
+    match = f"{text_match} AND {scope}"
+    candidate_query = "SELECT rowid FROM messages_fts WHERE messages_fts MATCH :match"
+    params = {"match": match, "cap": SEARCH_MAX_CANDIDATES}
+    candidate_ids = [row[0] for row in db.execute(text(candidate_query + " LIMIT :cap"), params)]
+    if not candidate_ids:
+        return [], False
+    complete = len(candidate_ids) < SEARCH_MAX_CANDIDATES
+    if not complete:
+        candidate_ids = [row[0] for row in db.execute(
+            text(candidate_query + " ORDER BY rowid DESC LIMIT :cap"), params)]
+    rows = db.query(
+        Message.id, Message.username, Message.chat_id, Message.timestamp, Message.text
+    ).filter(Message.id.in_(candidate_ids)).all()
+
+    # 2) Ранжирование и страница
+    scored = rank_bm25(db, rows, terms, scope, complete)
+    page = scored[offset:offset + limit]
+    has_more = len(scored) > offset + limit
+
+    results: List[dict] = []
+    for score, row in page:
+        results.append({
+            "id": row.id,
+            "chat_id": row.chat_id,
+            "username": row.username,
+            "timestamp": row.timestamp.isoformat() + "Z",
+            "snippet": make_snippet(row.text or "", terms),
+            "score": round(score, 4),
+        })
+    return results, has_more
+
+
+@router.get("/api/search")
+def api_search(
+    username: str,
+    q: str,
+    chat_id: Optional[str] = None,
+    limit: int = SEARCH_PAGE_SIZE,
+    offset: int = 0,
+    user: str = Depends(current_user),
+    db: Session = Depends(get_db)
+):
+    require_self(username, user)
+    limit = max(1, min(limit, SEARCH_PAGE_MAX))
+    offset = max(0, offset)
+    results, has_more = search_messages(db, username, q, limit, offset, chat_id)
+    return {
+        "results": results,
+        "limit": limit,
+        "offset": offset,
+        "has_more": has_more,
+        "next_offset": offset + len(results) if has_more else None,
+    }
@@ -4,8 +4,32 @@ let currentChatId = "";
 let username = "";
 let isTyping = false;
 let typingTimer = null;
+let typingSentAt = 0;
+const TYPING_REFRESH_MS = 3000;
 let pendingChatToLoad = null;
 let editingMessageId = null;
+// Пагинация истории: id самого старого загруженного сообщения и есть ли ещё старее
+let oldestMessageId = null;
+let hasMoreHistory = false;
+let loadingOlder = false;
+// Догоняющая синхронизация: последнее увиденное сообщение и позиция журнала правок/удалений
+let lastMessageId = null;
+let lastEventSeq = 0;
+// Переподключение с экспоненциальной задержкой
+const RECONNECT_MIN_MS = 1000;
+const RECONNECT_MAX_MS = 30000;
+let reconnectDelay = RECONNECT_MIN_MS;
+let wasConnected = false;
+// Онлайн-статус собеседников из личных чатов: username -> true/false
+const presenceState = {};
+// Отправленные, но не подтверждённые сервером кадры: client_id -> кадр (повторяются после переподключения)
+const pendingSends = new Map();
+// Курсоры участников открытого чата: username -> {delivered, read}
+let chatReceipts = {};
+// Отметки о доставке копятся и уходят одним кадром на чат
+const DELIVERED_DELAY_MS = 500;
+const deliveredQueue = {};
+let deliveredTimer = null;
 
 // Берём имя пользователя из глобального window.appUsername, установленного в chat.html
 username = window.appUsername || document.getElementById('current-username').textContent;
@@ -49,10 +73,7 @@ async function loadUserChats() {
                     groupChatsList.appendChild(chatItem);
                 }
                 chatItem.dataset.chatId = chat.chat_id;
-                chatItem.innerHTML = `
-                    👥 ${chat.name}
-                    <span class="status-dot" style="float: right; width: 10px; height: 10px; border-radius: 50%; background: gray;"></span>
-                `;
+                renderChatItem(chatItem, `👥 ${chat.name}`, chat);
 
                 // Если этот чат сейчас активен и в заголовке было временное имя — обновим его
                 if (currentChatId === chat.chat_id) {
@@ -73,10 +94,7 @@ async function loadUserChats() {
                     privateChatsList.appendChild(chatItem);
                 }
                 chatItem.dataset.chatId = chat.chat_id;
-                chatItem.innerHTML = `
-                    💬 С ${chat.name}
-                    <span class="status-dot" style="float: right; width: 10px; height: 10px; border-radius: 50%; background: gray;"></span>
-                `;
+                renderChatItem(chatItem, `💬 С ${chat.name}`, chat);
 
                 if (currentChatId === chat.chat_id) {
                     document.getElementById('chat-header').textContent = `💬 С ${chat.name}`;
@@ -84,12 +102,90 @@ async function loadUserChats() {
             });
         }
 
+        await loadPresence(data.private_chats.map(chat => chat.name));
+
     } catch (err) {
         console.error("Ошибка загрузки списка чатов:", err);
     }
 }
 
-function initChat() {
+// Один запрос на весь список, дальше статус обновляют события presence по WebSocket
+async function loadPresence(usernames) {
+    if (usernames.length === 0) return;
+    const response = await fetch(`/api/presence?usernames=${encodeURIComponent(usernames.join(','))}`);
+    const data = await response.json();
+    Object.entries(data.presence || {}).forEach(([name, status]) => updatePresence(name, status.online));
+}
+
+function updatePresence(name, online) {
+    presenceState[name] = online;
+    document.querySelectorAll('.chat-item[data-peer]').forEach(chatItem => {
+        if (chatItem.dataset.peer === name) setStatusDot(chatItem, online);
+    });
+}
+
+function setStatusDot(chatItem, online) {
+    const dot = chatItem.querySelector('.status-dot');
+    if (!dot) return;
+    dot.style.background = online ? '#2ecc71' : 'gray';
+    dot.title = online ? 'В сети' : 'Не в сети';
+}
+
+// Элемент списка чатов: название, превью последнего сообщения и счётчик непрочитанных
+function renderChatItem(chatItem, title, chat) {
+    chatItem.innerHTML = `
+        <div class="chat-item-body">
+            <div class="chat-item-title"></div>
+            <div class="chat-item-preview"></div>
+        </div>
+        <span class="unread-badge" style="display:none;"></span>
+        <span class="status-dot" style="float: right; width: 10px; height: 10px; border-radius: 50%; background: gray;"></span>
+    `;
+    if (chat.type === 'private') {
+        chatItem.dataset.peer = chat.name;
+        setStatusDot(chatItem, presenceState[chat.name]);
+    } else {
+        chatItem.querySelector('.status-dot').style.display = 'none';
+    }
+    chatItem.querySelector('.chat-item-title').textContent = title;
+    const last = chat.last_message;
+    if (last) {
+        const text = (last.text || '').startsWith('[file] ') ? '📎 Файл' : last.text;
+        const author = last.username === 'system' ? '' : `${last.username}: `;
+        chatItem.querySelector('.chat-item-preview').textContent = author + text;
+    }
+    setUnreadBadge(chatItem, chat.chat_id === currentChatId ? 0 : (chat.unread_count || 0));
+}
+
+function setUnreadBadge(chatItem, count) {
+    const badge = chatItem && chatItem.querySelector('.unread-badge');
+    if (!badge) return;
+    badge.dataset.count = count;
+    badge.textContent = count > 99 ? '99+' : String(count);
+    badge.style.display = count > 0 ? 'inline-block' : 'none';
+}
+
+function updateChatPreview(msg) {
+    const chatItem = document.querySelector(`.chat-item[data-chat-id="${msg.chat_id}"]`);
+    if (!chatItem) return;
+    const preview = chatItem.querySelector('.chat-item-preview');
+    if (preview) {
+        const text = msg.attachment ? '📎 Файл' : msg.text;
+        preview.textContent = `${msg.username}: ${text}`;
+    }
+    if (msg.chat_id !== currentChatId && msg.username !== username) {
+        const badge = chatItem.querySelector('.unread-badge');
+        setUnreadBadge(chatItem, (parseInt(badge && badge.dataset.count, 10) || 0) + 1);
+    }
+}
+
+function markChatRead(chatId, messageId) {
+    if (!ws || ws.readyState !== WebSocket.OPEN || !chatId) return;
+    ws.send(JSON.stringify({ type: "mark_read", chat_id: chatId, message_id: messageId || 0 }));
+    setUnreadBadge(document.querySelector(`.chat-item[data-chat-id="${chatId}"]`), 0);
+}
+
+function connectSocket() {
     const wsHost = window.location.host;
     ws = new WebSocket(`ws://${wsHost}/ws/${username}`);
 
@@ -104,13 +200,28 @@ function initChat() {
         };
 
         if (data.type === "history") {
+            if (data.before_id) {
+                // Догрузка старых сообщений при прокрутке вверх
+                if (data.chat_id !== currentChatId) return;
+                prependHistoryPage(data);
+                return;
+            }
+
             chatBox.innerHTML = '';
-            
+            oldestMessageId = data.messages.length ? data.messages[0].id : null;
+            lastMessageId = data.messages.length ? data.messages[data.messages.length - 1].id : 0;
+            lastEventSeq = data.seq || 0;
+            hasMoreHistory = !!data.has_more;
+            loadingOlder = false;
+
             if (!currentChatId) {
                 chatBox.innerHTML = '<em>Выберите чат слева</em>';
                 return;
             }
 
+            chatReceipts = data.receipts || {};
+            markChatRead(data.chat_id, lastMessageId);
+
             if (data.messages.length === 0) {
                 chatBox.innerHTML = '<em>В этом чате пока нет сообщений</em>';
                 return;
@@ -123,21 +234,19 @@ function initChat() {
             chatBox.scrollTop = chatBox.scrollHeight;
 
         } else if (data.type === "message") {
+            updateChatPreview(data);
             if (data.chat_id === currentChatId) {
+                noteMessageId(data.id);
                 const row = renderMessageRow(data);
                 chatBox.appendChild(row);
                 chatBox.scrollTop = chatBox.scrollHeight;
+                if (data.username !== username) markChatRead(data.chat_id, data.id);
+            } else if (data.username !== username) {
+                queueDelivered(data.chat_id, data.id);
             }
         } else if (data.type === 'message_edited') {
-            const el = document.querySelector(`[data-message-id="${data.message_id}"] .msg-text`);
-            if (el) el.textContent = data.text;
-            const container = document.querySelector(`[data-message-id="${data.message_id}"]`);
-            if (container && !container.querySelector('.edited-mark')) {
-                const mark = document.createElement('span');
-                mark.className = 'edited-mark';
-                mark.textContent = '(edited)';
-                container.querySelector('p').appendChild(mark);
-            }
+            if (data.chat_id === currentChatId) noteEventSeq(data.seq);
+            applyEdit(data.message_id, data.text);
             if (editingMessageId === String(data.message_id)) {
                 // Exit edit mode if this was our edit
                 editingMessageId = null;
@@ -147,20 +256,51 @@ function initChat() {
                 document.getElementById('send').textContent = 'Отправить';
             }
         } else if (data.type === 'message_deleted') {
-            const container = document.querySelector(`[data-message-id="${data.message_id}"]`);
-            if (container && container.parentElement) container.parentElement.removeChild(container);
+            if (data.chat_id === currentChatId) noteEventSeq(data.seq);
+            applyDelete(data.message_id);
+        } else if (data.type === "sync") {
+            if (data.chat_id === currentChatId) applySync(data);
         } else if (data.type === "attachment") {
+            const msg = {
+                id: data.id || '',
+                client_id: data.client_id,
+                username: data.username,
+                chat_id: data.chat_id,
+                timestamp: data.timestamp,
+                attachment: { url: data.url, filename: data.filename, is_image: data.is_image }
+            };
+            updateChatPreview(msg);
             if (data.chat_id === currentChatId) {
-                const msg = {
-                    id: data.id || '',
-                    username: data.username,
-                    timestamp: data.timestamp,
-                    attachment: { url: data.url, filename: data.filename, is_image: data.is_image }
-                };
+                noteMessageId(data.id);
                 const row = renderMessageRow(msg);
                 chatBox.appendChild(row);
                 chatBox.scrollTop = chatBox.scrollHeight;
+                if (data.username !== username) markChatRead(data.chat_id, data.id);
+            } else if (data.username !== username) {
+                queueDelivered(data.chat_id, data.id);
             }
+        } else if (data.type === "ack") {
+            data.messages.forEach(ack => {
+                pendingSends.delete(ack.client_id);
+                const row = chatBox.querySelector(`[data-message-id="${ack.id}"]`);
+                if (row && row.dataset.pending) {
+                    delete row.dataset.pending;
+                    updateMessageStatus(row);
+                }
+            });
+        } else if (data.type === "error") {
+            // База была занята: запрос истории повторим позже
+            if (data.chat_id === currentChatId) {
+                setTimeout(() => retryChatRequest(data.event, data.chat_id), data.retry_after * 1000);
+            }
+        } else if (data.type === "nack") {
+            // Сервер не смог записать сообщение: повторять бесполезно
+            data.messages.forEach(nack => pendingSends.delete(nack.client_id));
+            showSendFailed();
+        } else if (data.type === "receipts") {
+            if (data.chat_id === currentChatId) applyReceipts(data.receipts);
+        } else if (data.type === "presence") {
+            updatePresence(data.username, data.online);
         } else if (data.type === "typing") {
             if (data.chat_id === currentChatId) {
                 const users = data.users.filter(u => u !== username);
@@ -171,22 +311,204 @@ function initChat() {
                     typingIndicator.style.display = 'none';
                 }
             }
+        } else if (data.type === "rate_limited") {
+            showRateLimited(data.retry_after);
+            // Отброшенное сообщение отправим ещё раз, когда лимит восстановится
+            if (data.event === "message" || data.event === "attachment") {
+                setTimeout(resendPending, Math.max(1000, data.retry_after * 1000));
+            }
         }
     };
 
     ws.onopen = function() {
         console.log("✅ WebSocket подключён");
+        reconnectDelay = RECONNECT_MIN_MS;
         // Если пользователь выбрал чат до открытия сокета — загружаем его сейчас
         if (pendingChatToLoad) {
             ws.send(JSON.stringify({ type: "load_chat", chat_id: pendingChatToLoad }));
             pendingChatToLoad = null;
+        } else if (wasConnected && currentChatId && lastMessageId !== null) {
+            // После обрыва — только то, что пропустили, а не вся история заново
+            ws.send(JSON.stringify({
+                type: "sync",
+                chat_id: currentChatId,
+                since_id: lastMessageId,
+                since_seq: lastEventSeq
+            }));
         }
+        if (wasConnected) {
+            loadUserChats();
+            // Неподтверждённые сообщения: сервер не создаст дубль, если уже принял их
+            resendPending();
+        }
+        flushDelivered();
+        wasConnected = true;
     };
 
     ws.onerror = function(err) {
         console.error("❌ Ошибка WebSocket:", err);
     };
 
+    ws.onclose = function() {
+        const delay = reconnectDelay + Math.random() * reconnectDelay / 2;
+        reconnectDelay = Math.min(reconnectDelay * 2, RECONNECT_MAX_MS);
+        console.log(`WebSocket закрыт, переподключение через ${Math.round(delay)} мс`);
+        setTimeout(connectSocket, delay);
+    };
+}
+
+let rateLimitTimer = null;
+
+function showRateLimited(retryAfter) {
+    // Сервер отбросил кадр: сообщение не отправлено
+    const status = document.getElementById('user-status');
+    status.textContent = '⏳ Слишком часто, подождите';
+    clearTimeout(rateLimitTimer);
+    rateLimitTimer = setTimeout(() => {
+        status.textContent = '🌐 онлайн';
+    }, Math.max(1000, retryAfter * 1000));
+}
+
+function retryChatRequest(event, chatId) {
+    if (!ws || ws.readyState !== WebSocket.OPEN || chatId !== currentChatId) return;
+    if (event === "sync" && lastMessageId !== null) {
+        ws.send(JSON.stringify({ type: "sync", chat_id: chatId, since_id: lastMessageId, since_seq: lastEventSeq }));
+    } else {
+        ws.send(JSON.stringify({ type: "load_chat", chat_id: chatId }));
+    }
+}
+
+function showSendFailed() {
+    const status = document.getElementById('user-status');
+    status.textContent = '⚠️ Сообщение не отправлено';
+    clearTimeout(rateLimitTimer);
+    rateLimitTimer = setTimeout(() => {
+        status.textContent = '🌐 онлайн';
+    }, 3000);
+}
+
+function newClientId() {
+    if (window.crypto && crypto.randomUUID) return crypto.randomUUID();
+    return Date.now().toString(36) + Math.random().toString(36).slice(2, 12);
+}
+
+function sendTracked(frame) {
+    frame.client_id = newClientId();
+    pendingSends.set(frame.client_id, frame);
+    if (ws && ws.readyState === WebSocket.OPEN) ws.send(JSON.stringify(frame));
+}
+
+function resendPending() {
+    if (!ws || ws.readyState !== WebSocket.OPEN) return;
+    pendingSends.forEach(frame => ws.send(JSON.stringify({ ...frame, retry: true })));
+}
+
+function queueDelivered(chatId, messageId) {
+    if (!messageId) return;
+    if (!deliveredQueue[chatId] || messageId > deliveredQueue[chatId]) deliveredQueue[chatId] = messageId;
+    if (!deliveredTimer) deliveredTimer = setTimeout(flushDelivered, DELIVERED_DELAY_MS);
+}
+
+function flushDelivered() {
+    clearTimeout(deliveredTimer);
+    deliveredTimer = null;
+    // Без соединения очередь ждёт следующего onopen
+    if (!ws || ws.readyState !== WebSocket.OPEN) return;
+    Object.keys(deliveredQueue).forEach(chatId => {
+        ws.send(JSON.stringify({ type: "delivered", chat_id: chatId, message_id: deliveredQueue[chatId] }));
+        delete deliveredQueue[chatId];
+    });
+}
+
+function applyReceipts(receipts) {
+    Object.entries(receipts).forEach(([name, cursor]) => {
+        const current = chatReceipts[name] || { delivered: 0, read: 0 };
+        chatReceipts[name] = {
+            delivered: Math.max(current.delivered, cursor.delivered),
+            read: Math.max(current.read, cursor.read)
+        };
+    });
+    chatBox.querySelectorAll('[data-own="1"]').forEach(updateMessageStatus);
+}
+
+function updateMessageStatus(row) {
+    const status = row.querySelector('.msg-status');
+    if (!status) return;
+    const id = Number(row.dataset.messageId);
+    const others = Object.entries(chatReceipts).filter(([name]) => name !== username);
+    const readers = others.filter(([, cursor]) => cursor.read >= id).map(([name]) => name);
+    const delivered = others.some(([, cursor]) => cursor.delivered >= id);
+    status.classList.toggle('read', readers.length > 0);
+    if (row.dataset.pending) {
+        status.textContent = '🕓';
+        status.title = 'Отправляется';
+    } else if (readers.length) {
+        // В группе — сколько участников прочитали
+        status.textContent = others.length > 1 ? `✓✓ ${readers.length}` : '✓✓';
+        status.title = `Прочитано: ${readers.join(', ')}`;
+    } else if (delivered) {
+        status.textContent = '✓✓';
+        status.title = 'Доставлено';
+    } else {
+        status.textContent = '✓';
+        status.title = 'Сохранено';
+    }
+}
+
+function noteMessageId(id) {
+    if (id && (lastMessageId === null || id > lastMessageId)) lastMessageId = id;
+}
+
+function noteEventSeq(seq) {
+    if (seq && seq > lastEventSeq) lastEventSeq = seq;
+}
+
+function applyEdit(messageId, text) {
+    const el = document.querySelector(`[data-message-id="${messageId}"] .msg-text`);
+    if (el) el.textContent = text;
+    const container = document.querySelector(`[data-message-id="${messageId}"]`);
+    if (container && !container.querySelector('.edited-mark')) {
+        const mark = document.createElement('span');
+        mark.className = 'edited-mark';
+        mark.textContent = '(edited)';
+        container.querySelector('p').appendChild(mark);
+    }
+}
+
+function applyDelete(messageId) {
+    const container = document.querySelector(`[data-message-id="${messageId}"]`);
+    if (container && container.parentElement) container.parentElement.removeChild(container);
+}
+
+function applySync(data) {
+    if (data.reset) {
+        // Пропущено слишком много — загружаем чат заново
+        ws.send(JSON.stringify({ type: "load_chat", chat_id: currentChatId }));
+        return;
+    }
+    const placeholder = chatBox.querySelector('em');
+    if (placeholder && data.messages.length) chatBox.innerHTML = '';
+    data.messages.forEach(msg => {
+        // Ответ берётся с запасом — уже показанные сообщения пропускаем
+        if (!document.querySelector(`[data-message-id="${msg.id}"]`)) {
+            chatBox.appendChild(renderMessageRow(msg));
+        }
+        noteMessageId(msg.id);
+    });
+    data.events.forEach(event => {
+        if (event.kind === 'edit') applyEdit(event.message_id, event.text);
+        else applyDelete(event.message_id);
+    });
+    noteEventSeq(data.seq);
+    if (data.messages.length) {
+        chatBox.scrollTop = chatBox.scrollHeight;
+        markChatRead(currentChatId, lastMessageId);
+    }
+}
+
+function initChat() {
+    connectSocket();
+
     const groupList = document.getElementById('group-chats-list');
     const privateList = document.getElementById('private-chats-list');
     contextMenu = document.getElementById('chat-context-menu');
@@ -226,6 +548,27 @@ function initChat() {
     }
 }
 
+function prependHistoryPage(data) {
+    loadingOlder = false;
+    hasMoreHistory = !!data.has_more;
+    if (data.messages.length === 0) return;
+    oldestMessageId = data.messages[0].id;
+
+    // Сохраняем позицию прокрутки, чтобы вставка сверху не сдвигала видимые сообщения
+    const prevHeight = chatBox.scrollHeight;
+    const fragment = document.createDocumentFragment();
+    data.messages.forEach(msg => fragment.appendChild(renderMessageRow(msg)));
+    chatBox.insertBefore(fragment, chatBox.firstChild);
+    chatBox.scrollTop += chatBox.scrollHeight - prevHeight;
+}
+
+function loadOlderMessages() {
+    if (!hasMoreHistory || loadingOlder || !oldestMessageId || !currentChatId) return;
+    if (!ws || ws.readyState !== WebSocket.OPEN) return;
+    loadingOlder = true;
+    ws.send(JSON.stringify({ type: "load_chat", chat_id: currentChatId, before_id: oldestMessageId }));
+}
+
 function handleChatItemClick(e) {
     if (e.target.classList.contains('chat-item') || e.target.closest('.chat-item')) {
         const chatItem = e.target.closest('.chat-item');
@@ -244,7 +587,7 @@ function sendMessage() {
     if (editingMessageId) {
         ws.send(JSON.stringify({ type: 'edit_message', message_id: editingMessageId, text }));
     } else {
-        ws.send(JSON.stringify({ text, chat_id: currentChatId }));
+        sendTracked({ text, chat_id: currentChatId });
     }
     input.value = '';
     input.placeholder = 'Введите сообщение';
@@ -278,14 +621,12 @@ function loadChat(chatId) {
             chatItem = document.createElement('div');
             chatItem.className = 'chat-item';
             chatItem.dataset.chatId = chatId;
-            chatItem.innerHTML = `
-                👥 ${groupName}
-                <span class="status-dot" style="float: right; width: 10px; height: 10px; border-radius: 50%; background: gray;"></span>
-            `;
+            renderChatItem(chatItem, `👥 ${groupName}`, { chat_id: chatId });
             groupChatsList.appendChild(chatItem);
         }
 
-        const fullText = chatItem.textContent.trim();
+        const title = chatItem.querySelector('.chat-item-title');
+        const fullText = (title || chatItem).textContent.trim();
         const cleanText = fullText.replace(/\s*●\s*$/, '');
         header.textContent = cleanText;
     } else {
@@ -308,6 +649,12 @@ function loadChat(chatId) {
     }
 
     chatBox.innerHTML = '<em>Загрузка...</em>';
+    oldestMessageId = null;
+    lastMessageId = null;
+    lastEventSeq = 0;
+    chatReceipts = {};
+    hasMoreHistory = false;
+    loadingOlder = false;
     typingIndicator.style.display = 'none';
     inputArea.style.display = 'flex';
 
@@ -362,8 +709,11 @@ function showFriendResult(message, isSuccess) {
 document.getElementById('message').addEventListener('input', function() {
     if (!ws || !currentChatId) return;
 
-    if (!isTyping) {
+    // Сервер забывает «печатает» через несколько секунд без обновлений — пока печатаем, продлеваем
+    const now = Date.now();
+    if (!isTyping || now - typingSentAt > TYPING_REFRESH_MS) {
         isTyping = true;
+        typingSentAt = now;
         ws.send(JSON.stringify({
             type: "typing",
             chat_id: currentChatId,
@@ -404,6 +754,61 @@ document.addEventListener('DOMContentLoaded', function() {
         window.__pendingGroupName = null;
     }
 
+    // Загрузка по частям: после обрыва спрашиваем сервер, сколько принято, и продолжаем оттуда
+    const UPLOAD_RETRIES = 5;
+
+    async function uploadFile(file, chatId) {
+        const form = new FormData();
+        form.append('username', username);
+        form.append('chat_id', chatId);
+        form.append('filename', file.name);
+        form.append('size', file.size);
+        form.append('content_type', file.type || 'application/octet-stream');
+        const initResp = await fetch('/api/uploads', { method: 'POST', body: form });
+        if (!initResp.ok) throw new Error(`Upload rejected: ${initResp.status}`);
+        const upload = await initResp.json();
+        try {
+            return await sendUploadChunks(file, upload);
+        } catch (e) {
+            // Недокачанный файл не должен занимать квоту до истечения TTL
+            fetch(`/api/uploads/${upload.upload_id}`, { method: 'DELETE' }).catch(() => {});
+            throw e;
+        }
+    }
+
+    async function sendUploadChunks(file, upload) {
+        let offset = upload.offset;
+        let failures = 0;
+        while (offset < file.size) {
+            const chunk = file.slice(offset, offset + upload.chunk_size);
+            let resp = null;
+            try {
+                resp = await fetch(`/api/uploads/${upload.upload_id}?offset=${offset}`, { method: 'PUT', body: chunk });
+            } catch (e) {
+                resp = null;
+            }
+            if (resp && resp.ok) {
+                offset = (await resp.json()).offset;
+                failures = 0;
+                continue;
+            }
+            if (resp && resp.status === 413) throw new Error('Upload quota exceeded');
+            if (++failures > UPLOAD_RETRIES) throw new Error('Upload failed');
+            await new Promise(resolve => setTimeout(resolve, 500 * failures));
+            try {
+                const status = await fetch(`/api/uploads/${upload.upload_id}`);
+                if (status.status === 404) throw new Error('Upload expired');
+                if (status.ok) offset = (await status.json()).offset;
+            } catch (e) {
+                if (e.message === 'Upload expired') throw e;
+            }
+        }
+
+        const done = await fetch(`/api/uploads/${upload.upload_id}/complete`, { method: 'POST' });
+        if (!done.ok) throw new Error(`Upload not completed: ${done.status}`);
+        return done.json();
+    }
+
     initChat();
 
     document.getElementById('message').addEventListener('keydown', function(event) {
@@ -415,6 +820,11 @@ document.addEventListener('DOMContentLoaded', function() {
 
     document.getElementById('send').addEventListener('click', sendMessage);
 
+    // Ленивая подгрузка истории при прокрутке к началу чата
+    chatBox.addEventListener('scroll', () => {
+        if (chatBox.scrollTop < 80) loadOlderMessages();
+    });
+
     // Прикрепление файлов
     if (attachBtn && fileInput) {
         attachBtn.addEventListener('click', () => {
@@ -426,23 +836,16 @@ document.addEventListener('DOMContentLoaded', function() {
             const file = fileInput.files && fileInput.files[0];
             if (!file || !currentChatId) return;
             try {
-                const form = new FormData();
-                form.append('username', username);
-                form.append('chat_id', currentChatId);
-                form.append('file', file);
-                const resp = await fetch('/api/upload', { method: 'POST', body: form });
-                const result = await resp.json();
+                const result = await uploadFile(file, currentChatId);
                 if (result && result.success) {
                     // Отправляем событие вложения по WebSocket для всех клиентов
-                    if (ws && ws.readyState === WebSocket.OPEN) {
-                        ws.send(JSON.stringify({
-                            type: 'attachment',
-                            chat_id: currentChatId,
-                            url: result.url,
-                            filename: result.filename,
-                            is_image: result.is_image
-                        }));
-                    }
+                    sendTracked({
+                        type: 'attachment',
+                        chat_id: currentChatId,
+                        url: result.url,
+                        filename: result.filename,
+                        is_image: result.is_image
+                    });
                 }
             } catch (e) {
                 console.error('Upload failed', e);
@@ -709,6 +1112,12 @@ function onMsgContextClick(e) {
     hideMsgContextMenu();
 }
 
+// Файлы из хранилища (/files/<sha256>/...) имеют уменьшенные копии на /thumb/<sha256>
+function thumbnailUrl(url, width) {
+    const match = /^\/files\/([0-9a-f]{64})\//.exec(url || '');
+    return match ? `/thumb/${match[1]}?w=${width}` : url;
+}
+
 function renderMessageRow(msg) {
     const row = document.createElement('div');
     row.dataset.messageId = msg.id || '';
@@ -727,14 +1136,22 @@ function renderMessageRow(msg) {
         p.appendChild(label);
         row.appendChild(p);
         if (msg.attachment.is_image) {
+            // В ленте — уменьшенная копия, по клику — оригинал
+            const link = document.createElement('a');
+            link.href = msg.attachment.url;
+            link.target = '_blank';
+            link.rel = 'noopener';
             const img = document.createElement('img');
-            img.src = msg.attachment.url;
+            img.src = thumbnailUrl(msg.attachment.url, 640);
             img.alt = msg.attachment.filename || '';
+            img.loading = 'lazy';
+            img.decoding = 'async';
             img.style.maxWidth = '280px';
             img.style.borderRadius = '6px';
             img.style.display = 'block';
             img.style.marginTop = '4px';
-            row.appendChild(img);
+            link.appendChild(img);
+            row.appendChild(link);
         } else {
             const a = document.createElement('a');
             a.href = msg.attachment.url;
@@ -756,6 +1173,15 @@ function renderMessageRow(msg) {
         }
         row.appendChild(p);
     }
+    if (msg.username === username && msg.id) {
+        // Своё сообщение: ожидает подтверждения, сохранено, доставлено, прочитано
+        row.dataset.own = '1';
+        if (msg.client_id && pendingSends.has(msg.client_id)) row.dataset.pending = '1';
+        const status = document.createElement('span');
+        status.className = 'msg-status';
+        p.appendChild(status);
+        updateMessageStatus(row);
+    }
     return row;
 }
 
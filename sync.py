@@ -0,0 +1,89 @@
+# sync.py
+"""Догоняющая синхронизация чата после переподключения.
+
+Клиент присылает {"type": "sync", "chat_id", "since_id", "since_seq"}:
+id последнего увиденного сообщения и seq последней увиденной правки или
+удаления (seq приходит в load_chat и в message_edited/message_deleted).
+В ответ — только новые сообщения и сжатый журнал правок/удалений из
+chat_events. Если пропущено слишком много, ответ — reset, и клиент
+загружает чат заново.
+
+id и seq выдаёт next_message_id на разных узлах, и событие может попасть
+в БД позже, чем клиент увидит более новое. Поэтому берём с запасом
+SYNC_SKEW_MS назад; клиент применяет ответ идемпотентно.
+"""
+import os
+import time
+from typing import List
+
+from sqlalchemy.orm import Session
+
+from history_cache import history_row
+from models import ChatEvent, Message, message_id_at
+
+SYNC_MAX_MESSAGES = 200
+SYNC_MAX_EVENTS = 1000
+SYNC_SKEW_MS = 5000
+# Журнал старше этого чистится; клиенту, отставшему сильнее, — reset
+CHAT_EVENT_RETENTION_DAYS = int(os.getenv("CHAT_EVENT_RETENTION_DAYS", "30"))
+
+
+def cursor() -> int:
+    """Текущая позиция журнала: всё, что выдано раньше, меньше неё."""
+    return message_id_at(int(time.time() * 1000))
+
+
+def _horizon() -> int:
+    return message_id_at(int((time.time() - CHAT_EVENT_RETENTION_DAYS * 86400) * 1000))
+
+
+def compact(events: List[ChatEvent], since_id: int) -> List[dict]:
+    """По одному событию на сообщение: последняя правка или удаление.
+    Сообщения новее since_id клиент получит целиком — события о них не нужны."""
+    latest = {}
+    for event in events:
+        if event.message_id > since_id:
+            continue
+        latest.pop(event.message_id, None)
+        latest[event.message_id] = event
+    return [
+        {"seq": e.seq, "kind": e.kind, "message_id": e.message_id, **({"text": e.text} if e.kind == "edit" else {})}
+        for e in latest.values()
+    ]
+
+
+def load_changes(db: Session, chat_id: str, since_id: int, since_seq: int) -> dict:
+    watermark = cursor()
+    if since_seq < _horizon():
+        return {"reset": True, "seq": watermark}
+    # id — миллисекунды << 12, так что запас по времени переводится в запас по id
+    margin = SYNC_SKEW_MS << 12
+
+    messages = (
+        db.query(Message)
+        .filter(Message.chat_id == chat_id, Message.id > since_id - margin)
+        .order_by(Message.id)
+        .limit(SYNC_MAX_MESSAGES + 1)
+        .all()
+    )
+    events = (
+        db.query(ChatEvent)
+        .filter(ChatEvent.chat_id == chat_id, ChatEvent.seq > since_seq - margin)
+        .order_by(ChatEvent.seq)
+        .limit(SYNC_MAX_EVENTS + 1)
+        .all()
+    )
+    if len(messages) > SYNC_MAX_MESSAGES or len(events) > SYNC_MAX_EVENTS:
+        return {"reset": True, "seq": watermark}
+    return {
+        "reset": False,
+        "messages": [history_row(msg) for msg in messages],
+        "events": compact(events, since_id),
+        "seq": watermark,
+    }
+
+
+def prune_events(db: Session):
+    """Удаляет журнал старше CHAT_EVENT_RETENTION_DAYS."""
+    db.query(ChatEvent).filter(ChatEvent.seq < _horizon()).delete(synchronize_session=False)
+    db.commit()
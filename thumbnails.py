@@ -0,0 +1,97 @@
+# thumbnails.py
+"""Уменьшенные копии картинок (аватары, вложения) в пуле процессов.
+
+Модуль намеренно не импортирует приложение: процессы пула запускаются через
+spawn и импортируют только его. HTTP-часть — в uploads.py (/thumb/{sha256}).
+"""
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Dict, Optional
+
+try:
+    import PIL  # noqa: F401
+    HAS_PILLOW = True
+except ImportError:
+    HAS_PILLOW = False
+
+THUMB_WORKERS = int(os.getenv("THUMB_WORKERS", "2"))
+# Допустимые ширины: запрошенная округляется вверх до ближайшей
+THUMB_WIDTHS = (64, 128, 320, 640, 1280)
+
+# Форматы: (ext, формат Pillow, параметры save)
+WEBP = ("webp", "WEBP", {"quality": 80, "method": 4})
+JPEG = ("jpg", "JPEG", {"quality": 85, "optimize": True, "progressive": True})
+PNG = ("png", "PNG", {"optimize": True})
+
+_executor: Optional[ProcessPoolExecutor] = None
+_in_flight: Dict[str, Future] = {}
+_lock = threading.Lock()
+
+
+def pick_width(width: int) -> int:
+    for allowed in THUMB_WIDTHS:
+        if width <= allowed:
+            return allowed
+    return THUMB_WIDTHS[-1]
+
+
+def fallback_format(content_type: str):
+    """Формат для браузеров без WebP: PNG сохраняет прозрачность, остальное — JPEG."""
+    return PNG if content_type == "image/png" else JPEG
+
+
+def can_resize(content_type: Optional[str]) -> bool:
+    # GIF потеряет анимацию, SVG и так векторный — такие отдаём как есть
+    return (HAS_PILLOW and bool(content_type) and content_type.startswith("image/")
+            and content_type not in ("image/gif", "image/svg+xml"))
+
+
+def render(src: str, dst: str, width: int, fmt: str, options: dict) -> str:
+    """Выполняется в процессе пула."""
+    from PIL import Image, ImageOps
+
+    with Image.open(src) as image:
+        image = ImageOps.exif_transpose(image)
+        # Ограничиваем ширину; высоту — с запасом для вертикальных картинок
+        image.thumbnail((width, width * 4))
+        if fmt == "JPEG" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        tmp = f"{dst}.{os.getpid()}.tmp"
+        image.save(tmp, fmt, **options)
+    os.replace(tmp, dst)
+    return dst
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=THUMB_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _executor
+
+
+def submit(src: str, dst: str, width: int, variant) -> Future:
+    """Ставит вариант в очередь; повторный запрос того же файла ждёт уже идущую задачу.
+    Потокобезопасно: можно звать и из обработчиков в пуле потоков."""
+    with _lock:
+        future = _in_flight.get(dst)
+        if future is None:
+            _, fmt, options = variant
+            future = _get_executor().submit(render, src, dst, width, fmt, options)
+            _in_flight[dst] = future
+            future.add_done_callback(lambda _: _forget(dst))
+        return future
+
+
+def _forget(dst: str):
+    with _lock:
+        _in_flight.pop(dst, None)
+
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
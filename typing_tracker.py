@@ -0,0 +1,106 @@
+# typing_tracker.py
+"""Индикатор «печатает»: кто печатает в каком чате, с истечением по TTL.
+
+Каждый узел держит копию состояния, собранную из событий шины (см. main.py),
+и раз в TYPING_EMIT_INTERVAL_MS рассылает своим сокетам список для каждого
+изменившегося чата — не больше одного обновления на чат за интервал, сколько
+бы событий ни пришло. Запись, которую не обновили за TYPING_TTL_MS
+(клиент пропал, не прислав is_typing=false), удаляется сама.
+"""
+import asyncio
+import logging
+import os
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+TYPING_EMIT_INTERVAL_MS = int(os.getenv("TYPING_EMIT_INTERVAL_MS", "300"))
+TYPING_TTL_MS = int(os.getenv("TYPING_TTL_MS", "6000"))
+
+Emit = Callable[[str, List[str]], Awaitable[None]]
+
+
+class TypingTracker:
+    def __init__(self, emit: Emit, interval_ms: int = TYPING_EMIT_INTERVAL_MS, ttl_ms: int = TYPING_TTL_MS):
+        self.emit = emit
+        self.interval = interval_ms / 1000.0
+        self.ttl = ttl_ms / 1000.0
+        # chat_id -> username -> когда запись истекает (time.monotonic)
+        self.typing: Dict[str, Dict[str, float]] = {}
+        # Чаты, где список изменился с прошлой рассылки
+        self.dirty: Set[str] = set()
+        # (chat_id, username) -> когда этот узел последний раз публиковал «печатает»
+        self.published: Dict[Tuple[str, str], float] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def should_publish(self, chat_id: str, username: str, is_typing: bool) -> bool:
+        """Отсев на входе: в шину идут только смена состояния и продление раз в полTTL."""
+        key = (chat_id, username)
+        now = time.monotonic()
+        if is_typing:
+            last = self.published.get(key)
+            if last is not None and now - last < self.ttl / 2:
+                return False
+            self.published[key] = now
+            return True
+        return self.published.pop(key, None) is not None
+
+    def apply(self, chat_id: str, username: str, is_typing: bool):
+        users = self.typing.setdefault(chat_id, {})
+        if is_typing:
+            if username not in users:
+                self.dirty.add(chat_id)
+            users[username] = time.monotonic() + self.ttl
+        elif users.pop(username, None) is not None:
+            self.dirty.add(chat_id)
+        if not users:
+            del self.typing[chat_id]
+
+    def clear_user(self, username: str):
+        for chat_id in [c for c, users in self.typing.items() if username in users]:
+            self.apply(chat_id, username, False)
+        for key in [k for k in self.published if k[1] == username]:
+            del self.published[key]
+
+    def is_typing(self, username: str) -> bool:
+        return any(username in users for users in self.typing.values())
+
+    def users(self, chat_id: str) -> List[str]:
+        return sorted(self.typing.get(chat_id, ()))
+
+    def _expire(self):
+        now = time.monotonic()
+        for chat_id in list(self.typing):
+            users = self.typing[chat_id]
+            for username in [u for u, expires in users.items() if expires <= now]:
+                self.apply(chat_id, username, False)
+        for key in [k for k, at in self.published.items() if now - at >= self.ttl]:
+            del self.published[key]
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self._expire()
+            dirty, self.dirty = self.dirty, set()
+            if dirty:
+                await asyncio.gather(*(self._emit(chat_id) for chat_id in dirty))
+
+    async def _emit(self, chat_id: str):
+        try:
+            await self.emit(chat_id, self.users(chat_id))
+        except Exception:
+            logger.exception("Typing update for %s failed", chat_id)
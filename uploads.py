@@ -0,0 +1,500 @@
+# uploads.py
+"""Вложения: загрузка по частям с докачкой и хранение по SHA-256.
+
+    POST /api/uploads                  — начать загрузку (username, chat_id, filename, size, content_type)
+    PUT  /api/uploads/{id}?offset=N    — тело запроса: байты файла начиная с offset
+    GET  /api/uploads/{id}             — сколько байт уже принято (откуда докачивать)
+    POST /api/uploads/{id}/complete    — собрать файл и получить url
+    DELETE /api/uploads/{id}           — отменить загрузку
+    GET  /files/{sha256}/{filename}    — отдача файла; содержимое неизменно, кэшируется навсегда
+    GET  /thumb/{sha256}?w=320         — уменьшенная копия картинки (WebP, если браузер его принимает)
+
+Одинаковые файлы хранятся один раз (uploads/objects/ab/abcdef...).
+Квота пользователя проверяется до записи: при начале загрузки резервируется
+заявленный размер, и принять больше заявленного нельзя.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import secrets
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Dict, Optional
+from urllib.parse import quote
+
+import anyio
+from fastapi import APIRouter, Depends, File, Form, HTTPException, Request, UploadFile
+from fastapi.responses import FileResponse, RedirectResponse, Response
+from sqlalchemy import func
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+import thumbnails
+from auth import current_user, require_self
+from database import run_db
+from models import ChatMember, StoredFile, Upload, UserFile
+from ratelimit import rate_limit
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+UPLOAD_ROOT = Path(os.getenv("UPLOAD_ROOT", "uploads"))
+OBJECTS_DIR = UPLOAD_ROOT / "objects"
+PARTIAL_DIR = UPLOAD_ROOT / "partial"
+THUMB_DIR = UPLOAD_ROOT / "thumbs"
+# Сколько всего может хранить один пользователь
+UPLOAD_QUOTA_BYTES = int(os.getenv("UPLOAD_QUOTA_BYTES", str(1024 ** 3)))
+# Рекомендуемый размер части для клиента
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(4 * 1024 * 1024)))
+# Незавершённые загрузки старше этого удаляются при старте
+UPLOAD_TTL_HOURS = int(os.getenv("UPLOAD_TTL_HOURS", "24"))
+READ_SIZE = 64 * 1024
+# Какие уменьшенные копии строим сразу после загрузки (остальные — по первому запросу)
+ATTACHMENT_THUMB_WIDTHS = (640,)
+AVATAR_THUMB_WIDTHS = (128, 320)
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+
+_SHA256_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+class _HashState:
+    """Хэш принятой части; живёт в памяти, после рестарта пересчитывается с диска."""
+
+    def __init__(self):
+        self.hasher = hashlib.sha256()
+        self.offset = 0
+
+
+_hashes: Dict[str, _HashState] = {}
+_locks: Dict[str, asyncio.Lock] = {}
+
+
+def object_path(sha256: str) -> Path:
+    return OBJECTS_DIR / sha256[:2] / sha256
+
+
+def partial_path(upload_id: str) -> Path:
+    return PARTIAL_DIR / upload_id
+
+
+def thumb_path(sha256: str, width: int, ext: str) -> Path:
+    return THUMB_DIR / sha256[:2] / f"{sha256}-{width}.{ext}"
+
+
+def file_url(sha256: str, filename: str) -> str:
+    return f"/files/{sha256}/{quote(filename)}"
+
+
+def thumb_url(url: Optional[str], width: int) -> Optional[str]:
+    """Jinja-фильтр и помощник: url файла из хранилища -> url его уменьшенной копии."""
+    if url and url.startswith("/files/"):
+        return f"/thumb/{url.split('/')[2]}?w={width}"
+    return url
+
+
+def prebuild_thumbnails(sha256: str, content_type: str, widths):
+    """Фоновая сборка WebP-вариантов; не ждёт результата."""
+    if not thumbnails.can_resize(content_type):
+        return
+    for width in widths:
+        thumbnails.submit(str(object_path(sha256)), str(thumb_path(sha256, width, "webp")), width, thumbnails.WEBP)
+
+
+# ====== БД ======
+def user_usage(db: Session, username: str) -> int:
+    """Занято пользователем: его файлы (каждый хэш один раз) плюс резерв незавершённых загрузок."""
+    own = db.query(UserFile.sha256).filter(UserFile.username == username).distinct()
+    stored = db.query(func.coalesce(func.sum(StoredFile.size), 0)).filter(StoredFile.sha256.in_(own)).scalar()
+    pending = db.query(func.coalesce(func.sum(Upload.size), 0)).filter(Upload.username == username).scalar()
+    return stored + pending
+
+
+def is_chat_member(db: Session, chat_id: str, username: str) -> bool:
+    return db.query(ChatMember.username).filter(
+        ChatMember.chat_id == chat_id, ChatMember.username == username
+    ).first() is not None
+
+
+def create_upload(db: Session, username: str, chat_id: str, filename: str, size: int, content_type: str):
+    if user_usage(db, username) + size > UPLOAD_QUOTA_BYTES:
+        return None
+    upload = Upload(
+        id=secrets.token_urlsafe(16),
+        username=username,
+        chat_id=chat_id,
+        filename=filename,
+        content_type=content_type,
+        size=size,
+        received=0
+    )
+    db.add(upload)
+    db.commit()
+    return upload.id
+
+
+def get_upload(db: Session, upload_id: str) -> Optional[dict]:
+    upload = db.query(Upload).filter(Upload.id == upload_id).first()
+    if not upload:
+        return None
+    return {
+        "id": upload.id,
+        "username": upload.username,
+        "chat_id": upload.chat_id,
+        "filename": upload.filename,
+        "content_type": upload.content_type,
+        "size": upload.size,
+        "received": upload.received or 0,
+    }
+
+
+def set_received(db: Session, upload_id: str, received: int):
+    db.query(Upload).filter(Upload.id == upload_id).update({"received": received}, synchronize_session=False)
+    db.commit()
+
+
+def register_file(db: Session, sha256: str, size: int, content_type: str,
+                  username: str, filename: str, chat_id: str, upload_id: Optional[str] = None):
+    db.execute(sqlite_insert(StoredFile).values(
+        sha256=sha256, size=size, content_type=content_type,
+        created_at=datetime.now(timezone.utc)
+    ).on_conflict_do_nothing(index_elements=["sha256"]))
+    db.add(UserFile(username=username, sha256=sha256, filename=filename, chat_id=chat_id))
+    if upload_id:
+        db.query(Upload).filter(Upload.id == upload_id).delete(synchronize_session=False)
+    db.commit()
+
+
+def get_content_type(db: Session, sha256: str) -> Optional[str]:
+    return db.query(StoredFile.content_type).filter(StoredFile.sha256 == sha256).scalar()
+
+
+def delete_upload(db: Session, upload_id: str):
+    db.query(Upload).filter(Upload.id == upload_id).delete(synchronize_session=False)
+    db.commit()
+
+
+def pop_stale_uploads(db: Session, ttl_hours: int):
+    cutoff = datetime.now(timezone.utc) - timedelta(hours=ttl_hours)
+    ids = [row.id for row in db.query(Upload.id).filter(Upload.created_at < cutoff)]
+    if ids:
+        db.query(Upload).filter(Upload.id.in_(ids)).delete(synchronize_session=False)
+        db.commit()
+    return ids
+
+
+# ====== Диск ======
+def _hash_prefix(path: Path, length: int) -> _HashState:
+    state = _HashState()
+    with open(path, "rb") as f:
+        while state.offset < length:
+            chunk = f.read(min(READ_SIZE, length - state.offset))
+            if not chunk:
+                break
+            state.hasher.update(chunk)
+            state.offset += len(chunk)
+    return state
+
+
+def _move_into_store(path: Path, sha256: str, size: int):
+    target = object_path(sha256)
+    if target.exists():
+        # Такой файл уже есть — копию не храним
+        path.unlink(missing_ok=True)
+        return
+    target.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "r+b") as f:
+        f.truncate(size)
+    os.replace(path, target)
+
+
+async def _hash_state(upload_id: str, offset: int) -> _HashState:
+    state = _hashes.get(upload_id)
+    if state is None or state.offset != offset:
+        path = partial_path(upload_id)
+        state = await anyio.to_thread.run_sync(_hash_prefix, path, offset) if offset else _HashState()
+        if state.offset != offset:
+            raise HTTPException(status_code=409, detail="Partial upload is missing on disk")
+        _hashes[upload_id] = state
+    return state
+
+
+async def store_file(path: Path, sha256: str, size: int, content_type: str,
+                     username: str, filename: str, chat_id: str, upload_id: Optional[str] = None) -> dict:
+    # Сначала файл на место, потом запись в БД — БД никогда не ссылается на отсутствующий файл
+    await anyio.to_thread.run_sync(_move_into_store, path, sha256, size)
+    await run_db(register_file, sha256, size, content_type, username, filename, chat_id, upload_id)
+    prebuild_thumbnails(sha256, content_type, ATTACHMENT_THUMB_WIDTHS)
+    return {
+        "success": True,
+        "url": file_url(sha256, filename),
+        "filename": filename,
+        "content_type": content_type,
+        "is_image": content_type.startswith("image/"),
+        "sha256": sha256,
+        "size": size,
+    }
+
+
+def store_stream(db: Session, fileobj, username: str, filename: str, content_type: str,
+                 chat_id: str = "") -> Optional[str]:
+    """Синхронная загрузка одним куском — для обработчиков в пуле потоков (аватар).
+    Возвращает url или None, если превышена квота."""
+    remaining = UPLOAD_QUOTA_BYTES - user_usage(db, username)
+    PARTIAL_DIR.mkdir(parents=True, exist_ok=True)
+    path = partial_path(secrets.token_urlsafe(16))
+    hasher = hashlib.sha256()
+    size = 0
+    with open(path, "wb") as f:
+        while chunk := fileobj.read(READ_SIZE):
+            size += len(chunk)
+            if size > remaining:
+                break
+            hasher.update(chunk)
+            f.write(chunk)
+    if size > remaining:
+        path.unlink(missing_ok=True)
+        return None
+
+    sha256 = hasher.hexdigest()
+    _move_into_store(path, sha256, size)
+    register_file(db, sha256, size, content_type, username, filename, chat_id)
+    prebuild_thumbnails(sha256, content_type, AVATAR_THUMB_WIDTHS)
+    return file_url(sha256, filename)
+
+
+async def cleanup_stale_uploads():
+    for upload_id in await run_db(pop_stale_uploads, UPLOAD_TTL_HOURS):
+        _forget(upload_id)
+        await anyio.Path(partial_path(upload_id)).unlink(missing_ok=True)
+
+
+def _forget(upload_id: str):
+    """Убирает состояние загрузки из памяти — после сборки, отмены или по TTL."""
+    _hashes.pop(upload_id, None)
+    _locks.pop(upload_id, None)
+
+
+def _clean_filename(filename: Optional[str]) -> str:
+    return os.path.basename(filename or "") or "attachment"
+
+
+def _not_found():
+    return HTTPException(status_code=404, detail="Upload not found")
+
+
+async def _require_member(chat_id: str, username: str):
+    # Как и кадр attachment: вложения — только в чаты, где пользователь состоит
+    if not await run_db(is_chat_member, chat_id, username):
+        raise HTTPException(status_code=403, detail="Not a chat member")
+
+
+async def _own_upload(upload_id: str, username: str) -> dict:
+    upload = await run_db(get_upload, upload_id)
+    if not upload:
+        # Лок под этот id мог создать сам запрос — не копим их для несуществующих загрузок
+        _forget(upload_id)
+        raise _not_found()
+    # Чужая загрузка для пользователя не существует
+    if upload["username"] != username:
+        raise _not_found()
+    return upload
+
+
+# ====== Загрузка по частям ======
+@router.post("/api/uploads", dependencies=[Depends(rate_limit("upload"))])
+async def init_upload(
+    username: str = Form(...),
+    chat_id: str = Form(...),
+    filename: str = Form(...),
+    size: int = Form(...),
+    content_type: str = Form("application/octet-stream"),
+    user: str = Depends(current_user)
+):
+    require_self(username, user)
+    if not chat_id:
+        raise HTTPException(status_code=400, detail="chat_id is required")
+    if size < 0:
+        raise HTTPException(status_code=400, detail="Invalid size")
+    await _require_member(chat_id, username)
+
+    upload_id = await run_db(create_upload, username, chat_id, _clean_filename(filename),
+                             size, (content_type or "application/octet-stream").lower())
+    if upload_id is None:
+        raise HTTPException(status_code=413, detail="Upload quota exceeded")
+    await anyio.Path(PARTIAL_DIR).mkdir(parents=True, exist_ok=True)
+    await anyio.Path(partial_path(upload_id)).touch()
+    return {"upload_id": upload_id, "offset": 0, "size": size, "chunk_size": UPLOAD_CHUNK_SIZE}
+
+
+@router.get("/api/uploads/{upload_id}")
+async def upload_status(upload_id: str, user: str = Depends(current_user)):
+    upload = await _own_upload(upload_id, user)
+    return {"upload_id": upload_id, "offset": upload["received"], "size": upload["size"]}
+
+
+@router.put("/api/uploads/{upload_id}")
+async def upload_chunk(upload_id: str, offset: int, request: Request, user: str = Depends(current_user)):
+    async with _locks.setdefault(upload_id, asyncio.Lock()):
+        upload = await _own_upload(upload_id, user)
+        if offset != upload["received"]:
+            # Клиент должен продолжить с того места, где сервер остановился
+            raise HTTPException(status_code=409, detail={"offset": upload["received"]})
+
+        state = await _hash_state(upload_id, offset)
+        received = offset
+        try:
+            async with await anyio.open_file(partial_path(upload_id), "r+b" if offset else "wb") as f:
+                await f.seek(offset)
+                async for chunk in request.stream():
+                    if received + len(chunk) > upload["size"]:
+                        raise HTTPException(status_code=413, detail="More data than declared")
+                    await f.write(chunk)
+                    state.hasher.update(chunk)
+                    received += len(chunk)
+                    state.offset = received
+        finally:
+            # Принятое до обрыва засчитываем: докачка продолжится с этого места
+            if received != offset:
+                await run_db(set_received, upload_id, received)
+
+    return {"upload_id": upload_id, "offset": received, "size": upload["size"]}
+
+
+@router.post("/api/uploads/{upload_id}/complete")
+async def complete_upload(upload_id: str, user: str = Depends(current_user)):
+    async with _locks.setdefault(upload_id, asyncio.Lock()):
+        upload = await _own_upload(upload_id, user)
+        if upload["received"] != upload["size"]:
+            raise HTTPException(status_code=409, detail={"offset": upload["received"]})
+
+        state = await _hash_state(upload_id, upload["size"])
+        result = await store_file(
+            partial_path(upload_id), state.hasher.hexdigest(), upload["size"], upload["content_type"],
+            upload["username"], upload["filename"], upload["chat_id"], upload_id
+        )
+    _forget(upload_id)
+    return result
+
+
+@router.delete("/api/uploads/{upload_id}")
+async def cancel_upload(upload_id: str, user: str = Depends(current_user)):
+    async with _locks.setdefault(upload_id, asyncio.Lock()):
+        await _own_upload(upload_id, user)
+        await run_db(delete_upload, upload_id)
+        await anyio.Path(partial_path(upload_id)).unlink(missing_ok=True)
+    _forget(upload_id)
+    return {"upload_id": upload_id, "cancelled": True}
+
+
+# ====== Загрузка одним запросом (старый API) ======
+@router.post("/api/upload", dependencies=[Depends(rate_limit("upload"))])
+async def upload_attachment(
+    username: str = Form(...),
+    chat_id: str = Form(...),
+    file: UploadFile = File(...),
+    user: str = Depends(current_user)
+):
+    require_self(username, user)
+    if not chat_id:
+        raise HTTPException(status_code=400, detail="chat_id is required")
+    await _require_member(chat_id, username)
+
+    remaining = UPLOAD_QUOTA_BYTES - await run_db(user_usage, username)
+    await anyio.Path(PARTIAL_DIR).mkdir(parents=True, exist_ok=True)
+    path = partial_path(secrets.token_urlsafe(16))
+    hasher = hashlib.sha256()
+    size = 0
+    try:
+        async with await anyio.open_file(path, "wb") as f:
+            while chunk := await file.read(READ_SIZE):
+                size += len(chunk)
+                if size > remaining:
+                    raise HTTPException(status_code=413, detail="Upload quota exceeded")
+                hasher.update(chunk)
+                await f.write(chunk)
+    except BaseException:
+        await anyio.Path(path).unlink(missing_ok=True)
+        raise
+
+    content_type = (file.content_type or "application/octet-stream").lower()
+    return await store_file(path, hasher.hexdigest(), size, content_type,
+                            username, _clean_filename(file.filename), chat_id)
+
+
+# ====== Отдача ======
+@router.get("/files/{sha256}/{filename}")
+async def get_file(sha256: str, filename: str, request: Request):
+    if not _SHA256_RE.match(sha256):
+        raise HTTPException(status_code=404, detail="File not found")
+    etag = f'"{sha256}"'
+    cache_headers = {"ETag": etag, "Cache-Control": IMMUTABLE_CACHE}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=cache_headers)
+
+    content_type = await run_db(get_content_type, sha256)
+    path = object_path(sha256)
+    if content_type is None or not await anyio.Path(path).exists():
+        raise HTTPException(status_code=404, detail="File not found")
+
+    # Картинки показываем inline, остальное (и svg со скриптами) — только скачиванием
+    inline = content_type.startswith("image/") and content_type != "image/svg+xml"
+    return FileResponse(
+        path,
+        media_type=content_type,
+        filename=filename,
+        content_disposition_type="inline" if inline else "attachment",
+        headers={**cache_headers, "X-Content-Type-Options": "nosniff"}
+    )
+
+
+@router.get("/thumb/{sha256}")
+async def get_thumbnail(sha256: str, request: Request, w: int = 320):
+    if not _SHA256_RE.match(sha256):
+        raise HTTPException(status_code=404, detail="File not found")
+    width = thumbnails.pick_width(w)
+    webp = "image/webp" in request.headers.get("accept", "")
+    variants = [thumbnails.WEBP] if webp else [thumbnails.JPEG, thumbnails.PNG]
+
+    # ETag выводится из хэша и параметров, так что 304 отдаём, не трогая ни диск, ни БД
+    if request.headers.get("if-none-match") in {_thumb_etag(sha256, width, v) for v in variants}:
+        return Response(status_code=304, headers={
+            "ETag": request.headers["if-none-match"], "Cache-Control": IMMUTABLE_CACHE, "Vary": "Accept"})
+
+    for variant in variants:
+        path = thumb_path(sha256, width, variant[0])
+        if await anyio.Path(path).exists():
+            return _thumb_response(path, sha256, width, variant)
+
+    content_type = await run_db(get_content_type, sha256)
+    if content_type is None:
+        raise HTTPException(status_code=404, detail="File not found")
+    original = file_url(sha256, "original")
+    if not thumbnails.can_resize(content_type):
+        return RedirectResponse(original)
+
+    variant = thumbnails.WEBP if webp else thumbnails.fallback_format(content_type)
+    path = thumb_path(sha256, width, variant[0])
+    try:
+        await asyncio.wrap_future(thumbnails.submit(str(object_path(sha256)), str(path), width, variant))
+    except Exception:
+        logger.exception("Thumbnail failed for %s", sha256)
+        return RedirectResponse(original)
+    return _thumb_response(path, sha256, width, variant)
+
+
+_THUMB_MEDIA_TYPES = {"webp": "image/webp", "jpg": "image/jpeg", "png": "image/png"}
+
+
+def _thumb_etag(sha256: str, width: int, variant) -> str:
+    return f'"{sha256}-{width}.{variant[0]}"'
+
+
+def _thumb_response(path: Path, sha256: str, width: int, variant):
+    return FileResponse(path, media_type=_THUMB_MEDIA_TYPES[variant[0]], headers={
+        "ETag": _thumb_etag(sha256, width, variant),
+        "Cache-Control": IMMUTABLE_CACHE,
+        "Vary": "Accept",
+    })
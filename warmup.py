@@ -0,0 +1,148 @@
+# warmup.py
+"""Прогрев узла перед приёмом трафика и время до готовности.
+
+Старт идёт через lifespan приложения: пока шаги не пройдены, uvicorn не
+принимает соединения, поэтому первые запросы после выката не платят за
+холодную базу и некомпилированные шаблоны. Каждый шаг замеряется; итог —
+в /healthz: время до готовности от запуска процесса и длительность шагов.
+
+Что прогревается:
+- пул соединений — открываются все DB_POOL_SIZE соединений, каждое
+  выполняет PRAGMA из models.py;
+- горячие индексы — начало индексов входа, списка друзей и списка чатов
+  и самые новые сообщения: страницы попадают в кэш ОС, откуда их читает
+  mmap любого соединения, и в кэш страниц прогревающего соединения.
+  Каждый проход ограничен WARMUP_INDEX_ROWS записями, все вместе —
+  WARMUP_BUDGET_S секундами, так что старт не растёт вместе с базой;
+- кэш истории — последние сообщения WARMUP_HISTORY_CHATS самых активных чатов;
+- шаблоны Jinja — компилируются заранее, а не на первом запросе.
+"""
+import logging
+import os
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+
+from models import Chat
+
+logger = logging.getLogger(__name__)
+
+WARMUP_INDEXES = os.getenv("WARMUP_INDEXES", "1") == "1"
+WARMUP_INDEX_ROWS = int(os.getenv("WARMUP_INDEX_ROWS", "100000"))
+WARMUP_BUDGET_S = float(os.getenv("WARMUP_BUDGET_S", "2"))
+# Сколько последних активных чатов загрузить в кэш истории
+WARMUP_HISTORY_CHATS = int(os.getenv("WARMUP_HISTORY_CHATS", "200"))
+
+# Выборки прогрева; INDEXED BY — чтобы SQLite не выбрал другой, более узкий индекс.
+# У индексов первичных ключей имена автоматические, их выбираем через ORDER BY по ключу.
+# Сообщения — с конца таблицы: свежие страницы нужнее всего (id растут со временем)
+HOT_QUERIES = (
+    "SELECT username FROM users INDEXED BY ix_users_username",
+    "SELECT friend FROM friendships ORDER BY username, friend",
+    "SELECT friend FROM friendships INDEXED BY ix_friendships_friend",
+    "SELECT username FROM chat_members ORDER BY chat_id, username",
+    "SELECT chat_id FROM chat_members INDEXED BY ix_chat_members_username_chat_id",
+    "SELECT last_message_text FROM chats",
+    "SELECT text FROM messages ORDER BY id DESC",
+)
+
+
+def process_uptime() -> Optional[float]:
+    """Секунды с запуска процесса (Linux); None, если узнать нельзя."""
+    try:
+        with open("/proc/self/stat") as f:
+            # Поле 22 — момент запуска в тиках от загрузки; имя процесса в скобках может содержать пробелы
+            started_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        return time.clock_gettime(time.CLOCK_BOOTTIME) - started_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+class Startup:
+    def __init__(self):
+        self.started = time.monotonic()
+        # шаг -> секунды
+        self.steps: Dict[str, float] = {}
+        self.ready_s: Optional[float] = None
+
+    @contextmanager
+    def step(self, name: str):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.steps[name] = round(time.monotonic() - started, 4)
+
+    def ready(self):
+        uptime = process_uptime()
+        # Без /proc считаем от начала lifespan — без учёта импорта модулей
+        self.ready_s = round(uptime if uptime is not None else time.monotonic() - self.started, 3)
+        logger.info("Ready in %.2fs: %s", self.ready_s,
+                    ", ".join(f"{name} {seconds:.3f}s" for name, seconds in self.steps.items()))
+
+    def status(self) -> dict:
+        return {
+            "ready": self.ready_s is not None,
+            "ready_s": self.ready_s,
+            "startup_s": round(sum(self.steps.values()), 3),
+            "steps": self.steps,
+        }
+
+
+def prewarm_pool(engine, size: int) -> int:
+    """Открывает size соединений разом, чтобы пул вернул их уже настроенными."""
+    connections = []
+    try:
+        for _ in range(size):
+            connection = engine.connect()
+            connection.exec_driver_sql("SELECT 1")
+            connections.append(connection)
+    finally:
+        for connection in connections:
+            connection.close()
+    return len(connections)
+
+
+def warm_indexes(db: Session, rows: int = WARMUP_INDEX_ROWS, budget_s: float = WARMUP_BUDGET_S) -> int:
+    """Читает начало горячих индексов; возвращает число прочитанных записей."""
+    if not WARMUP_INDEXES:
+        return 0
+    deadline = time.monotonic() + budget_s
+    total = 0
+    for query in HOT_QUERIES:
+        if time.monotonic() >= deadline:
+            logger.info("Index warm-up stopped at the %.1fs budget", budget_s)
+            break
+        try:
+            total += db.execute(text(f"SELECT count(*) FROM ({query} LIMIT :rows)"), {"rows": rows}).scalar()
+        except OperationalError:
+            # Нет индекса или база занята — прогрев необязателен, старт не прерываем
+            logger.warning("Index warm-up query failed: %s", query, exc_info=True)
+            db.rollback()
+    return total
+
+
+def recent_chats(db: Session, limit: int = WARMUP_HISTORY_CHATS) -> List[str]:
+    """Чаты с самыми свежими сообщениями (id растут со временем)."""
+    if limit <= 0:
+        return []
+    rows = (
+        db.query(Chat.id)
+        .filter(Chat.last_message_id.isnot(None))
+        .order_by(Chat.last_message_id.desc())
+        .limit(limit)
+        .all()
+    )
+    return [chat_id for (chat_id,) in rows]
+
+
+def compile_templates(env) -> int:
+    """Компилирует все шаблоны в кэш окружения Jinja."""
+    names = env.list_templates(extensions=["html"])
+    for name in names:
+        env.get_template(name)
+    return len(names)